@@ -6,7 +6,7 @@ from __future__ import division, absolute_import, unicode_literals
 from collections import OrderedDict
 from functools import wraps
 from itertools import chain, islice
-from random import choice, randrange, shuffle
+from random import choice, shuffle
 import traceback
 import uuid
 
@@ -22,6 +22,8 @@ from apps.admin.admin import flag_comment, flag_photo, flag_user
 from ocean_exceptions import InsufficientAuthorization, InvalidAPIUsage, \
     NotFound
 from log import log
+from logic import candidates, judged, leaderboard, match_queue, overview, \
+    ranking
 from logic import search
 from logic import sentry
 from logic import sns
@@ -30,18 +32,20 @@ from logic.auth_token import current_api_user
 from logic.facebook import get_facebook_id
 from logic.feed import feed_activity, feed_new_comment, feed_tournament_win
 from logic.location import Geo, get_location_name, Location
+from logic.matchmaking import get_matchmakers, get_media_type, get_pairs
 import model
-from logic.photo import create_photo, get_photo
+from logic.photo import create_photo, get_photo, get_photos_by_uuid
 from logic.s3 import get_s3_connection
 from logic.score import log_match_for_scoring
-from logic.sqs import get_facebook_photo
+from logic.sqs import get_facebook_photo, prefetch_matches
 from logic.stats import incr, timingIncrDecorator
-from logic.tournament import create_match, get_next_tournament, \
-    init_tournament_status, tournament_is_next, tournament_status_log_match
+from logic.tournament import create_match, create_matches, \
+    get_next_tournament, init_tournament_status, lock_tournament_status, \
+    tournament_is_next, tournament_status_log_match
 from logic.user import change_user_name, create_user, delete_user, get_user, \
     update_registration_status
 from settings import settings
-from util import count_iter, now, random_by_twos, unix_time
+from util import count_iter, now, unix_time
 
 # -- Error Handlers -----------------------------------------------------------
 
@@ -850,58 +854,47 @@ def render_feed_activity(feed_activity, request_authorized=False):
     return data
 
 def render_match(photo_a, a_win_delta, a_lose_delta,
-                 photo_b, b_win_delta, b_lose_delta):
+                 photo_b, b_win_delta, b_lose_delta, renders=None):
+    """Render a match, its photos from renders, by uuid, if they are there."""
+    renders = renders or {}
     db_match_hex = photo_a.uuid.hex + photo_b.uuid.hex
     return {
         'match_id': db_match_hex,
         't': 'regular',
-        'photo_a': render_photo(photo_a),
+        'photo_a': renders.get(photo_a.uuid) or render_photo(photo_a),
         'a_win_delta': pscore(a_win_delta),
         'a_lose_delta': pscore(a_lose_delta),
-        'photo_b': render_photo(photo_b),
+        'photo_b': renders.get(photo_b.uuid) or render_photo(photo_b),
         'b_win_delta': pscore(b_win_delta),
         'b_lose_delta': pscore(b_lose_delta)
     }
 
+# Tournament's photo attributes, in the order they are rendered.
+TOURNAMENT_SEATS = ('one', 'two', 'three', 'four', 'five', 'six', 'seven',
+                    'eight', 'nine', 'ten', 'eleven', 'twelve', 'thirteen',
+                    'fourteen', 'fifteen', 'sixteen')
+
 def render_tournament(gender_location, tournament):
-    # TODO: Broken - g_l arg won't work for cross regional tournament
-    try:
-        return {
-            't': tournament.kind,
-            'uuid': tournament.uuid.hex,
-            'one': render_photo(model.Photo.get(gender_location, tournament.one)),
-            'two': render_photo(model.Photo.get(gender_location, tournament.two)),
-            'three': render_photo(model.Photo.get(gender_location,
-                                                  tournament.three)),
-            'four': render_photo(model.Photo.get(gender_location,
-                                                 tournament.four)),
-            'five': render_photo(model.Photo.get(gender_location,
-                                                 tournament.five)),
-            'six': render_photo(model.Photo.get(gender_location,
-                                                tournament.six)),
-            'seven': render_photo(model.Photo.get(gender_location,
-                                                  tournament.seven)),
-            'eight': render_photo(model.Photo.get(gender_location,
-                                                  tournament.eight)),
-            'nine': render_photo(model.Photo.get(gender_location,
-                                                 tournament.nine)),
-            'ten': render_photo(model.Photo.get(gender_location,
-                                                tournament.ten)),
-            'eleven': render_photo(model.Photo.get(gender_location,
-                                                   tournament.eleven)),
-            'twelve': render_photo(model.Photo.get(gender_location,
-                                                   tournament.twelve)),
-            'thirteen': render_photo(model.Photo.get(gender_location,
-                                                     tournament.thirteen)),
-            'fourteen': render_photo(model.Photo.get(gender_location,
-                                                     tournament.fourteen)),
-            'fifteen': render_photo(model.Photo.get(gender_location,
-                                                    tournament.fifteen)),
-            'sixteen': render_photo(model.Photo.get(gender_location,
-                                                    tournament.sixteen)),
-        }
-    except DoesNotExist:
+    """Render a tournament, None if any of its photos is gone.
+
+    The photos are read in one batch from gender_location's shards, and
+    from uuid_index if they are elsewhere.
+
+    """
+    photo_uuids = [getattr(tournament, seat) for seat in TOURNAMENT_SEATS]
+    photos = get_photos_by_uuid(photo_uuids, dict(
+        (photo_uuid,
+         model.get_gender_location_shard(gender_location, photo_uuid))
+        for photo_uuid in photo_uuids))
+    if len(photos) < len(set(photo_uuids)):
         return None
+    result = {
+        't': tournament.kind,
+        'uuid': tournament.uuid.hex
+    }
+    for seat, photo_uuid in zip(TOURNAMENT_SEATS, photo_uuids):
+        result[seat] = render_photo(photos[photo_uuid])
+    return result
 
 def render_wins(wins):
     result = []
@@ -1240,8 +1233,7 @@ class TestNotification(Resource):
 
         # Get a photo, any photo will do, so long as it's not yours.
         photo = None
-        for p in model.Photo.all_score_index.query('all', limit=20,
-                                                   consistent_read=False):
+        for p in leaderboard.get_all_time_top(limit=20):
             photo = p
             if photo.user_uuid != user.uuid:
                 break
@@ -1271,8 +1263,7 @@ class TestNotification(Resource):
 
         # Get a comment, any comment will do, so long as it's not yours.
         comment = None
-        q = model.Photo.all_score_index.query('all', limit=200,
-                                              consistent_read=False)
+        q = leaderboard.get_all_time_top(limit=200)
         done = False
         while not done:
             try:
@@ -1307,8 +1298,7 @@ class TestNotification(Resource):
 
         # Get a user, any user will do, so long as it's not you.
         follower_uuid = None
-        for p in model.Photo.all_score_index.query('all', limit=20,
-                                                   consistent_read=False):
+        for p in leaderboard.get_all_time_top(limit=20):
             follower_uuid = p.user_uuid
             if follower_uuid != user.uuid:
                 break
@@ -2308,6 +2298,164 @@ matches_parser.add_argument('reset_tournament_status',
                             required=False,
                             location='values',
                             default='False')
+
+# Matches in a batch, at most.
+MATCH_BATCH_SIZE = 10
+
+def pick_matches(user, g_l, is_test=False, excluded=(), bumped=()):
+    """Pick a batch of pairs for the user to judge from the photos of g_l.
+
+    Returns (pairs, bump_photo), pairs of (photo_a, photo_b) with photo_a's
+    uuid the lower, and bump_photo the user's newest photo if the first pair
+    is it bumped into their matches, else None. None if g_l has too few
+    photos. Pairs in excluded, (photo_a uuid, photo_b uuid), are passed
+    over, as are the photos in bumped, by uuid, for bumping. Nothing is
+    written, see serve_matches.
+
+    """
+    # The newest 200 photos, so we can select from those at random.
+    pool = candidates.get_pool(g_l, include_test=is_test)
+    if len(pool) < 2:
+        log.info("not enough photos to make matches in %s", g_l)
+        return None
+
+    # Special Case - If the user posts and views the same gender, then
+    # we get their just-posted picture into their next Match request.
+    match_bump_photo = None
+    # This is a hack requested by @mcgraw, that everybody posts as female.
+#    if user.view_gender_male == user.show_gender_male:
+    if True:
+        # Get this user's most recent photo.
+        user_photos = model.Photo.user_index.query(
+                user.uuid,
+                limit=4,
+                scan_index_forward=False,
+                copy_complete__eq=True)
+
+        user_photos = list(user_photos)
+        if any(p for p in user_photos if not p.copy_complete):
+            log.debug("copy_complete__eq not working, photos with copy_complete!=True in leaderboards-query results")
+        user_photos = [p for p in user_photos if p.copy_complete]
+        if user_photos:
+            photo = user_photos[0]
+            # If we have not already bumped this photo.
+            if not photo.match_bumped and photo.uuid not in bumped:
+                if photo.copy_complete:
+                    match_bump_photo = photo
+
+    # Pairs favor photos we know least about against close opponents,
+    # see logic/matchmaking.py. Movies and photos aren't mixed.
+    first_pair = []
+    if match_bump_photo:
+        rando = pool.matchmakers[get_media_type(
+            match_bump_photo)].pick_opponent(match_bump_photo)
+        if rando is not None:
+            first_pair.append((match_bump_photo, rando))
+
+    matches = chain(first_pair, get_pairs(pool.matchmakers, len(pool)))
+    judged_filter = judged.get_filter(user.uuid)
+    pairs = []
+
+    while len(pairs) < MATCH_BATCH_SIZE:
+        try:
+            match = matches.next()
+        except StopIteration:
+            break
+
+        photo_a = match[0]
+        photo_b = match[1]
+        # Do not allow a user to compete against themselves.
+        if photo_a.user_uuid == photo_b.user_uuid:
+            continue
+        # Very important!  Match.photo_a.uuid < Match.photo_b.uuid
+        if photo_a.uuid.hex > photo_b.uuid.hex:
+            photo_a, photo_b = photo_b, photo_a
+
+        if (photo_a.uuid, photo_b.uuid) in excluded:
+            continue
+        # Matches are saved once the batch is served, so check this
+        # batch's pairs as well as the table.
+        if any(a.uuid == photo_a.uuid and b.uuid == photo_b.uuid
+               for a, b in pairs):
+            continue
+        # See if user has already made a match before suggesting it.
+        if judged_filter.has_judged(photo_a.uuid, photo_b.uuid):
+            continue
+        pairs.append((photo_a, photo_b))
+
+    bump_photo = None
+    if match_bump_photo and pairs and \
+       match_bump_photo.uuid in (pairs[0][0].uuid, pairs[0][1].uuid):
+        bump_photo = match_bump_photo
+    return pairs, bump_photo
+
+def serve_matches(user, g_l, pairs, bump_photo=None,
+                  reset_tournament_status=False, renders=None):
+    """Make and render the Matches of pick_matches's pairs for the user, up
+    to their next tournament, which is rendered after them.
+
+    The Matches, the user's tournament status and bump_photo's match_bumped
+    are written together. The status is written only if no other request
+    has changed it since the user was read, so two at once can't both
+    advance it. renders, rendered photos by uuid, are used rather than
+    rendering the photos again. Not idempotent.
+
+    """
+    write_back = model.WriteBack()
+    lock_tournament_status(user, write_back)
+    if reset_tournament_status:
+        log.info("resetting tournament status")
+        init_tournament_status(user, write_back)
+
+    pairs = iter(pairs)
+    served = []
+    tournament = None
+    while len(served) < MATCH_BATCH_SIZE:
+        if tournament_is_next(user, write_back):
+            tournament = get_next_tournament(user, write_back)
+            break  # Tournament loading is slow, so stop here.
+        pair = next(pairs, None)
+        if pair is None:
+            break
+        # Increment the tournament counter for this user.
+        tournament_status_log_match(user, write_back)
+        served.append(pair)
+
+    if bump_photo is not None and served and \
+       bump_photo.uuid in (served[0][0].uuid, served[0][1].uuid):
+        bump_photo.match_bumped = True
+        write_back.update(bump_photo, ['match_bumped'], uuid__exists=True)
+    # The matches' deltas are predicted together.
+    result = [render_match(photo_a, match.a_win_delta, match.a_lose_delta,
+                           photo_b, match.b_win_delta, match.b_lose_delta,
+                           renders)
+              for (photo_a, photo_b), match
+              in zip(served, create_matches(served, user, write_back))]
+    write_back.commit()
+    if tournament is not None:
+        # TODO: Broken - g_l arg won't work for cross regional tournament
+        result.append(render_tournament(g_l, tournament))
+    return result
+
+def generate_matches(user, g_l, is_test=False,
+                     reset_tournament_status=False):
+    """Pick, make and render a batch of matches for the user to judge, from
+    the photos of g_l.
+
+    None if g_l has too few photos, an empty list if the user has judged
+    every pair tried. Not idempotent, see serve_matches.
+
+    """
+    picked = pick_matches(user, g_l, is_test=is_test)
+    if picked is None:
+        if reset_tournament_status:
+            log.info("resetting tournament status")
+            init_tournament_status(user)
+        return None
+    pairs, bump_photo = picked
+    return serve_matches(user, g_l, pairs, bump_photo,
+                         reset_tournament_status=reset_tournament_status)
+
 # Rest notes:
 # GET /users/me/matches
 # REST implies it is idempotent, so we'd need to include the index, like so
@@ -2365,148 +2513,35 @@ class MatchList(Resource):
         is_test = test_parser.parse_args().get('is_test', '') == 'True'
 
         args = matches_parser.parse_args()
-        if args['reset_tournament_status'] == 'True':
-            log.info("resetting tournament status")
-            init_tournament_status(user)
-
-        # Get (up to) next 200 photos so we can select from that 200 at random.
-        load_kwargs = {
-            'scan_index_forward': False,
-            'copy_complete__eq': True,
-            'consistent_read': False
-        }
-        if not is_test:
-            load_kwargs['is_test__ne'] = True
-
-        photos = set(
-            islice(model.Photo.post_date_index.query(
-                    g_l, **load_kwargs),
-                   200))
-        bad_photos = [p for p in photos if not p.copy_complete]
-        if bad_photos:
-            log.debug("copy_complete__eq not working, photos with copy_complete!=True in match-query results")
-        photos = [p for p in photos if p.copy_complete]
-        if len(photos) < 2:
-            log.info("not enough photos to make matches in %s", g_l)
-            response = jsonify(
-                {'message': 'Not enough photos in %s' % g_l})
-            response.status_code = 404
-            return response
-
-        # Special Case - If the user posts and views the same gender, then
-        # we get their just-posted picture into their next Match request.
-        match_bump_photo = None
-        # This is a hack requested by @mcgraw, that everybody posts as female.
-#        if user.view_gender_male == user.show_gender_male:
-        if True:
-            # Get this user's most recent photo.
-            user_photos = model.Photo.user_index.query(
-                    user.uuid,
-                    limit=4,
-                    scan_index_forward=False,
-                    copy_complete__eq=True)
-
-            user_photos = list(user_photos)
-            if any(p for p in user_photos if not p.copy_complete):
-                log.debug("copy_complete__eq not working, photos with copy_complete!=True in leaderboards-query results")
-            user_photos = [p for p in user_photos if p.copy_complete]
-            if user_photos:
-                photo = user_photos[0]
-                # If we have not already bumped this photo.
-                if not photo.match_bumped:
-                    if photo.copy_complete:
-                        match_bump_photo = photo
-
-        # Do not mix movie and photo in same match.
-        pic_photos = []
-        movie_photos = []
-        for p in photos:
-            if p.media_type == 'movie':
-                movie_photos.append(p)
-            else:
-                pic_photos.append(p)
-
-        first_pair = []
-        if match_bump_photo:
-            pop_index = None
-            for i, photo in enumerate(photos):
-                if match_bump_photo.uuid == photo.uuid:
-                    pop_index = i
-                    break
-            if pop_index is not None:
-                photos.pop(pop_index)
-            if match_bump_photo.media_type == 'movie':
-                rando_index = randrange(len(movie_photos))
-                rando = movie_photos[rando_index]
-                movie_photos.pop(rando_index)
-            else:
-                rando_index = randrange(len(pic_photos))
-                rando = pic_photos[rando_index]
-                pic_photos.pop(rando_index)
-            first_pair.append((match_bump_photo, rando))
-            match_bump_photo.match_bumped = True
-            match_bump_photo.save()
-            # Remove the randomly selected photo.
-            for i, photo in enumerate(photos):
-                if rando.uuid == photo.uuid:
-                    pop_index = i
-                    break
-            photos.pop(pop_index)
-
-        # We need to balance the incidence of movie and pic, to do so, we'll
-        # track incidence in photos.
-
-        def switched_iter(photos, movie_photos, pic_photos):
-            movie_iter = random_by_twos(movie_photos)
-            pic_iter = random_by_twos(pic_photos)
-            for photo in photos:
-                if photo.media_type == 'movie':
-                    yield movie_iter.next()
-                else:
-                    yield pic_iter.next()
-
-        matches = chain(first_pair,
-                        switched_iter(photos, movie_photos, pic_photos))
-        result = []
-        remaining = 10
-
-        while remaining != 0:
-            if tournament_is_next(user):
-                tournament = get_next_tournament(user)
-                # TODO: Broken - g_l arg won't work for cross regional tournament
-                result.append(render_tournament(g_l, tournament))
-                break  # Tournament loading is slow, so stop here.
-            else:
-                try:
-                    match = matches.next()
-                except StopIteration:
-                    break
-
-                photo_a = match[0]
-                photo_b = match[1]
-                # Do not allow a user to compete against themselves.
-                if photo_a.user_uuid == photo_b.user_uuid:
-                    continue
-                # Very important!  Match.photo_a.uuid < Match.photo_b.uuid
-                if photo_a.uuid.hex > photo_b.uuid.hex:
-                    photo_a, photo_b = photo_b, photo_a
-
-                # See if user has already made a match before suggesting it.
-                try:
-                    db_match = model.Match.get((photo_a.uuid, photo_b.uuid),
-                                               user.uuid)
-                except DoesNotExist:
-                    pass
-                else:
-                    continue
-                # Increment the tournament counter for this user.
-                tournament_status_log_match(user)
-                match = create_match(photo_a, photo_b, user)
-                result.append(render_match(photo_a, match.a_win_delta,
-                                           match.a_lose_delta, photo_b,
-                                           match.b_win_delta,
-                                           match.b_lose_delta))
-                remaining -= 1
+        reset_tournament_status = args['reset_tournament_status'] == 'True'
+
+        # The worker makes the next batches ahead of time, see
+        # logic/match_queue.py, here they are made only if it hasn't yet.
+        use_queue = settings.MATCH_QUEUE_ENABLED and \
+            not (is_test or reset_tournament_status)
+        result = None
+        if use_queue:
+            batch = match_queue.pop(user.uuid, g_l)
+            if batch is not None:
+                pairs, renders, bump_photo = batch
+                # The user may have judged some since they were picked.
+                judged_filter = judged.get_filter(user.uuid)
+                pairs = [(photo_a, photo_b) for photo_a, photo_b in pairs
+                         if not judged_filter.has_judged(photo_a.uuid,
+                                                         photo_b.uuid)]
+                result = serve_matches(user, g_l, pairs, bump_photo,
+                                       renders=renders) or None
+        if result is None:
+            result = generate_matches(
+                user, g_l, is_test=is_test,
+                reset_tournament_status=reset_tournament_status)
+            if result is None:
+                response = jsonify(
+                    {'message': 'Not enough photos in %s' % g_l})
+                response.status_code = 404
+                return response
+        if use_queue:
+            prefetch_matches(user.uuid)
         if len(result) == 0:
             msg = "not enough unique matches in %s for this user" % g_l
             log.info(msg)
@@ -2538,11 +2573,15 @@ class TagMatchList(Resource):
         if 'application/json' != request.headers.get('Content-Type'):
             abort(415)
 
+        # The user's tournament status, the bumped photo and the Matches
+        # are written together once the matches are picked.
+        write_back = model.WriteBack()
+        lock_tournament_status(user, write_back)
         args = matches_parser.parse_args()
 
         if args['reset_tournament_status'] == 'True':
             log.info("resetting tournament status")
-            init_tournament_status(user)
+            init_tournament_status(user, write_back)
 
         # Get (up to) next 200 photos so we can select from that 200 at random.
         photo_gender_tags = set(
@@ -2560,6 +2599,7 @@ class TagMatchList(Resource):
 
         if len(photos) < 2:
             log.info("not enough photos to make matches in %s", gender_tag)
+            write_back.commit()
             response = jsonify(
                 {'message': 'Not enough photos in {} {}'.format(gender, tag)})
             response.status_code = 404
@@ -2590,24 +2630,20 @@ class TagMatchList(Resource):
                     if photo.copy_complete:
                         match_bump_photo = photo
 
+        matchmakers = get_matchmakers(photos)
         first_pair = []
         if match_bump_photo:
-            pop_index = None
-            for i, photo in enumerate(photos):
-                if match_bump_photo.uuid == photo.uuid:
-                    pop_index = i
-                    break
-            if pop_index is not None:
-                photos.pop(pop_index)
-            rando_index = randrange(len(photos))
-            rando = photos[rando_index]
-            photos.pop(rando_index)
-            first_pair.append((match_bump_photo, rando))
-            match_bump_photo.match_bumped = True
-            match_bump_photo.save()
-
-        matches = chain(first_pair, random_by_twos(photos))
-        result = []
+            rando = matchmakers[get_media_type(
+                match_bump_photo)].pick_opponent(match_bump_photo)
+            if rando is not None:
+                first_pair.append((match_bump_photo, rando))
+                match_bump_photo.match_bumped = True
+                write_back.update(match_bump_photo, ['match_bumped'],
+                                  uuid__exists=True)
+
+        matches = chain(first_pair, get_pairs(matchmakers, len(photos)))
+        judged_filter = judged.get_filter(user.uuid)
+        pairs = []
         remaining = 10
 
         while remaining != 0:
@@ -2632,24 +2668,25 @@ class TagMatchList(Resource):
                 if photo_a.uuid.hex > photo_b.uuid.hex:
                     photo_a, photo_b = photo_b, photo_a
 
+                # Matches are saved once the loop is done, so check this
+                # request's pairs as well as the table.
+                if any(a.uuid == photo_a.uuid and b.uuid == photo_b.uuid
+                       for a, b in pairs):
+                    continue
                 # TODO: Double-check, I think we already test this in the
                 # iterator.
                 # See if user has already made a match before suggesting it.
-                try:
-                    db_match = model.Match.get((photo_a.uuid, photo_b.uuid),
-                                               user.uuid)
-                except DoesNotExist:
-                    pass
-                else:
+                if judged_filter.has_judged(photo_a.uuid, photo_b.uuid):
                     continue
                 # Increment the tournament counter for this user.
-                tournament_status_log_match(user)
-                match = create_match(photo_a, photo_b, user)
-                result.append(render_match(photo_a, match.a_win_delta,
-                                           match.a_lose_delta, photo_b,
-                                           match.b_win_delta,
-                                           match.b_lose_delta))
+                tournament_status_log_match(user, write_back)
+                pairs.append((photo_a, photo_b))
                 remaining -= 1
+        result = [render_match(photo_a, match.a_win_delta, match.a_lose_delta,
+                               photo_b, match.b_win_delta, match.b_lose_delta)
+                  for (photo_a, photo_b), match
+                  in zip(pairs, create_matches(pairs, user, write_back))]
+        write_back.commit()
         if len(result) == 0:
             msg = "not enough unique matches in %s for this user" % tag
             log.info(msg)
@@ -2701,10 +2738,10 @@ class Match(Resource):
             match.a_won = False
             win_photo_uuid = photo_b_uuid
             lose_photo_uuid = photo_a_uuid
-        log_match_for_scoring(match)
         match.judged = True
         match.judged_date = now()
         match.scored_date = now()
+        log_match_for_scoring(match)
         match.save()
         winner_uuid = get_photo(win_photo_uuid).user_uuid
         win = model.Win(winner_uuid,
@@ -2740,18 +2777,12 @@ class Match(Resource):
             response.status_code = 404
             return response
 
-        load_kwargs = {
-            'scan_index_forward': False,
-            'copy_complete__eq': True,
-            'consistent_read': False
-        }
-        if not is_test:
-            load_kwargs['is_test__ne'] = True
-        photos = set(islice(
-                model.Photo.post_date_index.query(
-                    photo.gender_location, **load_kwargs),
-                200))
+        photos = candidates.get_pool(
+            model.get_base_gender_location(photo.gender_location),
+            include_test=is_test).get_all()
+        shuffle(photos)
 
+        judged_filter = judged.get_filter(user.uuid)
         found_photo = False
         for p in photos:
             # No same-on-same matches.
@@ -2768,24 +2799,13 @@ class Match(Resource):
 
             # See if user has already made a match before
             # suggesting it.
-            try:
-                db_match = model.Match.get(
-                    (photo_a.uuid, photo_b.uuid),
-                    user.uuid, consistent_read=False)
-            except DoesNotExist:
+            if not judged_filter.has_judged(photo_a.uuid, photo_b.uuid):
                 found_photo = True
                 break
-            else:
-                continue
 
         if not found_photo:
-            # Retry, without dupe-check.
-            photos = list(model.Photo.post_date_index.query(
-                        photo.gender_location,
-                        scan_index_forward=False,
-                        limit=11,
-                        copy_complete__eq=True,
-                        consistent_read=False))
+            # Retry, without dupe-check, with the newest.
+            photos = sorted(photos, key=model.newest_first)[:11]
             shuffle(photos)
             for p in photos:
                 if p.uuid == photo_uuid:
@@ -2892,31 +2912,73 @@ top_leaderboards_female = [
     ('Seattle, WA', '67f26f23ecf311e493c3c8e0eb16059b')
 ]
 
+def render_top_leaderboards(gender, leaderboards, **filters):
+    """Render the top 50 photos of each of leaderboards, (name, location
+    uuid hex) pairs. filters go to each query."""
+    result = []
+    for name, location_uuid_hex in leaderboards:
+        gender_location = '%s%s' % (gender, location_uuid_hex)
+        top = list(islice(model.query_gender_location(
+            model.Photo.score_index, gender_location, model.highest_first,
+            limit=50, scan_index_forward=False, consistent_read=False,
+            copy_complete__eq=True, **filters), 50))
+        if any(p for p in top if not p.copy_complete):
+            log.debug("copy_complete__eq not working, photos with copy_complete!=True in leaderboards/%s-query results" % gender)
+        top = [p for p in top if p.copy_complete]
+        result.append({
+            'name': name,
+            'gender_location': gender_location,
+            'photos': [render_photo(p) for p in top]
+        })
+    return result
+
+def refresh_top_leaderboards(gender_locations=None):
+    """Render GET /leaderboards/m and /f into logic.overview, for the
+    worker. With gender_locations, only the leaderboards of those are
+    rendered again, for the scorer."""
+    for gender, leaderboards, filters in (
+            ('m', top_leaderboards_male, {}),
+            ('f', top_leaderboards_female, {'is_test__ne': True})):
+        if gender_locations is None:
+            overview.save(gender, render_top_leaderboards(
+                gender, leaderboards, **filters))
+            continue
+        positions = [(position, leaderboard)
+                     for position, leaderboard in enumerate(leaderboards)
+                     if gender + leaderboard[1] in gender_locations]
+        if positions:
+            rendered = render_top_leaderboards(
+                gender, [leaderboard for position, leaderboard in positions],
+                **filters)
+            overview.update(gender, dict(
+                (position, leaderboard) for (position, x), leaderboard
+                in zip(positions, rendered)))
+
+def get_top_leaderboards(gender, leaderboards, **filters):
+    """The rendered leaderboards, rendered here if the worker hasn't yet."""
+    result = overview.get(gender)
+    if result is None:
+        log.info("no leaderboard overview for %s, rendering it" % gender)
+        result = {
+            'leaderboards': render_top_leaderboards(gender, leaderboards,
+                                                    **filters),
+            'version': None
+        }
+    return result
+
 @ns_match.route('/leaderboards/m')
 class LeaderBoardsMale(Resource):
     @timingIncrDecorator('GET /leaderboards/m')
 #    @marshal_with(leaderboard_list_model)
     @api.doc(description="autodocs are wrong, 'photos' is not optional")
     def get(self):
-        """Get the name and location id of all leaderboards."""
-        result = []
-        for name, location_uuid_hex in top_leaderboards_male:
-            gender_location = 'm%s' % (location_uuid_hex)
-
-            top = list(model.Photo.score_index.query(gender_location,
-                                                     limit=50,
-                                                     scan_index_forward=False,
-                                                     consistent_read=False,
-                                                     copy_complete__eq=True))
-            if any(p for p in top if not p.copy_complete):
-                log.debug("copy_complete__eq not working, photos with copy_complete!=True in leaderboards/m-query results")
-            top = [p for p in top if p.copy_complete]
-            result.append({
-                'name': name,
-                'gender_location': gender_location,
-                'photos': [render_photo(p) for p in top]
-            })
-        return {'leaderboards': result}
+        """Get the name and location id of all leaderboards.
+
+        Rendered ahead of time by the worker and the scorer, 'version' is
+        when.
+
+        """
+        return get_top_leaderboards('m', top_leaderboards_male)
 
 @ns_match.route('/leaderboards/f')
 class LeaderBoardsFemale(Resource):
@@ -2924,30 +2986,31 @@ class LeaderBoardsFemale(Resource):
 #    @marshal_with(leaderboard_list_model)
     @api.doc(description="autodocs are wrong, 'photos' is not optional")
     def get(self):
-        """Get the name and location id of all show_female top leaderboards."""
-        result = []
+        """Get the name and location id of all show_female top leaderboards.
+
+        Rendered ahead of time by the worker and the scorer, 'version' is
+        when. With is_test the leaderboards, test photos and all, are
+        rendered now.
+
+        """
         is_test = test_parser.parse_args().get('is_test', '') == 'True'
-        for name, location_uuid_hex in top_leaderboards_female:
-            gender_location = 'f%s' % (location_uuid_hex)
-            load_kwargs = {
-                'copy_complete__eq': True,
-                'limit': 50,
-                'scan_index_forward': False,
-                'consistent_read': False
+        if is_test:
+            return {
+                'leaderboards': render_top_leaderboards(
+                    'f', top_leaderboards_female),
+                'version': None
             }
-            if not is_test:
-                load_kwargs['is_test__ne'] = True
-            top = list(model.Photo.score_index.query(gender_location,
-                                                     **load_kwargs))
-            if any(p for p in top if not p.copy_complete):
-                log.debug("copy_complete__eq not working, photos with copy_complete!=True in leaderboards/f-query results")
-            top = [p for p in top if p.copy_complete]
-            result.append({
-                'name': name,
-                'gender_location': gender_location,
-                'photos': [render_photo(p) for p in top]
-            })
-        return {'leaderboards': result}
+        return get_top_leaderboards('f', top_leaderboards_female,
+                                    is_test__ne=True)
+
+# The `when` of GET /leaderboards/<gender_location>, to its Leaderboard window.
+LEADERBOARD_WINDOWS = {
+    'thishour': 'hour',
+    'today': 'today',
+    'thisweek': 'week',
+    'thismonth': 'month',
+    'thisyear': 'year'
+}
 
 leaderboard_parser = reqparse.RequestParser()
 leaderboard_parser.add_argument('when',
@@ -3008,48 +3071,166 @@ when can be alltime, thishour, today, thisweek, thismonth, thisyear""")
                         for item in i:
                             yield item
 
-        model_class = {
-            'alltime': model.Photo,
-            'thishour': model.HourLeaderboard,
-            'today': model.TodayLeaderboard,
-            'thisweek': model.WeekLeaderboard,
-            'thismonth': model.MonthLeaderboard,
-            'thisyear': model.YearLeaderboard
-        }[kind]
-
-        if 'all' == gender_location:
-            index_name = 'all_score_index'
-        else:
-            index_name = 'score_index'
+        photo_uuids = None
+        if 'alltime' != kind and not settings.LEADERBOARD_LEGACY_TABLES:
+            # This process' copy of the board, None while it is cold.
+            photo_uuids = ranking.get_page(LEADERBOARD_WINDOWS[kind],
+                                           gender_location,
+                                           exclusive_start_key, count)
+        if photo_uuids is None:
+            if 'alltime' == kind or settings.LEADERBOARD_LEGACY_TABLES:
+                model_class = {
+                    'alltime': model.Photo,
+                    'thishour': model.HourLeaderboard,
+                    'today': model.TodayLeaderboard,
+                    'thisweek': model.WeekLeaderboard,
+                    'thismonth': model.MonthLeaderboard,
+                    'thisyear': model.YearLeaderboard
+                }[kind]
+
+                if 'all' == gender_location:
+                    index_name = 'all_score_index'
+                else:
+                    index_name = 'score_index'
+
+                # Note that Photo needs to check copy_complete, but the
+                # Leaderboard copies don't because they don't get created until
+                # after the copy is complete. The Leaderboard copies do not have
+                # a copy_complete attribute.
+                kwargs = {}
+                if 'alltime' == kind:
+                    kwargs['copy_complete__eq'] = True
+                    if not is_test:
+                        kwargs['is_test__ne'] = True
+
+                if 'alltime' == kind and 'all' == gender_location:
+                    # Merged from the index's shards, and started past
+                    # exclusive_start_key already.
+                    try:
+                        after = uuid.UUID(exclusive_start_key) \
+                            if exclusive_start_key else None
+                    except ValueError:
+                        top = iter(())
+                    else:
+                        top = leaderboard.get_all_time_top(after=after,
+                                                           **kwargs)
+                    exclusive_start_key = ''
+                else:
+                    top = model.query_gender_location(
+                        getattr(model_class, index_name), gender_location,
+                        model.highest_first, scan_index_forward=False,
+                        consistent_read=False, **kwargs)
 
-        query = getattr(model_class, index_name).query
+                if 'alltime' == kind:
+                    top = query_filter_check(top, "GET /leaderboards")
+                else:
+                    # TTL deletes expired rows eventually, not right away.
+                    current_seconds = model.get_ttl_seconds(now())
+                    top = (x for x in top
+                           if not model.is_leaderboard_expired(x,
+                                                               current_seconds))
+            else:
+                top = leaderboard.get_top(LEADERBOARD_WINDOWS[kind],
+                                          gender_location)
 
-        # Note that Photo needs to check copy_complete, but the Leaderboard
-        # copies don't because they don't get created until after the copy
-        # is complete. The Leaderboard copies do not have a copy_complete
-        # attribute.
-        kwargs = {
-            'scan_index_forward': False,
-            'consistent_read': False
+            top = count_iter(exclusive_start_key_check(top), count)
+            if kind != 'alltime':
+                photo_uuids = (p.uuid for p in top)
+
+        if photo_uuids is not None:
+            top = (x for x in (get_photo(photo_uuid)
+                               for photo_uuid in photo_uuids)
+                   if x is not None)
+            top = (x for x in top if not x.is_test or is_test)
+        return {
+            'photos': [render_photo(p) for p in top]
         }
-        if 'alltime' == kind:
-            kwargs['copy_complete__eq'] = True
-            if not is_test:
-                kwargs['is_test__ne'] = True
 
-        top = query(gender_location, **kwargs)
+photo_rank_parser = reqparse.RequestParser()
+photo_rank_parser.add_argument('when',
+                               type=str,
+                               help="'thishour', 'today', 'thisweek', 'thismonth', 'thisyear'",
+                               required=False,
+                               location='values',
+                               default='thisweek')
+photo_rank_parser.add_argument('gender_location',
+                               type=str,
+                               help="the photo's gender_location (the default) or 'all'",
+                               required=False,
+                               location='values',
+                               default='')
+@ns_photo.route('/photos/<string:photo_id>/rank')
+@api.doc(params={'photo_id': 'uuid (hex) of photo to rank'})
+class PhotoRank(Resource):
+    @timingIncrDecorator('GET /photos/<photo_id>/rank')
+    @api.doc(description="""Where a photo stands on a leaderboard.
+    /photos/<photo_id>/rank?when=today&gender_location=all
 
-        if 'alltime' == kind:
-            top = query_filter_check(top, "GET /leaderboards")
+default params are
+when=thisweek
+gender_location='' (the photo's own)
+
+Returns
+{
+'when': the window,
+'gender_location': the leaderboard's gender_location,
+'rank': 1 for the top, null if the photo isn't on the leaderboard,
+'count': photos on the leaderboard,
+'percentile': percent of the leaderboard the photo is at or above,
+'exact': false if rank is an estimate
+}""")
+    def get(self, photo_id):
+        """Get a photo's rank on a leaderboard, and its percentile.
 
-        top = count_iter(exclusive_start_key_check(top), count)
+        Auth header required.
 
-        if kind != 'alltime':
-            top = (x for x in (get_photo(p.uuid) for p in top) if x is not None)
-            top = (x for x in top if not x.is_test or is_test)
-        return {
-            'photos': [render_photo(p) for p in top]
+        """
+        photo_uuid = uuid_schema(photo_id)
+        current_api_user()
+        args = photo_rank_parser.parse_args()
+        kind = args['when']
+        if kind not in LEADERBOARD_WINDOWS:
+            raise InvalidAPIUsage("unrecognized filter '{filter}'".format(
+                    filter=kind
+            ))
+        photo = get_photo(photo_uuid)
+        if photo is None:
+            msg = 'Could not find photo with uuid %s' % photo_uuid.hex
+            response = jsonify({'message': msg})
+            response.status_code = 404
+            return response
+        if photo.is_profile_only():
+            raise InvalidAPIUsage("profile only photos are not on leaderboards")
+        photo_gender_location = model.get_base_gender_location(
+            photo.gender_location)
+        gender_location = args['gender_location'] or photo_gender_location
+        if gender_location not in (photo_gender_location, leaderboard.ALL):
+            raise InvalidAPIUsage(
+                "photo is not on leaderboard '{}'".format(gender_location))
+        window = LEADERBOARD_WINDOWS[kind]
+        result = {
+            'when': kind,
+            'gender_location': gender_location,
+            'rank': None,
+            'count': None,
+            'percentile': None,
+            'exact': True
         }
+        if photo.post_date is None or not photo.get_is_rated() or \
+           photo.post_date + dict(leaderboard.WINDOWS)[window] <= now():
+            return result
+        # This process' copy of the board, or one query of its histogram.
+        position = ranking.get_rank(window, gender_location, photo_uuid)
+        if position is None:
+            position = leaderboard.get_histogram_rank(window, gender_location,
+                                                      photo.score)
+            result['exact'] = False
+        rank, count = position
+        result['count'] = count
+        if rank is not None:
+            result['rank'] = rank + 1
+            result['percentile'] = 100.0 * (count - rank) / count
+        return result
 
 wins_parser = reqparse.RequestParser()
 wins_parser.add_argument('exclusive_start_key',
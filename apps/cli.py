@@ -2287,3 +2287,250 @@ def setup_tags():
     """Call add_tags on the fixed tags."""
     from logic.tags import TOP_TAGS_FEMALE
     add_tags(TOP_TAGS_FEMALE)
+
+def drop_leaderboard_uuid_indexes(dry_run=True):
+    """Drop the five leaderboard *ByUUID GSIs, see docs/Leaderboards.rst.
+
+    Only run this once the deployed code no longer queries a leaderboard
+    uuid_index, and remove the uuid_index attributes from the model with it.
+    With dry_run, print what would be dropped.
+
+    """
+    import model
+    for cls in [model.HourLeaderboard, model.TodayLeaderboard,
+                model.WeekLeaderboard, model.MonthLeaderboard,
+                model.YearLeaderboard]:
+        table_name = cls.Meta.table_name
+        # PynamoDB names an index after its model attribute.
+        index_name = 'uuid_index'
+        client = cls._get_connection().connection.client
+        info = client.describe_table(TableName=table_name)['Table']
+        index_names = [i['IndexName']
+                       for i in info.get('GlobalSecondaryIndexes', [])]
+        if index_name not in index_names:
+            print('{} has no {}'.format(table_name, index_name))
+            continue
+        if dry_run:
+            print('would drop {} from {}'.format(index_name, table_name))
+            continue
+        print('dropping {} from {}'.format(index_name, table_name))
+        client.update_table(
+            TableName=table_name,
+            GlobalSecondaryIndexUpdates=[{'Delete': {'IndexName': index_name}}])
+
+def create_match_user_index(dry_run=True):
+    """Add Match.user_index to the match table, see docs/Matchmaking.rst.
+
+    With dry_run, print what would be created.
+
+    """
+    import model
+    table_name = model.Match.Meta.table_name
+    index = model.Match.user_index
+    client = model.Match._get_connection().connection.client
+    info = client.describe_table(TableName=table_name)['Table']
+    index_names = [i['IndexName']
+                   for i in info.get('GlobalSecondaryIndexes', [])]
+    if index.Meta.index_name in index_names:
+        print('{} has {}'.format(table_name, index.Meta.index_name))
+        return
+    if dry_run:
+        print('would create {} on {}'.format(index.Meta.index_name,
+                                             table_name))
+        return
+    print('creating {} on {}'.format(index.Meta.index_name, table_name))
+    client.update_table(
+        TableName=table_name,
+        AttributeDefinitions=[
+            {'AttributeName': 'user_uuid', 'AttributeType': 'B'},
+            {'AttributeName': 'proposed_date', 'AttributeType': 'S'}],
+        GlobalSecondaryIndexUpdates=[{'Create': {
+            'IndexName': index.Meta.index_name,
+            'KeySchema': [
+                {'AttributeName': 'user_uuid', 'KeyType': 'HASH'},
+                {'AttributeName': 'proposed_date', 'KeyType': 'RANGE'}],
+            'Projection': {'ProjectionType': 'KEYS_ONLY'},
+            'ProvisionedThroughput': {
+                'ReadCapacityUnits': index.Meta.read_capacity_units,
+                'WriteCapacityUnits': index.Meta.write_capacity_units}}}])
+
+def enable_leaderboard_ttl():
+    """Have DynamoDB delete expired leaderboard rows, see docs/Leaderboards.rst.
+
+    Run sweep_leaderboards once after, so rows written before leaderboards
+    had expires get it.
+
+    """
+    import model
+    if model.enable_leaderboard_ttl():
+        print('TTL enabled on the leaderboards')
+    else:
+        print('TTL not enabled on every leaderboard, see the log')
+
+def sweep_leaderboards():
+    """Delete expired leaderboard rows, for DynamoDB stand-ins without TTL."""
+    from logic import leaderboard
+    print('wrote {} items'.format(leaderboard.sweep()))
+
+def backfill_leaderboard():
+    """Copy the per-window leaderboard tables into Leaderboard.
+
+    See docs/Leaderboards.rst, run it while the scorer writes both.
+
+    """
+    from logic import leaderboard
+    print('wrote {} items'.format(leaderboard.backfill()))
+
+def reshard_all_leaderboards():
+    """Move Photos and all board rows from before the shards onto them.
+
+    See docs/Leaderboards.rst, run rebuild_score_histograms after.
+
+    """
+    from logic import leaderboard
+    print('wrote {} items'.format(leaderboard.reshard_all()))
+
+def rebuild_score_histograms():
+    """Count the Leaderboard table into the ScoreHistogram table again.
+
+    See docs/Leaderboards.rst, run it after backfill_leaderboard.
+
+    """
+    from logic import leaderboard
+    print('wrote {} items'.format(leaderboard.rebuild_histograms()))
+
+def refresh_top_leaderboards():
+    """Render GET /leaderboards/m and /f now, as the worker's cron does.
+
+    For a new table, before the cron first runs.
+
+    """
+    from apps.api.api import refresh_top_leaderboards
+    refresh_top_leaderboards()
+
+def replay_ratings(dry_run=True, period_minutes=5, processes=None):
+    """Recompute every photo's rating from the judged Matches.
+
+    Prints what would change, see logic/replay.py. With dry_run=False the
+    new ratings are written to Photo, PhotoGenderTag and the leaderboards.
+
+    """
+    from datetime import timedelta
+    from logic.replay import replay
+    plan = replay(period=timedelta(minutes=period_minutes),
+                  processes=processes)
+    print(plan.report())
+    if dry_run:
+        return plan
+    print('wrote {} items'.format(plan.write()))
+    return plan
+
+def benchmark_glicko2(player_count=300, game_count=2000, repeat=10):
+    """Time one rating period through each Glicko2 path.
+
+    The original rate(), a Rating object per opponent and per step, is kept
+    here as the baseline the others are reported against. Then rate() as it
+    is now, rate_tuple() sharing prepared opponents, and rate_batch(), all
+    over the same random games.
+
+    """
+    import math
+    import random
+    from time import time
+    from logic.glicko2 import Glicko2, LOSS, Q, WIN
+    from logic.score import TAU
+    env = Glicko2(tau=TAU)
+    ratings = [(random.uniform(1200, 1800), random.uniform(30, 350),
+                random.uniform(0.004, 0.09)) for x in xrange(player_count)]
+    series = {}
+    players, opponents, outcomes = [], [], []
+    for x in xrange(game_count):
+        winner, loser = random.sample(xrange(player_count), 2)
+        series.setdefault(winner, []).append((WIN, ratings[loser]))
+        series.setdefault(loser, []).append((LOSS, ratings[winner]))
+        players.extend((winner, loser))
+        opponents.extend((loser, winner))
+        outcomes.extend((WIN, LOSS))
+
+    # Glicko2.determine_sigma and Glicko2.rate as they were before
+    # rate_tuple and rate_batch.
+    def original_determine_sigma(rating, difference, variance):
+        phi = rating.phi
+        difference_squared = difference ** 2
+        alpha = math.log(rating.sigma ** 2)
+        def f(x):
+            tmp = phi ** 2 + variance + math.exp(x)
+            a = math.exp(x) * (difference_squared - tmp) / (2 * tmp ** 2)
+            b = (x - alpha) / (env.tau ** 2)
+            return a - b
+        a = alpha
+        if difference_squared > phi ** 2 + variance:
+            b = math.log(difference_squared - phi ** 2 - variance)
+        else:
+            k = 1
+            while f(alpha - k * math.sqrt(env.tau ** 2)) < 0:
+                k += 1
+            b = alpha - k * math.sqrt(env.tau ** 2)
+        f_a, f_b = f(a), f(b)
+        while abs(b - a) > env.epsilon:
+            c = a + (a - b) * f_a / (f_b - f_a)
+            f_c = f(c)
+            if f_c * f_b < 0:
+                a, f_a = b, f_b
+            else:
+                f_a /= 2
+            b, f_b = c, f_c
+        return math.exp(1) ** (a / 2)
+    def original_rate(rating, series):
+        rating = env.scale_down(rating)
+        d_square_inv = 0
+        variance_inv = 0
+        difference = 0
+        for actual_score, other_rating in series:
+            other_rating = env.scale_down(other_rating)
+            impact = env.reduce_impact(other_rating)
+            expected_score = env.expect_score(rating, other_rating, impact)
+            variance_inv += impact ** 2 * expected_score * (1 - expected_score)
+            difference += impact * (actual_score - expected_score)
+            d_square_inv += (
+                expected_score * (1 - expected_score) *
+                (Q ** 2) * (impact ** 2))
+        difference /= variance_inv
+        variance = 1. / variance_inv
+        denom = rating.phi ** -2 + d_square_inv
+        mu = rating.mu + Q / denom * (difference / variance_inv)
+        phi = math.sqrt(1 / denom)
+        sigma = original_determine_sigma(rating, difference, variance)
+        phi_star = math.sqrt(phi ** 2 + sigma ** 2)
+        phi = 1 / math.sqrt(1 / phi_star ** 2 + 1 / variance)
+        mu = rating.mu + phi ** 2 * (difference / variance)
+        return env.scale_up(env.create_rating(mu, phi, sigma))
+
+    def rate_original():
+        for player, games in series.iteritems():
+            original_rate(env.create_rating(*ratings[player]),
+                          [(outcome, env.create_rating(*rating))
+                           for outcome, rating in games])
+    def rate_objects():
+        for player, games in series.iteritems():
+            env.rate(env.create_rating(*ratings[player]),
+                     [(outcome, env.create_rating(*rating))
+                      for outcome, rating in games])
+    def rate_tuples():
+        prepared = {}
+        for player, games in series.iteritems():
+            env.rate_tuple(ratings[player], games, prepared)
+    def rate_batch():
+        env.rate_batch(*(zip(*ratings) + [players, opponents, outcomes]))
+
+    baseline = None
+    for name, f in [('original', rate_original), ('rate', rate_objects),
+                    ('rate_tuple', rate_tuples), ('rate_batch', rate_batch)]:
+        start = time()
+        for x in xrange(repeat):
+            f()
+        duration = (time() - start) / repeat
+        if baseline is None:
+            baseline = duration
+        print('{:<12} {:.3f} ms per {} game period, {:.1f}x original'.format(
+            name, duration * 1000, game_count, baseline / duration))
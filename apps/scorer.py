@@ -0,0 +1,76 @@
+from __future__ import division, absolute_import, unicode_literals
+
+
+# -- Hacks --------------------------------------------------------------------
+
+# Note: Here we remove bogus 'key' info from the environment because
+# on EC2 we have blanks in there and it reads them and then barfs. (It
+# will otherwise get the info from another config system, IF the env is
+# empty of these.) HOWEVER when we run in local dev, we need these.
+# See apps/worker.py
+import os
+if os.environ.get('IS_LOCAL_DEV') == '0':
+    try:
+        del os.environ['AWS_SECRET_KEY']
+    except KeyError:
+        pass
+    try:
+        del os.environ['AWS_ACCESS_KEY_ID']
+    except KeyError:
+        pass
+
+# -- Imports ------------------------------------------------------------------
+
+import signal
+import sys
+from time import sleep
+
+from log import log
+from logic.lease import get_owner, LEASE_DURATION
+from logic.overview import Refresher
+from logic.score import stream_scores
+from logic.stats import incr
+from settings import settings
+
+# Streaming scorer. Run one or more on the Worker instances:
+#
+#     $ python -m apps.scorer
+#
+# Only the one holding the score lease reads the stream, the others wait to
+# take over if it dies. While a scorer holds the lease the cron
+# /worker_score_callback does nothing.
+
+# Seconds to wait after an unexpected error before scoring again.
+ERROR_WAIT = 5.0
+
+
+def refresh_top_leaderboards(gender_locations):
+    # The photos are rendered as the Api renders them.
+    from apps.api.api import refresh_top_leaderboards
+    refresh_top_leaderboards(gender_locations)
+
+def handle_sigterm(signum, frame):
+    # Unwind through stream_scores so the lease is released on the way out.
+    sys.exit(0)
+
+def main():
+    log.info("Starting LocalPicTourney Scorer")
+    if not settings.IS_WORKER:
+        log.warn("Running Scorer with settings.IS_WORKER=False")
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    owner = get_owner()
+    # The top leaderboards of the cities scored, every 30 seconds or so.
+    refresher = Refresher(refresh_top_leaderboards)
+    while True:
+        try:
+            if not stream_scores(owner, on_scored=refresher.touch):
+                sleep(LEASE_DURATION.total_seconds() / 3)
+        except Exception as e:
+            log.error("Scorer {} had exception {}".format(owner, e))
+            log.exception(e)
+            incr('Scorer.{name}-incr'.format(name=type(e).__name__))
+            sleep(ERROR_WAIT)
+
+
+if __name__ == '__main__':
+    main()
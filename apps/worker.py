@@ -38,8 +38,6 @@ from logic.awards import leaderboard_awards
 from logic.facebook import get_facebook_data
 from logic.feed import feed_new_photo
 from logic.photo import crop, file_hash, get_photo, preserve
-from logic.score import trim_hour_leaderboards, trim_today_leaderboards, \
-    trim_week_leaderboards, trim_month_leaderboards, trim_year_leaderboards
 from logic.sentry import sentryDecorator
 from logic.sns import push_new_photo
 from logic.stats import incr, timingIncrDecorator
@@ -121,6 +119,9 @@ def worker_callback():
         elif data.get('t') == 'facebook_registration':
             log.debug('Worker calling handle_facebook_registration')
             return handle_facebook_registration(data)
+        elif data.get('t') == 'prefetch_matches':
+            log.debug('Worker calling handle_prefetch_matches')
+            return handle_prefetch_matches(data)
         # s3 sent this when I subscribed an event (?)
         # { u'HostId': u'2kCAZHZNV+eo0TKycXNXtyx96ucGY/3q3iUozK0l1uOerowugZ2iiSYJkFp6bPjN',
         #   u'Service': u'Amazon S3',
@@ -340,13 +341,44 @@ def handle_facebook_registration(payload):
 
     return ''
 
+@timingIncrDecorator('worker_handle_prefetch_matches', track_status=False)
+def handle_prefetch_matches(payload):
+    # The pairs are picked as the Api picks them and their photos rendered,
+    # the Matches are made when the Api serves them.
+    from apps.api.api import pick_matches, render_photo
+    from logic import match_queue
+    user_uuid = uuid.UUID(payload['user_uuid'])
+    try:
+        # Read consistently, the user may have just changed what they view.
+        user = model.User.get(user_uuid, consistent_read=True)
+    except DoesNotExist:
+        log.warn("prefetch_matches for missing user %s" % user_uuid.hex)
+        return ''
+    g_l = user.get_view_gender_location()
+
+    def pick(excluded, bumped):
+        picked = pick_matches(user, g_l, excluded=excluded, bumped=bumped)
+        if picked is None:
+            return None
+        pairs, bump_photo = picked
+        renders = dict((photo.uuid, render_photo(photo))
+                       for pair in pairs for photo in pair)
+        return pairs, renders, bump_photo
+
+    match_queue.fill(user.uuid, g_l, pick)
+    return ''
+
+
 @application.route('/worker_score_callback', methods=['POST'])
 @sentryDecorator()
 @timingIncrDecorator('worker_score_callback', track_status=False)
 def score_callback():
+    # Fallback for apps/scorer.py, do_scores does nothing while it runs.
     log.info("Worker processing message for score_callback")
+    from apps.api.api import refresh_top_leaderboards
+    from logic.overview import Refresher
     from logic.score import do_scores
-    do_scores()
+    do_scores(on_scored=Refresher(refresh_top_leaderboards).touch)
 
     return ''
 
@@ -360,21 +392,17 @@ def tag_trends_callback():
 
     return ''
 
-@application.route('/worker_filtered_leaderboard_callback', methods=['POST'])
+@application.route('/worker_top_leaderboards_callback', methods=['POST'])
 @sentryDecorator()
-@timingIncrDecorator('worker_filtered_leaderboard_callback', track_status=False)
-def filtered_leaderboard_callback():
-    # See cron.yaml, this is called once per hour on the hour.
-    log.info("Worker processing message for filtered_leaderboard_callback")
+@timingIncrDecorator('worker_top_leaderboards_callback', track_status=False)
+def top_leaderboards_callback():
+    log.info("Worker processing message for top_leaderboards_callback")
     start_time = now()
+    # The photos are rendered as the Api renders them.
+    from apps.api.api import refresh_top_leaderboards
+    refresh_top_leaderboards()
 
-    trim_hour_leaderboards()
-    trim_today_leaderboards()
-    trim_week_leaderboards()
-    trim_month_leaderboards()
-    trim_year_leaderboards()
-
-    log.info("leaderboard trim done, %s" % took(start_time))
+    log.info("top leaderboards done, %s" % took(start_time))
     return ''
 
 @application.route('/worker_awards_callback', methods=['POST'])
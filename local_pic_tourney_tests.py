@@ -3459,6 +3459,32 @@ class LocalPicTourneyTestCase(unittest.TestCase):
         # This doesn't get set until the worker completes the upload.
         self.assertIsNone(user.photo)
 
+    def test_get_photos_by_uuid(self):
+        from logic.photo import get_photos_by_uuid
+        user = create_user()
+        user.show_gender_male = False
+        user.save()
+
+        photos = [create_photo(user, la_location, la_geo, False, True)
+                  for x in xrange(3)]
+        photos += [create_photo(user, boston_location, boston_geo, False,
+                                True) for x in xrange(2)]
+        # Keys for some, a wrong key for one, none for the rest.
+        gender_locations = {
+            photos[0].uuid: photos[0].gender_location,
+            photos[1].uuid: photos[1].gender_location,
+            photos[3].uuid: photos[0].gender_location,
+        }
+        missing_uuid = uuid1()
+        result = get_photos_by_uuid([p.uuid for p in photos] + [missing_uuid],
+                                    gender_locations)
+        self.assertEqual(set(p.uuid for p in photos), set(result.keys()))
+        for photo in photos:
+            self.assertEqual(photo.gender_location,
+                             result[photo.uuid].gender_location)
+
+        self.assertEqual({}, get_photos_by_uuid([]))
+
 
     def test_photo_comments(self):
         self.reset_model()
@@ -4270,6 +4296,71 @@ class LocalPicTourneyTestCase(unittest.TestCase):
         self.assertIsNotNone(match2)
         self.assertEqual(proposed_date, match2.proposed_date)
 
+    def test_write_back(self):
+        from model import WriteBack
+        user_uuid = uuid1()
+        matches = []
+        for x in xrange(30):
+            match = Match((uuid1(), uuid1()), user_uuid)
+            match.proposed_date = now()
+            match.lat = la_geo.lat
+            match.lon = la_geo.lon
+            match.geodata = la_geo.meta
+            match.location = la_location.uuid
+            matches.append(match)
+        user = create_user()
+
+        write_back = WriteBack()
+        for match in matches:
+            write_back.save(match)
+        # A second write to the same key replaces the first.
+        matches[0].judged = True
+        write_back.save(matches[0])
+        user.win_count = 7
+        write_back.save(user)
+        self.assertEqual(31, len(write_back))
+        self.assertEqual(31, write_back.commit())
+        self.assertEqual(3, write_back.request_count)
+        self.assertEqual(0, len(write_back))
+
+        self.assertTrue(Match.get(matches[0].photo_uuids, user_uuid).judged)
+        self.assertFalse(Match.get(matches[29].photo_uuids, user_uuid).judged)
+        self.assertEqual(7, User.get(user.uuid).win_count)
+
+        write_back.delete(matches[1])
+        self.assertEqual(1, write_back.commit())
+        self.assertEqual(0, Match.count(matches[1].photo_uuids))
+        self.assertEqual(0, write_back.commit())
+
+        # A conditional update writes only if the condition holds.
+        scored_date = now()
+        write_back.update(Match(matches[2].photo_uuids, user_uuid,
+                                scored_date=scored_date),
+                          ['scored_date'], user_uuid__exists=True)
+        write_back.update(Match(matches[1].photo_uuids, user_uuid,
+                                scored_date=scored_date),
+                          ['scored_date'], user_uuid__exists=True)
+        self.assertEqual(1, write_back.commit())
+        self.assertEqual(1, write_back.conditional_failures)
+        self.assertEqual(scored_date,
+                         Match.get(matches[2].photo_uuids,
+                                   user_uuid).scored_date)
+        self.assertEqual(0, Match.count(matches[1].photo_uuids))
+
+        # ADD updates are summed when merged and added to the stored value.
+        write_back.update(User(user.uuid, win_count=2, loss_count=1),
+                          ['win_count', 'loss_count'], action='ADD',
+                          uuid__exists=True)
+        write_back.update(User(user.uuid, win_count=3), ['win_count'],
+                          action='ADD', uuid__exists=True)
+        write_back.update(User(uuid1(), win_count=1), ['win_count'],
+                          action='ADD', uuid__exists=True)
+        self.assertEqual(1, write_back.commit())
+        self.assertEqual(2, write_back.conditional_failures)
+        stored = User.get(user.uuid)
+        self.assertEqual(12, stored.win_count)
+        self.assertEqual(1, stored.loss_count)
+
 
     def test_judge_match(self):
 
@@ -5056,6 +5147,72 @@ class LocalPicTourneyTestCase(unittest.TestCase):
             self.assertIn('gender_location', leaderboard)
             self.assertIn('photos', leaderboard)
 
+    def test_top_leaderboards_overview(self):
+        from apps.api.api import refresh_top_leaderboards
+        from logic import overview
+        self.reset_model()
+        overview.clear_cache()
+        user = create_user_with_photo(True, la_location, True)
+        headers = headers_with_auth(user.uuid, user.token)
+        # Rendered on the spot until the worker has saved them.
+        result = self.get200('/leaderboards/m', headers=headers)
+        self.assertIsNone(result['version'])
+        self.assertEqual([user.photo.hex], [
+            photo['id'] for photo in result['leaderboards'][0]['photos']])
+
+        refresh_top_leaderboards()
+        result = self.get200('/leaderboards/m', headers=headers)
+        version = result['version']
+        self.assertIsNotNone(version)
+        self.assertEqual('m%s' % la_location.uuid.hex,
+                         result['leaderboards'][0]['gender_location'])
+        self.assertEqual([user.photo.hex], [
+            photo['id'] for photo in result['leaderboards'][0]['photos']])
+        self.assertEqual(user.uuid.hex,
+                         result['leaderboards'][0]['photos'][0]['user']['uuid'])
+        self.assertIsNotNone(self.get200('/leaderboards/f',
+                                         headers=headers)['version'])
+
+        # A new photo shows once they are rendered again.
+        other = create_user_with_photo(True, la_location, True)
+        refresh_top_leaderboards()
+        self.assertEqual(version, self.get200('/leaderboards/m',
+                                              headers=headers)['version'])
+        overview.clear_cache()
+        result = self.get200('/leaderboards/m', headers=headers)
+        self.assertLess(version, result['version'])
+        self.assertItemsEqual([user.photo.hex, other.photo.hex], [
+            photo['id'] for photo in result['leaderboards'][0]['photos']])
+
+        # The scorer renders just the cities it scored again, at most every
+        # REFRESH_INTERVAL.
+        from model import LeaderboardOverview
+        la = 'm%s' % la_location.uuid.hex
+        boston = 'm%s' % boston_location.uuid.hex
+        third = create_user_with_photo(True, la_location, True)
+        before = dict((row.position, row.generated)
+                      for row in LeaderboardOverview.query('m'))
+        refreshes = []
+        def refresh(gender_locations):
+            refreshes.append(gender_locations)
+            refresh_top_leaderboards(gender_locations)
+        refresher = overview.Refresher(refresh)
+        self.assertTrue(refresher.touch(['%s#1' % la]))
+        self.assertFalse(refresher.touch([boston]))
+        self.assertEqual([set([la])], refreshes)
+        after = dict((row.position, row.generated)
+                     for row in LeaderboardOverview.query('m'))
+        self.assertEqual([0], [position for position in before
+                               if before[position] != after[position]])
+        overview.clear_cache()
+        result = self.get200('/leaderboards/m', headers=headers)
+        self.assertIn(third.photo.hex, [
+            photo['id'] for photo in result['leaderboards'][0]['photos']])
+        refresher.refreshed -= overview.REFRESH_INTERVAL
+        self.assertTrue(refresher.touch([]))
+        self.assertEqual(set([boston]), refreshes[-1])
+        overview.clear_cache()
+
     def test_leaderboard_filter(self):
         self.reset_model()
         url = '/leaderboards/f%s' % la_location.uuid.hex
@@ -5240,8 +5397,11 @@ class LocalPicTourneyTestCase(unittest.TestCase):
         # Log in as a male user from the same area.
         user = create_user_with_photo(True)
         headers = headers_with_auth(user.uuid, user.token)
-        # This trims the leaderboard.
-        self.worker.post('/worker_filtered_leaderboard_callback')
+        # Copy the rows into Leaderboard as the migration does, then do what
+        # TTL would, the reads skip expired rows regardless.
+        from logic import leaderboard
+        leaderboard.backfill()
+        leaderboard.sweep()
 
         user = create_user()
         headers = get_headers(user)
@@ -5551,6 +5711,9 @@ class LocalPicTourneyTestCase(unittest.TestCase):
         score_iter = iter(scores)
         gender_location = 'f%s' % location.hex
         users = []
+        from logic import leaderboard
+        from model import WriteBack
+        write_back = WriteBack()
         for x in xrange(user_count):
             user = create_user()
             user.show_gender_male = False
@@ -5564,32 +5727,22 @@ class LocalPicTourneyTestCase(unittest.TestCase):
                 photo.lon = la_geo.lon
                 photo.geodata = la_geo.meta
                 photo.location = location
-                photo.post_date = datetime.now()
+                photo.post_date = now()
                 photo.user_uuid = user.uuid
                 photo.copy_complete = True
                 photo.file_name = '%s_%s' % (gender_location, photo_uuid.hex)
                 photo.score = score_iter.next()
+                # Rated before, as every photo on the leaderboards is.
+                photo.phi = 200.0
                 photo.set_as_profile_photo = True
                 photo.save()
-                photo_today = TodayLeaderboard(gender_location,
-                                               uuid=photo_uuid,
-                                               post_date=photo.post_date,
-                                               score=photo.score)
-                photo_today.save()
-                photo_week = WeekLeaderboard(gender_location,
-                                             uuid=photo_uuid,
-                                             post_date=photo.post_date,
-                                             score=photo.score)
-                photo_week.save()
-                photo_month = MonthLeaderboard(gender_location,
-                                               uuid=photo_uuid,
-                                               post_date=photo.post_date,
-                                               score=photo.score)
-                photo_month.save()
+                leaderboard.put(write_back, gender_location, photo_uuid,
+                                photo.post_date, photo.score)
                 if y == 1:
                     user.photo = photo.uuid
                     user.save()
                 photos.append(photo)
+        write_back.commit()
 
         index_photos = list(Photo.score_index.query(gender_location,
                                                     limit=51,
@@ -5639,8 +5792,1266 @@ class LocalPicTourneyTestCase(unittest.TestCase):
             self.assertEqual(match.photo_uuids, match_2.photo_uuids)
             self.assertEqual(match.user_uuid, match_2.user_uuid)
 
-        from logic.score import do_scores
-        do_scores()
+        # Nothing is scored while someone else holds the score lease.
+        from logic import lease
+        from logic.score import do_scores, SCORE_LEASE
+        self.assertTrue(lease.acquire(SCORE_LEASE, 'another-scorer'))
+        self.assertFalse(do_scores())
+        self.assertIsNone(
+            Match.get(matches[0].photo_uuids, matches[0].user_uuid).scored_date)
+        self.assertTrue(lease.release(SCORE_LEASE, 'another-scorer'))
+
+        self.assertTrue(do_scores())
+        self.assertIsNone(lease.get_holder(SCORE_LEASE))
+
+        for match in matches:
+            self.assertIsNotNone(
+                Match.get(match.photo_uuids, match.user_uuid).scored_date)
+
+        # Each vote added a win to one photo's user and a loss to another's.
+        stored_users = [User.get(user.uuid) for user in users]
+        self.assertEqual(len(matches),
+                         sum(user.win_count for user in stored_users))
+        self.assertEqual(len(matches),
+                         sum(user.loss_count for user in stored_users))
+
+        # Every photo moved to its new score on every board, and is on it
+        # once.
+        scored = dict((photo.uuid, Photo.get(gender_location, photo.uuid))
+                      for photo in photos)
+        for photo in photos:
+            self.assertNotEqual(photo.score, scored[photo.uuid].score)
+        for window, duration in leaderboard.WINDOWS:
+            rows = list(leaderboard.Leaderboard.query(
+                leaderboard.get_board(window, gender_location)))
+            self.assertItemsEqual(scored.keys(), [row.uuid for row in rows])
+            for row in rows:
+                self.assertEqual(scored[row.uuid].score, row.score)
+                self.assertEqual((row.score, row.uuid), row.rank)
+                self.assertEqual(scored[row.uuid].post_date, row.post_date)
+
+    def test_score_consecutive_periods(self):
+        from logic import leaderboard
+        from logic import photo as photo_logic
+        from logic.score import decode_match, encode_match, process_scores
+        self.reset_model()
+        gender_location = 'f%s' % la_location.uuid.hex
+        users = [create_user_with_photo() for x in xrange(3)]
+        photo_a, photo_b, photo_c = [user.get_photo() for user in users]
+
+        def get_record(winner, loser):
+            photo_1, photo_2 = sorted([winner, loser],
+                                      key=lambda photo: photo.uuid.hex)
+            match = Match((photo_1.uuid, photo_2.uuid), users[0].uuid)
+            match.proposed_date = now()
+            match.lat = la_geo.lat
+            match.lon = la_geo.lon
+            match.geodata = la_geo.meta
+            match.location = la_location.uuid
+            match.a_won = photo_1 is winner
+            match.judged_date = now()
+            match.a_gender_location = photo_1.gender_location
+            match.b_gender_location = photo_2.gender_location
+            match.save()
+            return decode_match(encode_match(match))
+
+        reads = []
+        batch_get = photo_logic.batch_get
+        def recording_batch_get(model_class, keys, consistent_read=False):
+            reads.append(consistent_read)
+            return batch_get(model_class, keys,
+                             consistent_read=consistent_read)
+        photo_logic.batch_get = recording_batch_get
+        try:
+            # The second period starts from the rating the first wrote.
+            self.assertEqual(set([gender_location]), process_scores(
+                [get_record(photo_a, photo_b)]))
+            first = Photo.get(gender_location, photo_a.uuid).score
+            process_scores([get_record(photo_a, photo_c)])
+            second = Photo.get(gender_location, photo_a.uuid).score
+        finally:
+            photo_logic.batch_get = batch_get
+        self.assertEqual([True, True], reads)
+        self.assertGreater(second, first)
+        # Each board has the photo once, at its latest score.
+        for window, duration in leaderboard.WINDOWS:
+            rows = [row for row in leaderboard.Leaderboard.query(
+                        leaderboard.get_board(window, gender_location))
+                    if row.uuid == photo_a.uuid]
+            self.assertEqual([second], [row.score for row in rows])
+
+        # A match whose photo was deleted since is dropped, not rated.
+        record = get_record(photo_b, photo_c)
+        photo_c.delete()
+        before = Photo.get(gender_location, photo_b.uuid).score
+        self.assertEqual(set(), process_scores([record]))
+        self.assertEqual(before,
+                         Photo.get(gender_location, photo_b.uuid).score)
+
+    def test_score_with_lease(self):
+        import threading
+        from logic import kinesis, lease
+        from logic import score
+        self.reset_model()
+
+        class Consumer(object):
+            def __init__(self, batches):
+                self.batches = batches
+                self.checkpoints = []
+            def __iter__(self):
+                return iter(self.batches)
+            def checkpoint(self, batch):
+                self.checkpoints.append(batch)
+            def stop(self):
+                pass
+
+        attempts = []
+        def failing_process_scores(matches):
+            attempts.append(matches)
+            raise ValueError('bad batch (TEST)')
+        def losing_process_scores(matches):
+            for thread in threading.enumerate():
+                if isinstance(thread, lease.LeaseKeeper):
+                    thread.lost.set()
+            return set(['f'])
+
+        batches = [kinesis.Batch(), kinesis.Batch()]
+        process_scores = score.process_scores
+        backoff_sleep = score.backoff_sleep
+        score.backoff_sleep = lambda attempt, base, cap: None
+        try:
+            # A batch that keeps failing is checkpointed past, after
+            # SCORE_BATCH_ATTEMPTS tries, rather than stopping scoring.
+            score.process_scores = failing_process_scores
+            consumer = Consumer(batches)
+            self.assertTrue(score._score_with_lease(consumer, 'scorer'))
+            self.assertEqual(score.SCORE_BATCH_ATTEMPTS * len(batches),
+                             len(attempts))
+            self.assertEqual(batches, consumer.checkpoints)
+
+            # A lease lost while scoring a batch isn't checkpointed, nor
+            # reported scored.
+            score.process_scores = losing_process_scores
+            consumer = Consumer(batches)
+            scored = []
+            self.assertTrue(score._score_with_lease(consumer, 'scorer',
+                                                    scored.append))
+            self.assertEqual([], consumer.checkpoints)
+            self.assertEqual([], scored)
+        finally:
+            score.process_scores = process_scores
+            score.backoff_sleep = backoff_sleep
+        self.assertIsNone(lease.get_holder(score.SCORE_LEASE))
+
+    def test_score_record(self):
+        from logic.score import decode_match, encode_match
+        a_gender_location = 'f%s' % la_location.uuid.hex
+        b_gender_location = 'f%s' % boston_location.uuid.hex
+        match = Match((uuid1(), uuid1()), uuid1())
+        match.proposed_date = now()
+        match.lat = la_geo.lat
+        match.lon = la_geo.lon
+        match.geodata = la_geo.meta
+        match.location = la_location.uuid
+        match.a_won = False
+        match.judged_date = now()
+        match.a_gender_location = a_gender_location
+        match.b_gender_location = b_gender_location
+        record = decode_match(encode_match(match))
+        self.assertEqual(match.photo_uuids, record.photo_uuids)
+        self.assertEqual(match.user_uuid, record.user_uuid)
+        self.assertIs(False, record.a_won)
+        self.assertEqual(match.judged_date, record.judged_date)
+        self.assertEqual((a_gender_location, b_gender_location),
+                         record.gender_locations)
+
+        match.a_won = None
+        match.judged_date = None
+        match.b_gender_location = None
+        record = decode_match(encode_match(match))
+        self.assertIsNone(record.a_won)
+        self.assertIsNone(record.judged_date)
+        self.assertEqual((a_gender_location, None), record.gender_locations)
+
+        # The legacy hex record reads the vote from the Match.
+        match.a_won = True
+        match.judged_date = now()
+        match.save()
+        photo_a_uuid, photo_b_uuid = match.photo_uuids
+        legacy = '%s%s%s' % (photo_a_uuid.hex, photo_b_uuid.hex,
+                             match.user_uuid.hex)
+        record = decode_match(legacy)
+        self.assertEqual(match.photo_uuids, record.photo_uuids)
+        self.assertEqual(match.user_uuid, record.user_uuid)
+        self.assertIs(True, record.a_won)
+        self.assertEqual(match.judged_date, record.judged_date)
+        self.assertEqual((a_gender_location, a_gender_location),
+                         record.gender_locations)
+
+    def test_kinesis_shards(self):
+        from logic.kinesis import get_all
+        from logic.score import get_match_partition_key
+        stream = settings.SCORE_STREAM
+        connection = get_kinesis()
+        connection.reset(stream)
+        match = Match((uuid1(), uuid1()), uuid1())
+        swapped = Match((match.photo_uuids[1], match.photo_uuids[0]),
+                        match.user_uuid)
+        self.assertEqual(get_match_partition_key(match),
+                         get_match_partition_key(swapped))
+
+        data = [uuid1().hex for x in xrange(40)]
+        shard_ids = set()
+        for d in data:
+            shard_ids.add(connection.put_record(stream, d, d)['ShardId'])
+        self.assertGreater(len(shard_ids), 1)
+
+        # Page through describe_stream a shard at a time.
+        describe_limit = connection.describe_limit
+        connection.describe_limit = 1
+        try:
+            self.assertItemsEqual(data, list(get_all(stream)))
+        finally:
+            connection.describe_limit = describe_limit
+        self.assertEqual([], list(get_all(stream)))
+
+    def test_stream_consumer(self):
+        from logic.kinesis import StreamConsumer
+        from model import ShardIterator
+        stream = 'test-stream-' + rand_string(8)
+        connection = get_kinesis()
+        data = [uuid1().hex for x in xrange(35)]
+        for d in data:
+            connection.put_record(stream, d, d)
+
+        consumer = StreamConsumer(stream, batch_size=10, linger=0.1)
+        seen = []
+        previous = {}
+        for batch in consumer:
+            self.assertLessEqual(len(batch), 10)
+            seen.extend(batch)
+            # Nothing new is saved until the batch is checkpointed.
+            for shard_id, sequence_number in batch.positions.iteritems():
+                if previous.get(shard_id) == sequence_number:
+                    continue
+                try:
+                    saved = ShardIterator.get(stream + shard_id).sequence_number
+                except ShardIterator.DoesNotExist:
+                    saved = None
+                self.assertNotEqual(sequence_number, saved)
+            consumer.checkpoint(batch)
+            for shard_id, sequence_number in batch.positions.iteritems():
+                self.assertEqual(
+                    sequence_number,
+                    ShardIterator.get(stream + shard_id).sequence_number)
+            previous = batch.positions
+        self.assertItemsEqual(data, seen)
+        self.assertEqual(35, consumer.count)
+        self.assertEqual(connection.shard_count, len(consumer.lag))
+
+    def test_replay(self):
+        import pytz
+        from logic.glicko2 import Glicko2, LOSS, WIN
+        from logic.replay import replay
+        from logic.score import TAU
+        from model import PhotoGenderTag
+        location = uuid1()
+        gender_location = 'f%s' % location.hex
+        user = create_user()
+        photos = []
+        for x in xrange(5):
+            photo = Photo(gender_location, uuid1())
+            photo.lat = la_geo.lat
+            photo.lon = la_geo.lon
+            photo.geodata = la_geo.meta
+            photo.location = location
+            photo.post_date = now()
+            photo.user_uuid = user.uuid
+            photo.file_name = '%s_%s' % (gender_location, photo.uuid.hex)
+            photo.is_gender_male = False
+            photo.copy_complete = True
+            photo.set_as_profile_photo = False
+            photo.tags = set(['replay'])
+            photo.save()
+            photos.append(photo)
+
+        # Two rating periods of votes among the first four photos, and one
+        # vote for a photo that is gone.
+        start = datetime(2016, 1, 1, tzinfo=pytz.utc)
+        periods = []
+        for offset in (timedelta(minutes=1), timedelta(minutes=12)):
+            games = []
+            for x in xrange(6):
+                photo_a, photo_b = random.sample(photos[:4], 2)
+                a_won = random.choice([True, False])
+                match = Match((photo_a.uuid, photo_b.uuid), uuid1())
+                match.proposed_date = start
+                match.judged = True
+                match.judged_date = start + offset + timedelta(seconds=x)
+                match.a_won = a_won
+                match.lat = la_geo.lat
+                match.lon = la_geo.lon
+                match.geodata = la_geo.meta
+                match.location = location
+                match.save()
+                games.append((photo_a.uuid, photo_b.uuid, a_won))
+            periods.append(games)
+        match = Match((photos[0].uuid, uuid1()), uuid1())
+        match.proposed_date = start
+        match.judged = True
+        match.judged_date = start
+        match.a_won = True
+        match.lat = la_geo.lat
+        match.lon = la_geo.lon
+        match.geodata = la_geo.meta
+        match.location = location
+        match.save()
+
+        # The expected ratings, one scalar rate per photo per period.
+        env = Glicko2(tau=TAU)
+        ratings = dict((photo.uuid, env.create_rating(1500.0, 350.0, 0.006))
+                       for photo in photos)
+        for games in periods:
+            series = {}
+            for uuid_a, uuid_b, a_won in games:
+                series.setdefault(uuid_a, []).append(
+                    (WIN if a_won else LOSS, ratings[uuid_b]))
+                series.setdefault(uuid_b, []).append(
+                    (LOSS if a_won else WIN, ratings[uuid_a]))
+            ratings.update((photo_uuid, env.rate(ratings[photo_uuid], games))
+                           for photo_uuid, games in series.iteritems())
+
+        # moto can't segment a scan on a binary hash key, Match's.
+        plan = replay(processes=2, segments=1)
+        self.assertGreaterEqual(plan.skipped, 1)
+        changes = dict((photo['uuid'], rating)
+                       for photo, rating in plan.changes
+                       if photo['gender_location'] == gender_location)
+        self.assertItemsEqual([photo.uuid for photo in photos[:4]],
+                              changes.keys())
+        for photo_uuid, (score, phi, sigma) in changes.iteritems():
+            self.assertAlmostEqual(ratings[photo_uuid].mu, score, places=9)
+            self.assertAlmostEqual(ratings[photo_uuid].phi, phi, places=9)
+            self.assertAlmostEqual(ratings[photo_uuid].sigma, sigma, places=12)
+        self.assertIn(gender_location, plan.report())
+        # A dry run writes nothing.
+        self.assertEqual(1500.0, Photo.get(gender_location,
+                                           photos[0].uuid).score)
+
+        plan.write()
+        from logic import leaderboard
+        today = dict((row.uuid, row.score)
+                     for row in leaderboard.get_top('today', gender_location))
+        for photo in photos[:4]:
+            stored = Photo.get(gender_location, photo.uuid)
+            self.assertAlmostEqual(changes[photo.uuid][0], stored.score)
+            self.assertEqual(photo.file_name, stored.file_name)
+            self.assertAlmostEqual(stored.score, today[photo.uuid])
+            # Tag rows are updated, not created.
+            with self.assertRaises(PhotoGenderTag.DoesNotExist):
+                PhotoGenderTag.get('f_replay', photo.uuid)
+        self.assertEqual(1500.0, Photo.get(gender_location,
+                                           photos[4].uuid).score)
+
+    def test_leaderboard_expiry(self):
+        from model import get_leaderboard_expires, get_ttl_seconds, \
+            is_leaderboard_expired
+        from logic import leaderboard
+        gender_location = 'f%s' % uuid1().hex
+        current = now()
+        current_seconds = get_ttl_seconds(current)
+        # (post_date, with expires) for rows on the hour board.
+        rows = {'live': (current - timedelta(minutes=10), True),
+                'expired': (current - timedelta(hours=2), True),
+                'old_live': (current - timedelta(minutes=20), False),
+                'old_expired': (current - timedelta(hours=3), False)}
+        uuids = {}
+        for name, (post_date, with_expires) in rows.iteritems():
+            uuids[name] = uuid1()
+            row = HourLeaderboard(gender_location, uuid=uuids[name],
+                                  post_date=post_date, score=1500)
+            if with_expires:
+                row.expires = get_leaderboard_expires(HourLeaderboard,
+                                                      post_date)
+            row.save()
+            self.assertEqual(name.endswith('expired'),
+                             is_leaderboard_expired(row, current_seconds))
+        self.assertEqual(
+            get_ttl_seconds(current) + 3600 - 600,
+            get_leaderboard_expires(HourLeaderboard, rows['live'][0]))
+        self.assertEqual(
+            get_ttl_seconds(current) + 31 * 86400 - 600,
+            get_leaderboard_expires(MonthLeaderboard, rows['live'][0]))
+
+        leaderboard.sweep()
+        stored = dict((row.uuid, row)
+                      for row in HourLeaderboard.query(gender_location))
+        self.assertItemsEqual([uuids['live'], uuids['old_live']],
+                              stored.keys())
+        # The older row gets its expires so TTL can take it.
+        self.assertEqual(
+            get_leaderboard_expires(HourLeaderboard, rows['old_live'][0]),
+            stored[uuids['old_live']].expires)
+
+    def test_leaderboard_table(self):
+        from model import ScoreRankAttribute, WriteBack
+        from logic import leaderboard
+        # The range key sorts as the scores do.
+        attribute = ScoreRankAttribute()
+        scores = [-1500.5, -1.0, -0.25, 0.0, 0.25, 2, 1500.0, 1500.5, 1e9]
+        keys = [(score, uuid1()) for score in scores]
+        serialized = [attribute.serialize(key) for key in keys]
+        self.assertListEqual(serialized, sorted(serialized))
+        self.assertListEqual(keys, [attribute.deserialize(value)
+                                    for value in serialized])
+
+        gender_location = 'f%s' % uuid1().hex
+        current = now()
+        post_dates = [current, current - timedelta(hours=2), current]
+        photo_uuids = [uuid1() for x in xrange(3)]
+        write_back = WriteBack()
+        for photo_uuid, post_date, score in zip(photo_uuids, post_dates,
+                                                [1500.0, 1600.0, 1400.0]):
+            leaderboard.put(write_back, gender_location, photo_uuid,
+                            post_date, score)
+        write_back.commit()
+
+        def top(window, board_gender_location=gender_location):
+            return [(row.uuid, row.score) for row in leaderboard.get_top(
+                        window, board_gender_location)
+                    if row.uuid in photo_uuids]
+        self.assertListEqual([(photo_uuids[1], 1600.0),
+                              (photo_uuids[0], 1500.0),
+                              (photo_uuids[2], 1400.0)], top('week'))
+        self.assertListEqual(top('week'), top('week', leaderboard.ALL))
+        # Posted two hours ago, it is not on the hour board.
+        self.assertListEqual([(photo_uuids[0], 1500.0),
+                              (photo_uuids[2], 1400.0)], top('hour'))
+
+        # A new score moves the photo.
+        write_back = WriteBack()
+        leaderboard.put(write_back, gender_location, photo_uuids[2],
+                        post_dates[2], 1700.0, old_score=1400.0)
+        write_back.commit()
+        self.assertListEqual([(photo_uuids[2], 1700.0),
+                              (photo_uuids[1], 1600.0),
+                              (photo_uuids[0], 1500.0)], top('week'))
+        self.assertEqual(3, len(list(leaderboard.Leaderboard.query(
+            leaderboard.get_board('month', gender_location)))))
+
+        # The migration copies the per-window tables.
+        photo_uuids.append(uuid1())
+        WeekLeaderboard(gender_location, uuid=photo_uuids[3],
+                        post_date=current - timedelta(days=2),
+                        score=1550.0).save()
+        leaderboard.backfill()
+        self.assertListEqual([(photo_uuids[2], 1700.0),
+                              (photo_uuids[1], 1600.0),
+                              (photo_uuids[3], 1550.0),
+                              (photo_uuids[0], 1500.0)], top('week'))
+        self.assertNotIn(photo_uuids[3], [uuid for uuid, score
+                                          in top('today')])
+
+    def test_photo_rank(self):
+        from model import WriteBack
+        from logic import leaderboard
+        user = self.create_user(gender='female')
+        headers = get_headers(user)
+        gender_location = 'f%s' % uuid1().hex
+        post_date = now() - timedelta(days=2)
+        photos = []
+        write_back = WriteBack()
+        for score in xrange(1300, 1750, 15):
+            photo_uuid = uuid1()
+            photo = Photo(gender_location, photo_uuid)
+            photo.is_gender_male = False
+            photo.lat = la_geo.lat
+            photo.lon = la_geo.lon
+            photo.geodata = la_geo.meta
+            photo.location = la_location.uuid
+            photo.post_date = post_date
+            photo.user_uuid = user.uuid
+            photo.copy_complete = True
+            photo.score = float(score)
+            photo.phi = 200.0
+            photo.file_name = "%s_%s" % (gender_location, photo_uuid.hex)
+            photo.set_as_profile_photo = True
+            photo.save()
+            photos.append(photo)
+            leaderboard.put(write_back, gender_location, photo_uuid,
+                            post_date, photo.score)
+        write_back.commit()
+
+        def get_rank(photo, query=''):
+            return self.get200('/photos/%s/rank%s' % (photo.uuid.hex, query),
+                               headers=headers)
+        # One photo to a bucket, so the histogram ranks them exactly.
+        result = get_rank(photos[0])
+        self.assertEqual(len(photos), result['rank'])
+        self.assertEqual(len(photos), result['count'])
+        self.assertFalse(result['exact'])
+        result = get_rank(photos[-3])
+        self.assertEqual(3, result['rank'])
+        self.assertEqual(100.0 * (len(photos) - 2) / len(photos),
+                         result['percentile'])
+        self.assertGreaterEqual(
+            get_rank(photos[-3], '?gender_location=all')['rank'], 3)
+        # Posted two days ago, the photo isn't on today's board.
+        self.assertIsNone(get_rank(photos[-3], '?when=today')['rank'])
+        self.get409('/photos/%s/rank?when=alltime' % photos[0].uuid.hex,
+                    headers=headers,
+                    error_message=u"InvalidAPIUsage: unrecognized filter "
+                                  u"'alltime'")
+
+        # A new score moves the photo between buckets.
+        write_back = WriteBack()
+        leaderboard.put(write_back, gender_location, photos[0].uuid,
+                        post_date, 1800.0, old_score=photos[0].score)
+        write_back.commit()
+        photos[0].score = 1800.0
+        photos[0].save()
+        self.assertEqual(1, get_rank(photos[0])['rank'])
+        self.assertEqual(4, get_rank(photos[-3])['rank'])
+        self.assertEqual(len(photos), get_rank(photos[1])['count'])
+
+        # Rebuilt from the Leaderboard table, the counts are the same.
+        leaderboard.rebuild_histograms()
+        self.assertEqual((3, len(photos)), leaderboard.get_histogram_rank(
+            'week', gender_location, photos[-3].score))
+
+    def test_all_shards(self):
+        from itertools import islice
+        from model import ALL_SHARD_COUNT, get_all_shard, get_ttl_seconds, \
+            Leaderboard, WriteBack
+        from logic import leaderboard
+        from util import merge_by
+        self.assertListEqual([5, 4, 3, 3, 2, 1, 0], list(merge_by(
+            [[5, 3, 1], [4, 3, 0], [], [2]], lambda x: -x)))
+        shards = set(get_all_shard(uuid1()) for x in xrange(200))
+        self.assertEqual(ALL_SHARD_COUNT, len(shards))
+        self.assertNotIn(leaderboard.ALL, shards)
+
+        self.reset_model()
+        user = self.create_user(gender='female')
+        gender_location = 'f%s' % la_location.uuid.hex
+        post_date = now() - timedelta(days=2)
+        photos = []
+        write_back = WriteBack()
+        # Two photos share a score, the rest are apart.
+        for index, score in enumerate([1500] + range(1300, 1700, 10)):
+            photo_uuid = uuid1()
+            photo = Photo(gender_location, photo_uuid)
+            photo.is_gender_male = False
+            photo.lat = la_geo.lat
+            photo.lon = la_geo.lon
+            photo.geodata = la_geo.meta
+            photo.location = la_location.uuid
+            photo.post_date = post_date
+            photo.user_uuid = user.uuid
+            photo.copy_complete = True
+            photo.score = float(score)
+            photo.phi = 200.0
+            photo.file_name = "%s_%s" % (gender_location, photo_uuid.hex)
+            photo.set_as_profile_photo = True
+            # Every third photo is from before the shards.
+            if index % 3:
+                photo.null_hash = get_all_shard(photo_uuid)
+            photo.save()
+            photos.append(photo)
+            leaderboard.put(write_back, gender_location, photo_uuid,
+                            post_date, photo.score)
+        write_back.commit()
+        expected = [photo.uuid for photo in
+                    sorted(photos, key=lambda photo: -photo.score)]
+
+        def get_all_time_top(after=None, count=None):
+            return [photo.uuid for photo in islice(
+                leaderboard.get_all_time_top(after=after), count)]
+        top = get_all_time_top()
+        self.assertItemsEqual(expected, top)
+        self.assertListEqual(sorted(photo.score for photo in photos)[::-1],
+                             [Photo.get(gender_location, photo_uuid).score
+                              for photo_uuid in top])
+        # Pages pick up past the last photo, even within a tie.
+        tie = [photo_uuid for photo_uuid in top
+               if Photo.get(gender_location, photo_uuid).score == 1500.0]
+        self.assertEqual(2, len(tie))
+        cut = top.index(tie[0]) + 1
+        self.assertListEqual(top[cut:cut + 10],
+                             get_all_time_top(after=tie[0], count=10))
+        self.assertListEqual(top[16:], get_all_time_top(after=top[15]))
+        rows = list(leaderboard.get_top('week', leaderboard.ALL))
+        self.assertItemsEqual(top, [row.uuid for row in rows])
+        self.assertListEqual(sorted(photo.score for photo in photos)[::-1],
+                             [row.score for row in rows])
+
+        # Photos and all board rows from before the shards move to them.
+        old_board = leaderboard.get_board('week', leaderboard.ALL)
+        Leaderboard(old_board, (1800.0, photos[0].uuid),
+                    gender_location=gender_location, uuid=photos[0].uuid,
+                    score=1800.0, post_date=post_date,
+                    expires=get_ttl_seconds(post_date + timedelta(days=7))
+                    ).save()
+        self.assertEqual(photos[0].uuid,
+                         leaderboard.get_top('week', leaderboard.ALL).next().uuid)
+        leaderboard.reshard_all()
+        self.assertEqual([], list(Photo.all_score_index.query(
+            leaderboard.ALL)))
+        self.assertEqual([], list(Leaderboard.query(old_board)))
+        self.assertItemsEqual(top, get_all_time_top())
+        self.assertEqual(photos[0].uuid,
+                         leaderboard.get_top('week', leaderboard.ALL).next().uuid)
+
+    def test_gender_location_shards(self):
+        from itertools import islice
+        from model import get_base_gender_location, \
+            get_gender_location_shard, get_gender_location_shards, \
+            highest_first, newest_first, query_gender_location, WriteBack
+        from logic import leaderboard
+        from settings import settings
+        self.reset_model()
+        user = self.create_user(gender='female')
+        gender_location = 'f%s' % la_location.uuid.hex
+        self.assertListEqual([gender_location],
+                             get_gender_location_shards(gender_location))
+        settings.GENDER_LOCATION_SHARDS[la_location.uuid.hex] = 4
+        try:
+            shards = get_gender_location_shards(gender_location)
+            self.assertEqual(4, len(shards))
+            self.assertEqual(gender_location, shards[0])
+            self.assertEqual(gender_location,
+                             get_base_gender_location(shards[3]))
+
+            post_date = now() - timedelta(days=2)
+            photos = []
+            write_back = WriteBack()
+            for index, score in enumerate(range(1300, 1700, 10)):
+                photo_uuid = uuid1()
+                photo = Photo(get_gender_location_shard(gender_location,
+                                                        photo_uuid),
+                              photo_uuid)
+                photo.is_gender_male = False
+                photo.lat = la_geo.lat
+                photo.lon = la_geo.lon
+                photo.geodata = la_geo.meta
+                photo.location = la_location.uuid
+                photo.post_date = post_date + timedelta(minutes=index)
+                photo.user_uuid = user.uuid
+                photo.copy_complete = True
+                photo.score = float(score)
+                photo.phi = 200.0
+                photo.file_name = "%s_%s" % (gender_location, photo_uuid.hex)
+                photo.set_as_profile_photo = True
+                photo.save()
+                photos.append(photo)
+                leaderboard.put(write_back, photo.gender_location, photo_uuid,
+                                photo.post_date, photo.score)
+            write_back.commit()
+            # The photos spread over the shards, and are in the location.
+            self.assertLess(1, len(set(photo.gender_location
+                                       for photo in photos)))
+            self.assertEqual(set([la_location.uuid.hex]),
+                             set(photo.get_location() for photo in photos))
+
+            # Reads of the location merge its shards in order.
+            by_score = [photo.uuid for photo in
+                        sorted(photos, key=lambda photo: -photo.score)]
+            self.assertListEqual(by_score, [photo.uuid for photo in
+                query_gender_location(Photo.score_index, gender_location,
+                                      highest_first,
+                                      scan_index_forward=False)])
+            by_date = [photo.uuid for photo in
+                       sorted(photos, key=lambda photo: photo.post_date,
+                              reverse=True)]
+            self.assertListEqual(by_date[:10], [photo.uuid for photo in islice(
+                query_gender_location(Photo.post_date_index, gender_location,
+                                      newest_first,
+                                      scan_index_forward=False), 10)])
+            self.assertListEqual(by_score, [row.uuid for row in
+                leaderboard.get_top('week', gender_location)])
+            self.assertEqual((0, len(photos)), leaderboard.get_histogram_rank(
+                'week', gender_location, 1690.0))
+        finally:
+            del settings.GENDER_LOCATION_SHARDS[la_location.uuid.hex]
+
+    def test_match_candidates(self):
+        from threading import Thread
+        from logic import candidates
+        from settings import settings
+        self.reset_model()
+        gender_location = 'f%s' % la_location.uuid.hex
+        photos = [create_user_with_photo(False, la_location).get_photo()
+                  for x in xrange(4)]
+        photos[1].media_type = 'movie'
+        photos[1].save()
+        photos[2].is_test = True
+        photos[2].save()
+        match_pool_seconds = settings.MATCH_POOL_SECONDS
+        settings.MATCH_POOL_SECONDS = 60
+        try:
+            # Split by media type, test photos left out unless asked for.
+            pool = candidates.get_pool(gender_location)
+            self.assertItemsEqual([photos[0].uuid, photos[3].uuid],
+                                  [photo.uuid for photo in pool.photos])
+            self.assertEqual([photos[1].uuid],
+                             [photo.uuid for photo in pool.movies])
+            self.assertEqual(4, len(candidates.get_pool(gender_location,
+                                                        include_test=True)))
+
+            # The pool is reused until it is MATCH_POOL_SECONDS old.
+            create_user_with_photo(False, la_location)
+            self.assertIs(pool, candidates.get_pool(gender_location))
+            settings.MATCH_POOL_SECONDS = 0
+            self.assertEqual(4, len(candidates.get_pool(gender_location)))
+
+            # Requests for a cold pool wait on one load.
+            settings.MATCH_POOL_SECONDS = 60
+            gender_location = 'm%s' % la_location.uuid.hex
+            pools = []
+            threads = [Thread(target=lambda: pools.append(
+                           candidates.get_pool(gender_location)))
+                       for x in xrange(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(8, len(pools))
+            self.assertEqual(1, len(set(id(pool) for pool in pools)))
+        finally:
+            settings.MATCH_POOL_SECONDS = match_pool_seconds
+
+    def test_judged_pairs(self):
+        from logic import judged
+        from logic.tournament import create_match
+        import model
+        # No false negatives, and about FALSE_POSITIVE_RATE false positives.
+        keys = judged.BloomFilter(1000)
+        added = [uuid1().bytes for x in xrange(1000)]
+        for key in added:
+            keys.add(key)
+        self.assertTrue(all(key in keys for key in added))
+        false_positives = sum(1 for x in xrange(10000)
+                              if uuid1().bytes in keys)
+        self.assertLess(false_positives, 10000 * 3 *
+                        judged.FALSE_POSITIVE_RATE)
+
+        self.reset_model()
+        judged.clear()
+        user = create_user_with_photo()
+        photo_a, photo_b, photo_c, photo_d = [
+            create_user_with_photo().get_photo() for x in xrange(4)]
+        if photo_a.uuid.hex > photo_b.uuid.hex:
+            photo_a, photo_b = photo_b, photo_a
+        create_match(photo_a, photo_b, user)
+        # Built from Match.user_index, and in either order.
+        judged_filter = judged.get_filter(user.uuid)
+        self.assertTrue(judged_filter.has_judged(photo_a.uuid, photo_b.uuid))
+        self.assertTrue(judged_filter.has_judged(photo_b.uuid, photo_a.uuid))
+        self.assertFalse(judged_filter.has_judged(photo_a.uuid, photo_c.uuid))
+        self.assertFalse(judged.get_filter(uuid1()).has_judged(photo_a.uuid,
+                                                               photo_b.uuid))
+        # Matches made here are added as they are saved.
+        create_match(photo_a, photo_c, user)
+        self.assertTrue(judged_filter.has_judged(photo_a.uuid, photo_c.uuid))
+        # Matches made elsewhere are read on the next request.
+        match = model.Match((photo_c.uuid, photo_d.uuid), user.uuid)
+        match.proposed_date = now()
+        match.lat = la_geo.lat
+        match.lon = la_geo.lon
+        match.geodata = la_geo.meta
+        match.location = la_location.uuid
+        match.save()
+        self.assertTrue(judged.get_filter(user.uuid).has_judged(
+            photo_c.uuid, photo_d.uuid))
+
+    def test_matchmaking(self):
+        from collections import Counter
+        from logic import matchmaking
+        users = [uuid1() for x in xrange(10)]
+        photos = []
+        for x in xrange(60):
+            photo = Photo('f%s' % la_location.uuid.hex, uuid1())
+            photo.user_uuid = users[x % len(users)]
+            photo.score = 1200.0 + 10 * x
+            photo.phi = 50.0
+            photo.media_type = 'movie' if x % 4 == 0 else 'photo'
+            photos.append(photo)
+        # One photo we know little about, it comes up most.
+        photos[30].phi = 350.0
+        matchmakers = matchmaking.get_matchmakers(photos)
+        self.assertEqual(15, len(matchmakers['movie']))
+        self.assertEqual(45, len(matchmakers['photo']))
+        picks = Counter(matchmakers['photo'].pick().uuid
+                        for x in xrange(2000))
+        self.assertEqual(photos[30].uuid, picks.most_common(1)[0][0])
+
+        # Opponents are close in score, of the same media type and not the
+        # photo or its user.
+        for x in xrange(200):
+            opponent = matchmakers['photo'].pick_opponent(photos[30])
+            self.assertNotEqual(photos[30].user_uuid, opponent.user_uuid)
+            self.assertEqual('photo', opponent.media_type)
+            self.assertLessEqual(abs(opponent.score - photos[30].score),
+                                 10 * 2 * matchmaking.OPPONENT_WINDOW)
+        # A photo from outside the pool gets one too.
+        bump = Photo('f%s' % la_location.uuid.hex, uuid1())
+        bump.user_uuid = uuid1()
+        bump.score = 1500.0
+        bump.media_type = 'movie'
+        self.assertEqual('movie', matchmakers['movie'].pick_opponent(
+            bump).media_type)
+
+        pairs = list(matchmaking.get_pairs(matchmakers, 30))
+        self.assertLessEqual(len(pairs), 30)
+        self.assertLess(20, len(pairs))
+        for photo_a, photo_b in pairs:
+            self.assertNotEqual(photo_a.uuid, photo_b.uuid)
+            self.assertNotEqual(photo_a.user_uuid, photo_b.user_uuid)
+            self.assertEqual(photo_a.media_type, photo_b.media_type)
+        # Too few photos to pair.
+        self.assertEqual([], list(matchmaking.get_pairs(
+            matchmaking.get_matchmakers(photos[:1]), 10)))
+
+    def test_match_queue(self):
+        from datetime import timedelta
+        from uuid import UUID
+        import json
+        import zlib
+        from pynamodb.exceptions import DoesNotExist
+        from logic import match_queue
+        from model import Match, MatchQueue
+        from settings import settings
+        self.reset_model()
+        gender_location = 'f%s' % la_location.uuid.hex
+        for x in xrange(20):
+            create_user_with_photo()
+        user = create_user_with_photo()
+        user.view_gender_male = False
+        user.save()
+        headers = get_headers(user)
+        del get_queue().messages[:]
+        match_queue_enabled = settings.MATCH_QUEUE_ENABLED
+        settings.MATCH_QUEUE_ENABLED = True
+        try:
+            # Nothing is queued yet, so the matches are made here, and the
+            # worker is asked to pick the next ones.
+            self.get200('/users/me/matches', headers=headers)
+            self.assertEqual(1, len(get_queue().messages))
+            status = User.get(user.uuid).matches_until_next_tournament
+            self.pop_sqs_to_worker()
+            self.assertEqual(match_queue.BATCHES,
+                             match_queue.count(user.uuid, gender_location))
+
+            # Nothing is written for the picked pairs until they're served.
+            oldest = list(MatchQueue.query(user.uuid))[0]
+            queued = [(UUID(photo_a['uuid']), UUID(photo_b['uuid']))
+                      for photo_a, photo_b in json.loads(
+                          zlib.decompress(oldest.pairs))['pairs']]
+            self.assertNotEqual([], queued)
+            self.assertEqual(status,
+                             User.get(user.uuid).matches_until_next_tournament)
+            for pair in queued:
+                with self.assertRaises(DoesNotExist):
+                    Match.get(pair, user.uuid)
+
+            # The oldest batch is served, and the worker asked again.
+            result = self.get200('/users/me/matches', headers=headers)
+            served = [(UUID(match['match_id'][:32]),
+                       UUID(match['match_id'][32:]))
+                      for match in result['matches'] if match['t'] == 'regular']
+            self.assertEqual(queued[:len(served)], served)
+            for pair in served:
+                Match.get(pair, user.uuid)
+            self.assertNotEqual(
+                status, User.get(user.uuid).matches_until_next_tournament)
+            self.assertEqual(match_queue.BATCHES - 1,
+                             match_queue.count(user.uuid, gender_location))
+            self.assertEqual(1, len(get_queue().messages))
+            self.pop_sqs_to_worker()
+            self.assertEqual(match_queue.BATCHES,
+                             match_queue.count(user.uuid, gender_location))
+
+            # Old batches, and batches of another gender_location, are
+            # dropped rather than served.
+            match_queue.push(user.uuid, 'm%s' % la_location.uuid.hex, [], {})
+            stale = MatchQueue(user.uuid,
+                               now() - match_queue.MAX_AGE - timedelta(1),
+                               gender_location=gender_location,
+                               pairs=zlib.compress(json.dumps(
+                                   {'pairs': [], 'bump': None})))
+            stale.save()
+            self.assertEqual(match_queue.BATCHES,
+                             match_queue.count(user.uuid, gender_location))
+            self.assertEqual(match_queue.BATCHES,
+                             len(list(MatchQueue.query(user.uuid))))
+            self.assertIsNotNone(match_queue.pop(user.uuid, gender_location))
+        finally:
+            settings.MATCH_QUEUE_ENABLED = match_queue_enabled
+            del get_queue().messages[:]
+
+    def test_tournament_status_write_back(self):
+        from pynamodb.exceptions import DoesNotExist
+        from logic.tournament import create_matches, \
+            init_tournament_status, lock_tournament_status, \
+            tournament_is_next, tournament_status_log_match
+        import model
+        self.reset_model()
+        user = create_user_with_photo()
+        photo_a, photo_b, photo_c = [
+            create_user_with_photo().get_photo() for x in xrange(3)]
+        pairs = [tuple(sorted(pair, key=lambda photo: photo.uuid.hex))
+                 for pair in [(photo_a, photo_b), (photo_a, photo_c)]]
+        user.matches_until_next_tournament = 3
+        user.save()
+        write_back = model.WriteBack()
+        init_tournament_status(user, write_back)
+        for pair in pairs:
+            self.assertFalse(tournament_is_next(user, write_back))
+            tournament_status_log_match(user, write_back)
+        matches = create_matches(pairs, user, write_back)
+        # Nothing is written until the commit.
+        self.assertEqual(3,
+                         User.get(user.uuid).matches_until_next_tournament)
+        with self.assertRaises(DoesNotExist):
+            model.Match.get((pairs[0][0].uuid, pairs[0][1].uuid), user.uuid)
+        # One UpdateItem of the user and one batch of the Matches.
+        self.assertEqual(3, write_back.commit())
+        self.assertEqual(2, write_back.request_count)
+        saved = User.get(user.uuid)
+        self.assertEqual(8, saved.matches_until_next_tournament)
+        self.assertEqual('local', saved.next_tournament)
+        for (a, b), match in zip(pairs, matches):
+            saved_match = model.Match.get((a.uuid, b.uuid), user.uuid)
+            self.assertEqual(match.a_win_delta, saved_match.a_win_delta)
+
+        # Bumping a photo deleted meanwhile doesn't make a stub of it.
+        photo = create_user_with_photo().get_photo()
+        photo.delete()
+        photo.match_bumped = True
+        write_back.update(photo, ['match_bumped'], uuid__exists=True)
+        write_back.commit()
+        with self.assertRaises(DoesNotExist):
+            Photo.get(photo.gender_location, photo.uuid)
+
+        # Of two requests advancing the status at once, only the first to
+        # commit does.
+        write_backs = []
+        for x in xrange(2):
+            request_user = User.get(user.uuid)
+            request_write_back = model.WriteBack()
+            lock_tournament_status(request_user, request_write_back)
+            self.assertFalse(tournament_is_next(request_user,
+                                                request_write_back))
+            tournament_status_log_match(request_user, request_write_back)
+            write_backs.append(request_write_back)
+        for request_write_back in write_backs:
+            request_write_back.commit()
+        self.assertEqual([0, 1], [request_write_back.conditional_failures
+                                  for request_write_back in write_backs])
+        self.assertEqual(7, User.get(user.uuid).matches_until_next_tournament)
+
+        # A request whose user was read before the last request committed
+        # advances the status from where that left it.
+        stale = User.get(user.uuid)
+        latest = User.get(user.uuid)
+        self.assertFalse(tournament_is_next(latest))
+        tournament_status_log_match(latest)
+        self.assertEqual(6, User.get(user.uuid).matches_until_next_tournament)
+        request_write_back = model.WriteBack()
+        lock_tournament_status(stale, request_write_back)
+        self.assertFalse(tournament_is_next(stale, request_write_back))
+        tournament_status_log_match(stale, request_write_back)
+        request_write_back.commit()
+        self.assertEqual(0, request_write_back.conditional_failures)
+        self.assertEqual(5, User.get(user.uuid).matches_until_next_tournament)
+
+    def test_ranked_board(self):
+        import random
+        from time import sleep, time
+        from model import get_ttl_seconds, WriteBack
+        from logic import leaderboard, ranking
+        # The skip list agrees with a sorted list.
+        entries = ranking.RankedList()
+        expected = []
+        for x in xrange(500):
+            key = random.random()
+            entries.insert(key)
+            expected.append(key)
+        for key in random.sample(expected, 200):
+            entries.remove(key)
+            expected.remove(key)
+        expected.sort()
+        self.assertEqual(len(expected), len(entries))
+        self.assertListEqual(expected, [entries[i]
+                                        for i in xrange(len(entries))])
+        for key in expected[::17]:
+            self.assertEqual(expected.index(key), entries.rank(key))
+        self.assertListEqual(expected[100:150], entries.slice(100, 50))
+        self.assertListEqual(expected[-5:], entries.slice(len(expected) - 5,
+                                                          50))
+
+        # Boards are in leaderboard order, and a photo expires off them.
+        board = ranking.RankedBoard()
+        photo_uuids = [uuid1() for x in xrange(4)]
+        for photo_uuid, score, expires in zip(photo_uuids,
+                                              [1500.0, 1600.0, 1400.0, 1600.0],
+                                              [100, 200, 300, 400]):
+            board.put(photo_uuid, score, expires)
+        # The newer of two photos with the same score is first.
+        self.assertListEqual([photo_uuids[3], photo_uuids[1], photo_uuids[0],
+                              photo_uuids[2]], board.top(10))
+        self.assertListEqual([photo_uuids[0]], board.top(1, photo_uuids[1]))
+        self.assertEqual(2, board.rank(photo_uuids[0]))
+        board.put(photo_uuids[2], 1700.0, 300)
+        self.assertEqual(0, board.rank(photo_uuids[2]))
+        board.expire(200)
+        self.assertListEqual([photo_uuids[2], photo_uuids[3]], board.top(10))
+        self.assertIsNone(board.rank(photo_uuids[0]))
+        self.assertListEqual([], board.top(10, photo_uuids[0]))
+
+        # The engine loads a board from the Leaderboard table, and takes
+        # published updates from then on.
+        gender_location = 'f%s' % uuid1().hex
+        current = now()
+        write_back = WriteBack()
+        for photo_uuid, score in zip(photo_uuids[:2], [1500.0, 1600.0]):
+            leaderboard.put(write_back, gender_location, photo_uuid, current,
+                            score)
+        write_back.commit()
+        engine = ranking.RankingEngine()
+        try:
+            self.assertIsNone(engine.top('week', gender_location, 10))
+            deadline = time() + 10.0
+            while not engine.is_warm('week', gender_location) and \
+                  time() < deadline:
+                sleep(0.05)
+            self.assertListEqual(photo_uuids[1::-1],
+                                 engine.top('week', gender_location, 10))
+            record = ranking.encode_ranking(gender_location, photo_uuids[0],
+                                            current, 1700.0)
+            engine.apply(*ranking.decode_ranking(record))
+            self.assertListEqual(photo_uuids[:2],
+                                 engine.top('week', gender_location, 10))
+            self.assertEqual(1, engine.rank('week', gender_location,
+                                            photo_uuids[1]))
+            # Boards the engine hasn't loaded don't take updates.
+            engine.apply(gender_location, photo_uuids[2],
+                         get_ttl_seconds(current), 1800.0)
+            self.assertFalse(engine.is_warm('today', gender_location))
+        finally:
+            engine.stop()
+
+        # Followers poll no faster than the shard's reads allow them all.
+        followers = settings.LEADERBOARD_FOLLOWERS
+        try:
+            settings.LEADERBOARD_FOLLOWERS = 8
+            self.assertEqual(2.0, ranking.get_follow_interval())
+            settings.LEADERBOARD_FOLLOWERS = 1
+            self.assertEqual(0.25, ranking.get_follow_interval())
+        finally:
+            settings.LEADERBOARD_FOLLOWERS = followers
+
+        # An update is published once its rows are written, not before.
+        connection = get_kinesis()
+        connection.reset(settings.LEADERBOARD_STREAM)
+        def published():
+            return sum(len(records) for (stream, shard_id), records
+                       in connection.records.iteritems()
+                       if stream == settings.LEADERBOARD_STREAM)
+        write_back = WriteBack()
+        leaderboard.put(write_back, gender_location, photo_uuids[3], current,
+                        1900.0)
+        self.assertEqual(0, published())
+        write_back.commit()
+        self.assertEqual(1, published())
+
+    def test_stream_consumer_follow(self):
+        from threading import Thread
+        from time import sleep, time
+        from logic.kinesis import StreamConsumer
+        stream = 'test-stream-' + rand_string(8)
+        connection = get_kinesis()
+        consumer = StreamConsumer(stream, batch_size=100, linger=5.0,
+                                  period=0.3, max_duration=None, follow=True)
+        batches = []
+        def consume():
+            for batch in consumer:
+                batches.append(list(batch))
+                consumer.checkpoint(batch)
+        thread = Thread(target=consume)
+        thread.start()
+        try:
+            # A caught up consumer keeps reading, and yields a partial batch
+            # after period seconds even though linger is longer.
+            data = [uuid1().hex for x in xrange(5)]
+            for d in data:
+                connection.put_record(stream, d, d)
+            deadline = time() + 4.0
+            while sum(len(b) for b in batches) < 5 and time() < deadline:
+                sleep(0.1)
+            self.assertItemsEqual(data, [d for b in batches for d in b])
+            self.assertTrue(thread.is_alive())
+
+            # A throttled reader backs off and carries on.
+            connection.throttle_next = 3
+            more = [uuid1().hex for x in xrange(5)]
+            for d in more:
+                connection.put_record(stream, d, d)
+            deadline = time() + 8.0
+            while sum(len(b) for b in batches) < 10 and time() < deadline:
+                sleep(0.1)
+            self.assertEqual(0, connection.throttle_next)
+            self.assertItemsEqual(data + more,
+                                  [d for b in batches for d in b])
+        finally:
+            consumer.stop()
+            thread.join(5.0)
+        self.assertFalse(thread.is_alive())
+
+    def test_lease(self):
+        from time import sleep
+        from logic import lease
+        name = 'test-lease-' + rand_string(8)
+        self.assertIsNone(lease.get_holder(name))
+        self.assertTrue(lease.acquire(name, 'a'))
+        self.assertEqual('a', lease.get_holder(name))
+        self.assertFalse(lease.acquire(name, 'b'))
+        # The holder can renew.
+        self.assertTrue(lease.acquire(name, 'a'))
+        self.assertFalse(lease.release(name, 'b'))
+        self.assertTrue(lease.release(name, 'a'))
+        self.assertTrue(lease.acquire(name, 'b'))
+
+        # An expired lease can be taken, and its keeper finds out.
+        short = timedelta(seconds=0.3)
+        self.assertTrue(lease.acquire(name, 'b', short))
+        sleep(0.4)
+        self.assertIsNone(lease.get_holder(name))
+        lost = []
+        keeper = lease.LeaseKeeper(name, 'b', short,
+                                   on_lost=lambda: lost.append(True))
+        self.assertTrue(lease.acquire(name, 'c'))
+        keeper.start()
+        self.assertTrue(keeper.lost.wait(2.0))
+        keeper.stop()
+        self.assertEqual([True], lost)
+        self.assertEqual('c', lease.get_holder(name))
+
+    def test_kinesis_producer(self):
+        from logic.kinesis import get_all, Producer
+        stream = 'test-stream-' + rand_string(8)
+        connection = get_kinesis()
+        producer = Producer(connection, batch_size=8, linger=0.05)
+        # Some records are rejected, as if throttled, and are sent again.
+        connection.fail_next = 3
+        data = [uuid1().hex for x in xrange(20)]
+        for d in data:
+            producer.put(stream, d, d)
+        producer.flush()
+        self.assertEqual(0, connection.fail_next)
+        self.assertEqual(20, producer.sent_count)
+        self.assertEqual(0, producer.dropped_count)
+        self.assertItemsEqual(data, list(get_all(stream)))
+        producer.close()
+
+    def test_glicko2_rate_batch(self):
+        from logic.glicko2 import Glicko2, LOSS, WIN
+        from logic.score import TAU
+        env = Glicko2(tau=TAU)
+        player_count = 30
+        mus = [random.uniform(1300, 1700) for x in xrange(player_count)]
+        phis = [random.uniform(50, 350) for x in xrange(player_count)]
+        sigmas = [random.uniform(0.04, 0.08) for x in xrange(player_count)]
+        players = []
+        opponents = []
+        outcomes = []
+        # The last player never plays and should come back unchanged.
+        for x in xrange(200):
+            winner, loser = random.sample(xrange(player_count - 1), 2)
+            players.extend((winner, loser))
+            opponents.extend((loser, winner))
+            outcomes.extend((WIN, LOSS))
+
+        new_mus, new_phis, new_sigmas = env.rate_batch(
+            mus, phis, sigmas, players, opponents, outcomes)
+
+        for index in xrange(player_count):
+            series = [(outcome, env.create_rating(mus[opponent],
+                                                  phis[opponent],
+                                                  sigmas[opponent]))
+                      for player, opponent, outcome
+                      in zip(players, opponents, outcomes)
+                      if player == index]
+            if series:
+                rating = env.create_rating(mus[index], phis[index],
+                                           sigmas[index])
+                rated = env.rate(rating, series)
+            else:
+                rated = env.create_rating(mus[index], phis[index],
+                                          sigmas[index])
+            self.assertAlmostEqual(rated.mu, new_mus[index], places=9)
+            self.assertAlmostEqual(rated.phi, new_phis[index], places=9)
+            self.assertAlmostEqual(rated.sigma, new_sigmas[index], places=12)
+
+    def test_glicko2_rate_tuple(self):
+        from logic.glicko2 import Glicko2, LOSS, Rating, WIN
+        from logic.score import TAU
+        env = Glicko2(tau=TAU)
+        ratings = [(random.uniform(1300, 1700), random.uniform(50, 350),
+                    random.uniform(0.004, 0.08)) for x in xrange(10)]
+        prepared = {}
+        for rating in ratings:
+            series = [(random.choice([WIN, LOSS]), random.choice(ratings))
+                      for x in xrange(random.randint(1, 5))]
+            rated = env.rate(env.create_rating(*rating),
+                             [(outcome, env.create_rating(*other))
+                              for outcome, other in series])
+            # Exactly the same, with or without prepared opponents.
+            self.assertEqual((rated.mu, rated.phi, rated.sigma),
+                             env.rate_tuple(rating, series))
+            self.assertEqual((rated.mu, rated.phi, rated.sigma),
+                             env.rate_tuple(rating, series, prepared))
+        self.assertFalse(hasattr(Rating(), '__dict__'))
+
+    def test_predict_matches(self):
+        from logic import score
+        from logic.glicko2 import LOSS, WIN
+        photos = []
+        for x in xrange(8):
+            photo = Photo('f%s' % la_location.uuid.hex, uuid1())
+            photo.score = random.uniform(1300, 1700)
+            photo.phi = random.uniform(50, 350)
+            photo.sigma = random.uniform(0.004, 0.08)
+            photos.append(photo)
+        pairs = [random.sample(photos, 2) for x in xrange(12)]
+        predictions = score.predict_matches(pairs)
+        for (photo_a, photo_b), deltas in zip(pairs, predictions):
+            expected = (score.predict_photo(WIN, photo_a, photo_b),
+                        score.predict_photo(LOSS, photo_a, photo_b),
+                        score.predict_photo(WIN, photo_b, photo_a),
+                        score.predict_photo(LOSS, photo_b, photo_a))
+            for value, expected_value in zip(deltas, expected):
+                self.assertAlmostEqual(expected_value, value, places=9)
+
+        # The same ratings again come from the cache.
+        predict_sides = score._predict_sides
+        score._predict_sides = None
+        try:
+            self.assertEqual(predictions, score.predict_matches(pairs))
+        finally:
+            score._predict_sides = predict_sides
+
+        from logic.tournament import create_matches
+        user = create_user()
+        user.lat = la_geo.lat
+        user.lon = la_geo.lon
+        user.geodata = la_geo.meta
+        user.location = la_location.uuid
+        for (photo_a, photo_b), match, deltas in zip(
+                pairs, create_matches(pairs[:3], user), predictions):
+            match = Match.get((photo_a.uuid, photo_b.uuid), user.uuid)
+            self.assertEqual(deltas, (match.a_win_delta, match.a_lose_delta,
+                                      match.b_win_delta, match.b_lose_delta))
 
     # -- Following ------------------------------------------------------------
 
@@ -3,6 +3,7 @@ from __future__ import division, absolute_import, unicode_literals
 
 
 import heapq
+from itertools import islice
 from uuid import uuid1
 
 import model
@@ -26,12 +27,17 @@ def leaderboard_awards():
     # At the end of every week, #1 on the leaderboard earns a special award for their photo.  So do the runner-ups #2 and #3.
     # At the end of every week, #1 in each category earns a special award for their photo. So do the runner-ups #2 and #3.
     all_time_best = []
+    current_seconds = model.get_ttl_seconds(now())
 
     for category in CATEGORIES:
-        # Get the top 3 from the Week leaderboard for each category.
-        items = list(model.WeekLeaderboard.score_index.query(
-                    category, scan_index_forward=False, limit=4,
-                    consistent_read=False))
+        # Get the top 3 from the Week leaderboard for each category, passing
+        # over rows that expired but TTL hasn't deleted yet.
+        items = model.WeekLeaderboard.score_index.query(
+                    category, scan_index_forward=False,
+                    consistent_read=False)
+        items = list(islice((item for item in items
+                             if not model.is_leaderboard_expired(
+                                 item, current_seconds)), 4))
         for i, item in enumerate(items):
             if 3 == i:
                 break
@@ -0,0 +1,106 @@
+from __future__ import division, absolute_import, unicode_literals
+
+# Matches and local tournaments are made from the newest photos of a
+# gender_location. Each process keeps those for settings.MATCH_POOL_SECONDS
+# and shares them between requests, so a busy gender_location is read once
+# per refresh rather than once per request. One thread refreshes a pool,
+# the others serve the one it replaces meanwhile, or wait for the first.
+
+from datetime import timedelta
+from itertools import islice
+from threading import Event, Lock
+
+from log import log
+from logic.matchmaking import Matchmaker
+from model import newest_first, Photo, query_gender_location
+from settings import settings
+from util import now, took
+
+# The newest photos of a gender_location in a pool.
+POOL_SIZE = 200
+
+_pools = {}  # (gender_location, include_test) -> Pool
+_loading = {}  # (gender_location, include_test) -> Event
+_lock = Lock()
+
+
+class Pool(object):
+    """The newest copied photos of a gender_location.
+
+    Shared between requests, copy the lists before changing them.
+
+    """
+    def __init__(self, gender_location, loaded, photos, movies):
+        self.gender_location = gender_location
+        self.loaded = loaded
+        self.photos = photos  # media_type photo, newest first.
+        self.movies = movies  # media_type movie, newest first.
+        self.matchmakers = {
+            'photo': Matchmaker(photos),
+            'movie': Matchmaker(movies)
+        }
+
+    def __len__(self):
+        return len(self.photos) + len(self.movies)
+
+    def get_all(self):
+        """A new list of the photos and movies."""
+        return self.photos + self.movies
+
+
+def _load(gender_location, include_test):
+    start_time = now()
+    query = query_gender_location(Photo.post_date_index, gender_location,
+                                  newest_first, scan_index_forward=False,
+                                  copy_complete__eq=True,
+                                  consistent_read=False)
+    photos = []
+    movies = []
+    # Filtered here rather than with is_test__ne, as DynamoDB would filter
+    # them after reading them anyway.
+    for photo in islice((photo for photo in query
+                         if include_test or not photo.is_test),
+                        POOL_SIZE):
+        if not photo.copy_complete:
+            log.debug("copy_complete__eq not working, photos with copy_complete!=True in match-query results")
+            continue
+        if photo.media_type == 'movie':
+            movies.append(photo)
+        else:
+            photos.append(photo)
+    log.info("candidates load %s, %s" % (
+        gender_location, took(len(photos) + len(movies), 'photo',
+                              start_time)))
+    return Pool(gender_location, start_time, photos, movies)
+
+def get_pool(gender_location, include_test=False):
+    """The newest photos of gender_location to make matches from.
+
+    Without include_test, photos posted by tests are left out.
+
+    """
+    key = (gender_location, include_test)
+    duration = timedelta(seconds=settings.MATCH_POOL_SECONDS)
+    while True:
+        with _lock:
+            pool = _pools.get(key)
+            if pool is not None and now() - pool.loaded < duration:
+                return pool
+            event = _loading.get(key)
+            is_loader = event is None
+            if is_loader:
+                event = _loading[key] = Event()
+        if is_loader:
+            break
+        if pool is not None:
+            return pool
+        event.wait()
+    try:
+        pool = _load(gender_location, include_test)
+        with _lock:
+            _pools[key] = pool
+    finally:
+        with _lock:
+            del _loading[key]
+        event.set()
+    return pool
@@ -10,6 +10,8 @@
 """
 import math
 
+import numpy
+
 
 __version__ = '0.0.dev'
 
@@ -34,6 +36,8 @@ Q = math.log(10) / 400
 
 class Rating(object):
 
+    __slots__ = ('mu', 'phi', 'sigma')
+
     def __init__(self, mu=MU, phi=PHI, sigma=SIGMA):
         self.mu = mu
         self.phi = phi
@@ -84,27 +88,34 @@ class Glicko2(object):
 
     def determine_sigma(self, rating, difference, variance):
         """Determines new sigma."""
-        phi = rating.phi
+        return self._determine_sigma(rating.phi, rating.sigma, difference,
+                                     variance)
+
+    def _determine_sigma(self, phi, sigma, difference, variance):
         difference_squared = difference ** 2
+        phi_variance = phi ** 2 + variance
+        tau_squared = self.tau ** 2
         # 1. Let a = ln(s^2), and define f(x)
-        alpha = math.log(rating.sigma ** 2)
+        alpha = math.log(sigma ** 2)
         def f(x):
             """This function is twice the conditional log-posterior density of
             phi, and is the optimality criterion.
             """
-            tmp = phi ** 2 + variance + math.exp(x)
-            a = math.exp(x) * (difference_squared - tmp) / (2 * tmp ** 2)
-            b = (x - alpha) / (self.tau ** 2)
+            exp_x = math.exp(x)
+            tmp = phi_variance + exp_x
+            a = exp_x * (difference_squared - tmp) / (2 * tmp ** 2)
+            b = (x - alpha) / tau_squared
             return a - b
         # 2. Set the initial values of the iterative algorithm.
         a = alpha
-        if difference_squared > phi ** 2 + variance:
+        if difference_squared > phi_variance:
             b = math.log(difference_squared - phi ** 2 - variance)
         else:
+            step = math.sqrt(tau_squared)
             k = 1
-            while f(alpha - k * math.sqrt(self.tau ** 2)) < 0:
+            while f(alpha - k * step) < 0:
                 k += 1
-            b = alpha - k * math.sqrt(self.tau ** 2)
+            b = alpha - k * step
         # 3. Let fA = f(A) and f(B) = f(B)
         f_a, f_b = f(a), f(b)
         # 4. While |B-A| > e, carry out the following steps.
@@ -113,7 +124,8 @@ class Glicko2(object):
         #     fA <- fA/2.
         # (c) Set B <- C and fB <- fC.
         # (d) Stop if |B-A| <= e. Repeat the above three steps otherwise.
-        while abs(b - a) > self.epsilon:
+        epsilon = self.epsilon
+        while abs(b - a) > epsilon:
             c = a + (a - b) * f_a / (f_b - f_a)
             f_c = f(c)
             if f_c * f_b < 0:
@@ -125,9 +137,36 @@ class Glicko2(object):
         return math.exp(1) ** (a / 2)
 
     def rate(self, rating, series):
+        series = [(actual_score, (other_rating.mu, other_rating.phi,
+                                  other_rating.sigma))
+                  for actual_score, other_rating in series]
+        return self.create_rating(*self.rate_tuple(
+            (rating.mu, rating.phi, rating.sigma), series))
+
+    def prepare_opponent(self, rating, ratio=173.7178):
+        """An opponent's (mu, phi, sigma) as (scaled mu, impact).
+
+        The part of a game that depends only on the opponent, `rate_tuple`
+        takes it from `prepared` when it has seen the opponent before.
+        """
+        phi = rating[1] / ratio
+        return ((rating[0] - self.mu) / ratio,
+                1 / math.sqrt(1 + (3 * phi ** 2) / (math.pi ** 2)))
+
+    def rate_tuple(self, rating, series, prepared=None, ratio=173.7178):
+        """`rate` on (mu, phi, sigma) tuples, returns a tuple.
+
+        `series` is a list of (actual_score, (mu, phi, sigma)). `prepared`
+        maps an opponent's rating to `prepare_opponent`'s result, pass the
+        same dict when rating many players against the same opponents.
+        """
+        if prepared is None:
+            prepared = {}
         # Step 2. For each player, convert the rating and RD's onto the
         #         Glicko-2 scale.
-        rating = self.scale_down(rating)
+        mu = (rating[0] - self.mu) / ratio
+        phi = rating[1] / ratio
+        sigma = rating[2]
         # Step 3. Compute the quantity v. This is the estimated variance of the
         #         team's/player's rating based only on game outcomes.
         # Step 4. Compute the quantity difference, the estimated improvement in
@@ -137,9 +176,12 @@ class Glicko2(object):
         variance_inv = 0
         difference = 0
         for actual_score, other_rating in series:
-            other_rating = self.scale_down(other_rating)
-            impact = self.reduce_impact(other_rating)
-            expected_score = self.expect_score(rating, other_rating, impact)
+            try:
+                other_mu, impact = prepared[other_rating]
+            except KeyError:
+                other_mu, impact = prepared[other_rating] = \
+                    self.prepare_opponent(other_rating, ratio)
+            expected_score = 1. / (1 + math.exp(-impact * (mu - other_mu)))
             variance_inv += impact ** 2 * expected_score * (1 - expected_score)
             difference += impact * (actual_score - expected_score)
             d_square_inv += (
@@ -147,20 +189,138 @@ class Glicko2(object):
                 (Q ** 2) * (impact ** 2))
         difference /= variance_inv
         variance = 1. / variance_inv
-        denom = rating.phi ** -2 + d_square_inv
-        mu = rating.mu + Q / denom * (difference / variance_inv)
-        phi = math.sqrt(1 / denom)
+        denom = phi ** -2 + d_square_inv
+        pre_phi = math.sqrt(1 / denom)
         # Step 5. Determine the new value, Sigma', ot the sigma. This
         #         computation requires iteration.
-        sigma = self.determine_sigma(rating, difference, variance)
+        sigma = self._determine_sigma(phi, sigma, difference, variance)
         # Step 6. Update the rating deviation to the new pre-rating period
         #         value, Phi*.
-        phi_star = math.sqrt(phi ** 2 + sigma ** 2)
+        phi_star = math.sqrt(pre_phi ** 2 + sigma ** 2)
         # Step 7. Update the rating and RD to the new values, Mu' and Phi'.
         phi = 1 / math.sqrt(1 / phi_star ** 2 + 1 / variance)
-        mu = rating.mu + phi ** 2 * (difference / variance)
+        mu = mu + phi ** 2 * (difference / variance)
+        # Step 8. Convert ratings and RD's back to original scale.
+        return (mu * ratio + self.mu, phi * ratio, sigma)
+
+    def determine_sigma_batch(self, phi, sigma, difference, variance):
+        """Determines new sigmas, the vectorized form of `determine_sigma`.
+
+        Every argument is an array on the Glicko-2 scale. Each element runs
+        the same Illinois iteration as the scalar form; elements that have
+        converged drop out of the working set while the rest continue.
+        """
+        difference_squared = difference ** 2
+        phi_squared = phi ** 2
+        phi_variance = phi_squared + variance
+        alpha = numpy.log(sigma ** 2)
+        tau_squared = self.tau ** 2
+        def f(x, i):
+            """`f` from `determine_sigma` over the elements in index `i`."""
+            tmp = phi_variance[i] + numpy.exp(x)
+            a = numpy.exp(x) * (difference_squared[i] - tmp) / (2 * tmp ** 2)
+            b = (x - alpha[i]) / tau_squared
+            return a - b
+        # 2. Set the initial values of the iterative algorithm.
+        a = alpha.copy()
+        b = numpy.empty_like(alpha)
+        large = difference_squared > phi_variance
+        b[large] = numpy.log(difference_squared[large] - phi_squared[large] -
+                             variance[large])
+        step = math.sqrt(tau_squared)
+        k = numpy.ones_like(alpha)
+        pending = numpy.flatnonzero(~large)
+        while len(pending):
+            below = f(alpha[pending] - k[pending] * step, pending) < 0
+            k[pending[below]] += 1
+            pending = pending[below]
+        small = ~large
+        b[small] = alpha[small] - k[small] * step
+        # 3. Let fA = f(A) and f(B) = f(B)
+        everyone = numpy.arange(len(alpha))
+        f_a, f_b = f(a, everyone), f(b, everyone)
+        # 4. Iterate every element still wider than epsilon, see
+        #    `determine_sigma` for the steps.
+        active = numpy.flatnonzero(numpy.abs(b - a) > self.epsilon)
+        while len(active):
+            a_i, b_i = a[active], b[active]
+            f_a_i, f_b_i = f_a[active], f_b[active]
+            c = a_i + (a_i - b_i) * f_a_i / (f_b_i - f_a_i)
+            f_c = f(c, active)
+            flip = f_c * f_b_i < 0
+            a_i = numpy.where(flip, b_i, a_i)
+            f_a[active] = numpy.where(flip, f_b_i, f_a_i / 2)
+            a[active] = a_i
+            b[active], f_b[active] = c, f_c
+            active = active[numpy.abs(c - a_i) > self.epsilon]
+        # 5. Once |B-A| <= e, set s' <- e^(A/2)
+        return math.exp(1) ** (a / 2)
+
+    def rate_batch(self, mu, phi, sigma, player, opponent, actual_score,
+                   ratio=173.7178):
+        """Rate many players in one rating period.
+
+        `mu`, `phi` and `sigma` are arrays of every player's rating before
+        the period. `player`, `opponent` and `actual_score` are a flat
+        table of games, one row per game as seen by `player`; `player` and
+        `opponent` index into the rating arrays. Returns arrays of new
+        (mu, phi, sigma). As with `rate`, a player's series is taken in the
+        order its rows appear, and players without a game are returned
+        unchanged.
+        """
+        mu = numpy.asarray(mu, dtype=numpy.float64)
+        phi = numpy.asarray(phi, dtype=numpy.float64)
+        sigma = numpy.asarray(sigma, dtype=numpy.float64)
+        player = numpy.asarray(player, dtype=numpy.intp)
+        opponent = numpy.asarray(opponent, dtype=numpy.intp)
+        actual_score = numpy.asarray(actual_score, dtype=numpy.float64)
+        count = len(mu)
+        if not len(player):
+            return mu.copy(), phi.copy(), sigma.copy()
+        # Step 2. Convert the ratings and RD's onto the Glicko-2 scale.
+        scaled_mu = (mu - self.mu) / ratio
+        scaled_phi = phi / ratio
+        # Step 3 and 4, see `rate`. bincount sums each player's games in
+        # table order, the same order the scalar loop adds them.
+        # g(phi) once per player, then looked up for each game it is the
+        # opponent in.
+        impact = (1 / numpy.sqrt(
+            1 + (3 * scaled_phi ** 2) / (math.pi ** 2)))[opponent]
+        expected_score = 1. / (1 + numpy.exp(
+            -impact * (scaled_mu[player] - scaled_mu[opponent])))
+        variance_inv = numpy.bincount(
+            player, weights=impact ** 2 * expected_score * (1 - expected_score),
+            minlength=count)
+        difference = numpy.bincount(
+            player, weights=impact * (actual_score - expected_score),
+            minlength=count)
+        d_square_inv = numpy.bincount(
+            player, weights=(expected_score * (1 - expected_score) *
+                             (Q ** 2) * (impact ** 2)),
+            minlength=count)
+        rated = numpy.flatnonzero(numpy.bincount(player, minlength=count))
+        variance_inv = variance_inv[rated]
+        difference = difference[rated] / variance_inv
+        variance = 1. / variance_inv
+        rated_mu = scaled_mu[rated]
+        rated_phi = scaled_phi[rated]
+        denom = rated_phi ** -2 + d_square_inv[rated]
+        pre_phi = numpy.sqrt(1 / denom)
+        # Step 5. Determine the new value, Sigma'.
+        new_sigma = self.determine_sigma_batch(rated_phi, sigma[rated],
+                                               difference, variance)
+        # Step 6. Update the rating deviation to the new pre-rating period
+        #         value, Phi*.
+        phi_star = numpy.sqrt(pre_phi ** 2 + new_sigma ** 2)
+        # Step 7. Update the rating and RD to the new values, Mu' and Phi'.
+        new_phi = 1 / numpy.sqrt(1 / phi_star ** 2 + 1 / variance)
+        new_mu = rated_mu + new_phi ** 2 * (difference / variance)
         # Step 8. Convert ratings and RD's back to original scale.
-        return self.scale_up(self.create_rating(mu, phi, sigma))
+        mu, phi, sigma = mu.copy(), phi.copy(), sigma.copy()
+        mu[rated] = new_mu * ratio + self.mu
+        phi[rated] = new_phi * ratio
+        sigma[rated] = new_sigma
+        return mu, phi, sigma
 
     def rate_1vs1(self, rating1, rating2, drawn=False):
         return (self.rate(rating1, [(DRAW if drawn else WIN, rating2)]),
@@ -0,0 +1,165 @@
+from __future__ import division, absolute_import, unicode_literals
+
+# Matchmaking skips pairs of photos a user has already been shown. Rather
+# than read Match for every pair it tries, each process keeps a Bloom filter
+# of the pairs of a user's Matches, built from Match.user_index the first
+# time the user asks for matches. A pair the filter hasn't seen is new, so
+# only a pair it might have seen is read from Match to be sure.
+#
+# Each request first reads the user's Matches proposed since the filter was
+# last brought up to date, from any process, usually a few. Filters are
+# dropped least recently used past MAX_USERS.
+
+from collections import OrderedDict
+from datetime import timedelta
+from hashlib import md5
+import math
+import struct
+from threading import Lock
+
+from pynamodb.exceptions import DoesNotExist
+
+from log import log
+from model import Match
+from util import now, took
+
+# False positive rate of a filter, each one costs a Match read.
+FALSE_POSITIVE_RATE = 0.01
+# Pairs a new filter has room for, it grows as the user judges more.
+MIN_CAPACITY = 1024
+# Users with a filter in this process.
+MAX_USERS = 10000
+# How late a Match can reach Match.user_index and still be read.
+INDEX_LAG = timedelta(minutes=1)
+
+_HASHES = struct.Struct(b'<QQ')
+
+_filters = OrderedDict()  # user_uuid -> JudgedFilter
+_lock = Lock()
+
+
+class BloomFilter(object):
+    """Set membership without false negatives, in about 10 bits an item.
+
+    Its bits and hashes are sized for capacity items at
+    FALSE_POSITIVE_RATE.
+
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.size = int(math.ceil(-capacity * math.log(FALSE_POSITIVE_RATE) /
+                                  math.log(2) ** 2))
+        self.hash_count = max(1, int(round(self.size / capacity *
+                                           math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _get_positions(self, key):
+        # Double hashing, every position from the two halves of one md5.
+        h1, h2 = _HASHES.unpack(md5(key).digest())
+        return ((h1 + i * h2) % self.size for i in xrange(self.hash_count))
+
+    def add(self, key):
+        for position in self._get_positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._get_positions(key))
+
+
+def get_pair_key(photo_a_uuid, photo_b_uuid):
+    """A pair's filter key, the same in either order."""
+    if photo_a_uuid.hex > photo_b_uuid.hex:
+        photo_a_uuid, photo_b_uuid = photo_b_uuid, photo_a_uuid
+    return photo_a_uuid.bytes + photo_b_uuid.bytes
+
+
+class JudgedFilter(object):
+    """The pairs of one user's Matches, up to the Matches proposed before
+    updated."""
+    def __init__(self, user_uuid):
+        self.user_uuid = user_uuid
+        self.updated = None
+        self.keys = BloomFilter(MIN_CAPACITY)
+        self.lock = Lock()
+
+    def _read(self, since):
+        kwargs = {'consistent_read': False}
+        if since is not None:
+            kwargs['proposed_date__ge'] = since
+        return [get_pair_key(*match.photo_uuids)
+                for match in Match.user_index.query(self.user_uuid,
+                                                    **kwargs)]
+
+    def update(self):
+        """Add the pairs of the Matches proposed since the last update, or
+        every Match on the first."""
+        start_time = now()
+        with self.lock:
+            if self.updated is None:
+                keys = self._read(None)
+                self.keys = BloomFilter(max(MIN_CAPACITY, len(keys) * 2))
+            else:
+                # Matches from other processes reach the index a little
+                # late, the ones already added are passed over.
+                keys = [key for key in self._read(self.updated - INDEX_LAG)
+                        if key not in self.keys]
+            if self.keys.count + len(keys) > self.keys.capacity:
+                # Full, start over with twice the room.
+                keys = self._read(None)
+                self.keys = BloomFilter(max(self.keys.capacity * 2,
+                                            len(keys) * 2))
+                log.info("judged %s grown to %s" % (self.user_uuid.hex,
+                                                    self.keys.capacity))
+            for key in keys:
+                self.keys.add(key)
+            self.updated = start_time
+        if keys:
+            log.debug("judged %s, %s" % (self.user_uuid.hex,
+                                         took(len(keys), 'pair', start_time)))
+
+    def add(self, photo_a_uuid, photo_b_uuid):
+        with self.lock:
+            self.keys.add(get_pair_key(photo_a_uuid, photo_b_uuid))
+
+    def has_judged(self, photo_a_uuid, photo_b_uuid):
+        """True if the user has a Match of the pair, from the filter when it
+        is sure, or from Match."""
+        with self.lock:
+            maybe = get_pair_key(photo_a_uuid, photo_b_uuid) in self.keys
+        if not maybe:
+            return False
+        if photo_a_uuid.hex > photo_b_uuid.hex:
+            photo_a_uuid, photo_b_uuid = photo_b_uuid, photo_a_uuid
+        try:
+            Match.get((photo_a_uuid, photo_b_uuid), self.user_uuid,
+                      consistent_read=False)
+        except DoesNotExist:
+            return False
+        return True
+
+
+def get_filter(user_uuid):
+    """The user's JudgedFilter, brought up to date."""
+    with _lock:
+        judged = _filters.pop(user_uuid, None)
+        if judged is None:
+            judged = JudgedFilter(user_uuid)
+        _filters[user_uuid] = judged
+        while len(_filters) > MAX_USERS:
+            _filters.popitem(last=False)
+    judged.update()
+    return judged
+
+def add(user_uuid, photo_a_uuid, photo_b_uuid):
+    """Note a new Match in this process' filter of the user, if it has one."""
+    with _lock:
+        judged = _filters.get(user_uuid)
+    if judged is not None:
+        judged.add(photo_a_uuid, photo_b_uuid)
+
+def clear():
+    with _lock:
+        _filters.clear()
@@ -1,8 +1,14 @@
 from __future__ import division, absolute_import, unicode_literals
 
 
+import atexit
 from datetime import timedelta
-from time import sleep
+from hashlib import md5
+import os
+import random
+from Queue import Empty, Full, Queue
+from threading import Event, Thread
+from time import sleep, time
 
 import boto
 import boto.kinesis
@@ -12,13 +18,21 @@ from botocore.vendored.requests.exceptions import ConnectionError
 from pynamodb.models import DoesNotExist
 
 from log import log
-from model import ShardIterator
+from model import backoff_sleep, ShardIterator
 from logic import sentry
+from logic.stats import gauge, incr
 from settings import settings
 from util import now
 
 
 CONNECTION = None
+# Kinesis allows 5 GetRecords calls per second per shard, across every
+# consumer of the stream.
+GET_RECORDS_INTERVAL = 0.2
+# A following consumer that is caught up polls less often.
+FOLLOW_INTERVAL = 1.0
+# Most seconds a throttled reader backs off before trying again.
+MAX_THROTTLE_WAIT = 10.0
 
 def setup_connection():
     global CONNECTION
@@ -33,173 +47,552 @@ def get_kinesis():
         setup_connection()
     return CONNECTION
 
+def new_connection():
+    """A connection of its own, for use on another thread."""
+    if settings.KINESIS_ENABLED:
+        return boto.kinesis.connect_to_region('us-west-2')
+    return get_kinesis()
+
+
+# Kinesis maps the md5 of a record's partition key into the shards' hash key
+# ranges, which together cover 0 to 2 ** 128 - 1.
+HASH_KEY_SPACE = 2 ** 128
+MOCK_SHARD_COUNT = 4
 
 class MockKinesis(object):
-    def __init__(self):
-        self.records = {}
+    def __init__(self, shard_count=MOCK_SHARD_COUNT, describe_limit=100):
+        self.shard_count = shard_count
+        # Most shards describe_stream returns at once, to exercise paging.
+        self.describe_limit = describe_limit
+        self.records = {}  # (stream, shard_id) -> records
         self.shard_iterators = {}
+        # put_records fails this many records, as if throttled.
+        self.fail_next = 0
+        # get_records fails this many calls, as if throttled.
+        self.throttle_next = 0
 
     n = 49550782119036890694910890427288626268549652974252589058
     def put_record(self, stream, data, partition_key):
         log.info('kinesis put_record is MOCK')
+        self.n += 1
+        shard_id = self.get_shard_id(partition_key)
         record = {u'PartitionKey': partition_key,
                   u'Data': data,
                   u'SequenceNumber': str(self.n)}
-        if stream not in self.records:
-            self.records[stream] = []
-        self.records[stream].append(record)
+        key = (stream, shard_id)
+        if key not in self.records:
+            self.records[key] = []
+        self.records[key].append(record)
+        return {u'ShardId': shard_id, u'SequenceNumber': str(self.n)}
+
+    def put_records(self, records, stream_name, b64_encode=True):
+        log.info('kinesis put_records is MOCK')
+        results = []
+        for record in records:
+            if self.fail_next:
+                self.fail_next -= 1
+                results.append({
+                    u'ErrorCode': u'ProvisionedThroughputExceededException',
+                    u'ErrorMessage': u'Rate exceeded (MOCK)'})
+                continue
+            results.append(self.put_record(stream_name, record['Data'],
+                                           record['PartitionKey']))
+        return {u'FailedRecordCount': len([r for r in results
+                                           if u'ErrorCode' in r]),
+                u'Records': results}
 
     def reset(self, stream):
-        try:
-            del self.records[stream]
-        except KeyError:
-            pass
+        for key in self.records.keys():
+            if key[0] == stream:
+                del self.records[key]
+
+    def make_shard_id(self, index):
+        return u'shardId-%012d' % index
 
-    def describe_stream(self, stream):
+    def get_shard_id(self, partition_key):
+        hash_key = int(md5(partition_key.encode('utf-8')).hexdigest(), 16)
+        return self.make_shard_id(hash_key * self.shard_count //
+                                  HASH_KEY_SPACE)
+
+    def describe_stream(self, stream, limit=None,
+                        exclusive_start_shard_id=None):
+        shards = []
+        for index in xrange(self.shard_count):
+            start = HASH_KEY_SPACE * index // self.shard_count
+            end = HASH_KEY_SPACE * (index + 1) // self.shard_count - 1
+            shards.append({
+                u'HashKeyRange': {
+                    u'EndingHashKey': unicode(end),
+                    u'StartingHashKey': unicode(start)
+                },
+                u'ShardId': self.make_shard_id(index),
+                u'SequenceNumberRange': {
+                    u'StartingSequenceNumber': u'49550782119036890694910889893090902948876102227749502978'
+                }})
+        if exclusive_start_shard_id is not None:
+            while shards and shards[0][u'ShardId'] <= exclusive_start_shard_id:
+                shards.pop(0)
+        limit = min(limit or self.describe_limit, self.describe_limit)
         return {
 u'StreamDescription': {
-    u'HasMoreShards': False,
+    u'HasMoreShards': len(shards) > limit,
     u'StreamStatus': u'ACTIVE',
     u'StreamName': stream,
     u'StreamARN': u'arn:aws:kinesis:us-west-2:000841753196:stream/{}'.format(stream),
-    u'Shards': [
-        {u'HashKeyRange': {
-            u'EndingHashKey': u'340282366920938463463374607431768211455',
-            u'StartingHashKey': u'0'
-        },
-        u'ShardId': u'shardId-000000000000',
-        u'SequenceNumberRange': {
-            u'StartingSequenceNumber': u'49550782119036890694910889893090902948876102227749502978'
-}}]}}
+    u'Shards': shards[:limit]}}
 
     def get_shard_iterator(self, stream, shard_id, shard_iterator_type, starting_sequence_number=None):
         shard_iterator = 'sharditer-%s-%s-%s' % (stream, shard_id,
                                                  shard_iterator_type)
-        self.shard_iterators[shard_iterator] = stream
+        self.shard_iterators[shard_iterator] = (stream, shard_id)
         return {'ShardIterator': shard_iterator}
 
     def get_records(self, shard_iterator):
-        stream = self.shard_iterators[shard_iterator]
+        if self.throttle_next:
+            self.throttle_next -= 1
+            raise ProvisionedThroughputExceededException(
+                400, 'Rate exceeded (MOCK)')
+        key = self.shard_iterators[shard_iterator]
         try:
-            records = self.records[stream]
+            records = self.records[key]
         except KeyError:
             records = []
-        self.records[stream] = []
-        return {u'Records': records, u'NextShardIterator': shard_iterator}
+        self.records[key] = []
+        return {u'Records': records, u'NextShardIterator': shard_iterator,
+                u'MillisBehindLatest': 0}
 
-def get_all(stream):
-    """Iterator that gets all the messages pending on a given stream."""
-    try:
-        log.info("kinesis get_all(stream=%s)", stream)
-        connection = get_kinesis()
-
-        count = 0
-        response = connection.describe_stream(stream)
-        if response['StreamDescription']['StreamStatus'] != 'ACTIVE':
-            log.error("Stream '{}' not active, get_all abort.".format(stream))
+def get_shards(connection, stream):
+    """Return the stream's description and all of its shards.
+
+    describe_stream returns the shards a page at a time, this follows
+    HasMoreShards to the end.
+
+    """
+    response = connection.describe_stream(stream)
+    description = response['StreamDescription']
+    shards = list(description['Shards'])
+    while response['StreamDescription']['HasMoreShards'] and shards:
+        response = connection.describe_stream(
+            stream, exclusive_start_shard_id=shards[-1]['ShardId'])
+        shards.extend(response['StreamDescription']['Shards'])
+    return description, shards
+
+def get_start_iterator(connection, stream, shard_id):
+    """Get a shard iterator just after the shard's last checkpoint.
+
+    Starts at TRIM_HORIZON if the shard has never been checkpointed.
+
+    """
+    stream_and_shard_id = '%s%s' % (stream, shard_id)
+    # Do we already have a record for this?
+    for i in range(10):
+        log.info("getting ShardIterator")
+        try:
+            shard_iter = ShardIterator.get(stream_and_shard_id,
+                                           consistent_read=False)
+            break
+        except ConnectionError:
+            log.warn("Got ConnectionError getting ShardIterator")
+            sleep(i)
+        except DoesNotExist:
+            log.info("Creating ShardIterator")
+            shard_iter = ShardIterator(stream_and_shard_id)
+            log.info("saving ShardIterator")
+            shard_iter.save()
+            log.info("sleeping {}".format(i))
+            sleep(i)
+    else:
+        log.error("Could not find or create ShardIterator %s",
+                     stream_and_shard_id)
+        return None
+    log.info("getting sequence number")
+    sequence_number = shard_iter.sequence_number
+    log.info("sequence number {}".format(sequence_number))
+    if sequence_number:
+        # We got this error after some early Terraform work:
+        # InvalidArgumentException: InvalidArgumentException: 400
+        # Bad Request
+        # StartingSequenceNumber 49561732024706981605478962100984641178096952071497449474
+        #     used in GetShardIterator on shard shardId-000000000000
+        #     in stream LocalPicTourney-dev-kinesis-stream under account
+        #     000841753196 is invalid because it did not come from
+        #     this stream.'
+        # I'm assuming it is a terraform related issue, where
+        # the sequence number we are keeping is from another
+        # deploy. So, when this happens we will log the issue and
+        # reset.
+        try:
+            response = connection.get_shard_iterator(
+                    stream, shard_id, 'AFTER_SEQUENCE_NUMBER',
+                    sequence_number)
+        except InvalidArgumentException as ex:
+            log.info('--debug-- in InvalidArgumentException, kinesis.py')
+            log.exception(ex)
+            msg_fragment = 'invalid because it did not come from this stream.'
+            if msg_fragment in ex.message:
+                msg = 'kinesis.py attempting to get shard iterator, had error. Resetting shard iterator.'
+                log.warn(msg)
+                sentry.get_client().captureMessage(msg)
+            shard_iter.sequence_number = None
+            shard_iter.save()
+            response = connection.get_shard_iterator(stream,
+                                                        shard_id,
+                                                        'TRIM_HORIZON')
+    else:
+        response = connection.get_shard_iterator(stream,
+                                                    shard_id,
+                                                    'TRIM_HORIZON')
+    return response['ShardIterator']
+
+
+class Batch(list):
+    """A micro-batch of record data from a StreamConsumer.
+
+    positions maps shard_id to the sequence number of the last record read
+    from that shard, up to and including this batch. Checkpointing a batch
+    checkpoints everything before it too.
+
+    """
+    def __init__(self, *args):
+        super(Batch, self).__init__(*args)
+        self.positions = {}
+        self.started = None
+
+
+class StreamConsumer(object):
+    """Reads every shard of a stream at once and yields micro-batches.
+
+    Each shard is read on its own thread, at most one GetRecords call per
+    interval seconds, GET_RECORDS_INTERVAL unless other consumers share the
+    shards' reads. A throttled reader backs off exponentially. Records go through a bounded queue, so readers
+    wait when the caller falls behind. Iterating yields Batches of at most
+    batch_size records. A partial batch is yielded when no records arrive
+    for linger seconds, or once its first record is period seconds old.
+    Iteration ends when every shard is caught up or closed, or after
+    max_duration. A consumer made with follow=True doesn't stop when it is
+    caught up, it keeps polling until stop() is called.
+
+    Nothing is checkpointed until the caller says so:
+
+        consumer = StreamConsumer(stream)
+        for batch in consumer:
+            process(batch)
+            consumer.checkpoint(batch)
+
+    A crash replays only what came after the last checkpointed batch.
+    Per-shard lag (MillisBehindLatest) is kept in `lag` and sent to stats.
+
+    A consumer made with latest=True starts at the tip of each shard
+    instead, for a process that only wants what happens from now on. It
+    doesn't checkpoint.
+
+    """
+    def __init__(self, stream, batch_size=500, linger=1.0,
+                 max_duration=timedelta(minutes=3), queue_size=20,
+                 period=None, follow=False, latest=False,
+                 interval=GET_RECORDS_INTERVAL):
+        self.stream = stream
+        self.interval = interval
+        self.batch_size = batch_size
+        self.linger = linger
+        self.period = period
+        self.max_duration = max_duration
+        self.follow = follow
+        self.latest = latest
+        self.queue = Queue(maxsize=queue_size)
+        self.lag = {}  # shard_id -> MillisBehindLatest
+        self.count = 0
+        self._positions = {}  # shard_id -> last sequence number read
+        self._checkpoints = {}  # shard_id -> last sequence number saved
+        self._stopping = Event()
+        self._readers = []
+
+    def __iter__(self):
+        description, shards = get_shards(get_kinesis(), self.stream)
+        if description['StreamStatus'] != 'ACTIVE':
+            log.error("Stream '{}' not active, consumer abort.".format(
+                self.stream))
             return
-        else:
-            shards = response['StreamDescription']['Shards']
-            log.info("{} shard count {}".format(stream, len(shards)))
-            for shard in shards:
-                shard_id = shard['ShardId']
-                stream_and_shard_id = '%s%s' % (stream, shard_id)
-                log.info("get_all reading %s", stream_and_shard_id)
-                # Do we already have a record for this?
-                for i in range(10):
-                    log.info("getting ShardIterator")
-                    try:
-                        shard_iter = ShardIterator.get(stream_and_shard_id,
-                                                       consistent_read=False)
-                        break
-                    except ConnectionError:
-                        log.warn("Got ConnectionError getting ShardIterator")
-                        sleep(i)
-                    except DoesNotExist:
-                        log.info("Creating ShardIterator")
-                        shard_iter = ShardIterator(stream_and_shard_id)
-                        log.info("saving ShardIterator")
-                        shard_iter.save()
-                        log.info("sleeping {}".format(i))
-                        sleep(i)
-                else:
-                    log.error("Could not find or create ShardIterator %s",
-                                 stream_and_shard_id)
+        log.info("{} shard count {}".format(self.stream, len(shards)))
+        self._start = now()
+        self._stopping.clear()
+        self._readers = []
+        for shard in shards:
+            reader = Thread(target=self._read_shard, args=(shard['ShardId'],),
+                            name='%s-%s' % (self.stream, shard['ShardId']))
+            reader.daemon = True
+            reader.start()
+            self._readers.append(reader)
+        running = len(self._readers)
+        batch = Batch()
+        try:
+            while running and not self._stopping.is_set():
+                try:
+                    kind, shard_id, value = self.queue.get(
+                        timeout=self._timeout(batch))
+                except Empty:
+                    if batch:
+                        yield self._seal(batch)
+                        batch = Batch()
                     continue
-                log.info("getting sequence number")
-                sequence_number = shard_iter.sequence_number
-                log.info("sequence number {}".format(sequence_number))
-                if sequence_number:
-                    # We got this error after some early Terraform work:
-                    # InvalidArgumentException: InvalidArgumentException: 400
-                    # Bad Request
-                    # StartingSequenceNumber 49561732024706981605478962100984641178096952071497449474
-                    #     used in GetShardIterator on shard shardId-000000000000
-                    #     in stream LocalPicTourney-dev-kinesis-stream under account
-                    #     000841753196 is invalid because it did not come from
-                    #     this stream.'
-                    # I'm assuming it is a terraform related issue, where
-                    # the sequence number we are keeping is from another
-                    # deploy. So, when this happens we will log the issue and
-                    # reset.
-                    try:
-                        response = connection.get_shard_iterator(
-                                stream, shard_id, 'AFTER_SEQUENCE_NUMBER',
-                                sequence_number)
-                    except InvalidArgumentException as ex:
-                        log.info('--debug-- in InvalidArgumentException, kinesis.py')
-                        log.exception(ex)
-                        msg_fragment = 'invalid because it did not come from this stream.'
-                        if msg_fragment in ex.message:
-                            msg = 'kinesis.py attempting to get shard iterator, had error. Resetting shard iterator.'
-                            log.warn(msg)
-                            sentry.get_client().captureMessage(msg)
-                        shard_iter.sequence_number = None
-                        shard_iter.save()
-                        response = connection.get_shard_iterator(stream,
-                                                                    shard_id,
-                                                                    'TRIM_HORIZON')
+                if kind == 'records':
+                    for record in value:
+                        if not batch:
+                            batch.started = time()
+                        batch.append(record['Data'])
+                        self._positions[shard_id] = record['SequenceNumber']
+                        if len(batch) >= self.batch_size:
+                            yield self._seal(batch)
+                            batch = Batch()
+                elif kind == 'done':
+                    running -= 1
                 else:
-                    response = connection.get_shard_iterator(stream,
-                                                                shard_id,
-                                                                'TRIM_HORIZON')
-
-                shard_iterator = response['ShardIterator']
-                log.info("shard iterator {}".format(shard_iterator))
-
-                start = now()
-                flag = True
-                while flag:
-                    try:
-                        response = connection.get_records(shard_iterator)
-                    except ProvisionedThroughputExceededException:
-                        log.warn('kinesis get_records ProvisionThroughputExceededException, skipping')
-                        sleep(1.0)
-                        continue
-                    shard_iterator = response['NextShardIterator']
-                    records = response['Records']
-                    if not records:
-                        flag = False
-                        continue
-                    for record in records:
-                        data = record['Data']
-                        sequence_number = record['SequenceNumber']
-                        yield data
-                        count += 1
-                    if now() - start > timedelta(minutes=3):
-                        flag = False
-                shard_iter.sequence_number = sequence_number
-                shard_iter.save()
-
-        log.info("get_all complete with count %s", count)
-        return
-    except Exception as e:
-        log.error("get_all had Exception %s", e)
-        log.exception(e)
-        raise
+                    raise value
+            if batch:
+                yield self._seal(batch)
+        finally:
+            self.stop()
+        log.info("StreamConsumer %s complete with count %s", self.stream,
+                 self.count)
+
+    def _timeout(self, batch):
+        if self.period is None or not batch:
+            return self.linger
+        return max(0, min(self.linger, batch.started + self.period - time()))
+
+    def _seal(self, batch):
+        batch.positions = dict(self._positions)
+        self.count += len(batch)
+        return batch
+
+    def checkpoint(self, batch):
+        """Save the shard positions of batch, the caller is done with it."""
+        for shard_id, sequence_number in batch.positions.iteritems():
+            if self._checkpoints.get(shard_id) == sequence_number:
+                continue
+            ShardIterator('%s%s' % (self.stream, shard_id),
+                          sequence_number=sequence_number).save()
+            self._checkpoints[shard_id] = sequence_number
+
+    def stop(self):
+        self._stopping.set()
+        for reader in self._readers:
+            reader.join()
+        self._readers = []
+
+    def _put(self, item):
+        while not self._stopping.is_set():
+            try:
+                self.queue.put(item, timeout=0.5)
+                return
+            except Full:
+                pass
+
+    def _read_shard(self, shard_id):
+        try:
+            connection = new_connection()
+            if self.latest:
+                shard_iterator = connection.get_shard_iterator(
+                    self.stream, shard_id, 'LATEST')['ShardIterator']
+            else:
+                shard_iterator = get_start_iterator(connection, self.stream,
+                                                    shard_id)
+            last_call = None
+            throttles = 0
+            while shard_iterator and not self._stopping.is_set():
+                if self.max_duration is not None and \
+                   now() - self._start > self.max_duration:
+                    log.info("StreamConsumer %s%s hit max duration",
+                             self.stream, shard_id)
+                    break
+                if last_call is not None:
+                    wait = self.interval - (time() - last_call)
+                    if wait > 0:
+                        sleep(wait)
+                last_call = time()
+                try:
+                    response = connection.get_records(shard_iterator)
+                except ProvisionedThroughputExceededException:
+                    log.warn('kinesis get_records ProvisionThroughputExceededException, %s', shard_id)
+                    incr('kinesis.{}.throttled-incr'.format(self.stream))
+                    # Others are reading the shard too, back off with
+                    # jitter so the readers spread out.
+                    throttles += 1
+                    wait = min(MAX_THROTTLE_WAIT,
+                               self.interval * 2 ** throttles)
+                    self._stopping.wait(random.uniform(wait / 2, wait))
+                    continue
+                throttles = 0
+                records = response['Records']
+                lag = response.get('MillisBehindLatest', 0)
+                self.lag[shard_id] = lag
+                gauge('kinesis.{}.{}.millis_behind'.format(self.stream,
+                                                           shard_id), lag)
+                if records:
+                    self._put(('records', shard_id, records))
+                shard_iterator = response['NextShardIterator']
+                if shard_iterator is None:
+                    # The shard was closed by a reshard and we have read to
+                    # its end, its children hold what came after.
+                    log.info("StreamConsumer %s%s is closed", self.stream,
+                             shard_id)
+                elif not records and not lag:
+                    # An empty read doesn't mean we are caught up, the shard
+                    # can have gaps, MillisBehindLatest says.
+                    if not self.follow:
+                        break
+                    self._stopping.wait(FOLLOW_INTERVAL)
+        except Exception as e:
+            log.error("StreamConsumer %s%s had Exception %s", self.stream,
+                      shard_id, e)
+            log.exception(e)
+            self._put(('error', shard_id, e))
+        else:
+            self._put(('done', shard_id, None))
+
+def get_all(stream):
+    """Iterator that gets all the messages pending on a given stream.
+
+    Each micro-batch is checkpointed once the caller has iterated past it.
+
+    """
+    log.info("kinesis get_all(stream=%s)", stream)
+    consumer = StreamConsumer(stream)
+    for batch in consumer:
+        for data in batch:
+            yield data
+        consumer.checkpoint(batch)
+
+# -- Producer -----------------------------------------------------------------
+
+PUT_RECORDS_LIMIT = 500  # Kinesis' PutRecords maximum.
+PRODUCER_ATTEMPTS = 8
+PRODUCER = None
+PRODUCER_PID = None
+
+class Producer(object):
+    """Buffers records and sends them with put_records on its own thread.
+
+    put() queues a record and returns; a batch goes out when batch_size
+    records are waiting or linger seconds after the first of them arrived.
+    The queue is bounded, when it is full put() waits up to put_timeout for
+    room and then sends the record itself. Records a put_records call
+    rejects, or all of them if the call fails, are sent again with backoff,
+    up to PRODUCER_ATTEMPTS.
+
+    """
+    def __init__(self, connection=None, batch_size=PUT_RECORDS_LIMIT,
+                 linger=0.1, queue_size=10000, put_timeout=1.0):
+        self.connection = connection or new_connection()
+        self.batch_size = batch_size
+        self.linger = linger
+        self.put_timeout = put_timeout
+        self.queue = Queue(maxsize=queue_size)
+        self.sent_count = 0
+        self.dropped_count = 0
+        self._stopping = Event()
+        self._thread = Thread(target=self._run, name='kinesis-producer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, stream, data, partition_key):
+        try:
+            self.queue.put((stream, data, partition_key),
+                           timeout=self.put_timeout)
+        except Full:
+            log.warn("kinesis Producer queue full, putting %s directly",
+                     stream)
+            self.connection.put_record(stream, data, partition_key)
+
+    def flush(self):
+        """Block until everything queued so far has been sent."""
+        self.queue.join()
+
+    def close(self):
+        self.flush()
+        self._stopping.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            batch = self._gather()
+            if not batch:
+                continue
+            by_stream = {}
+            for stream, data, partition_key in batch:
+                by_stream.setdefault(stream, []).append(
+                    {'Data': data, 'PartitionKey': partition_key})
+            for stream, records in by_stream.iteritems():
+                try:
+                    self._send(stream, records)
+                except Exception as e:
+                    log.error("kinesis Producer had Exception %s", e)
+                    log.exception(e)
+            for _ in batch:
+                self.queue.task_done()
+
+    def _gather(self):
+        try:
+            batch = [self.queue.get(timeout=0.5)]
+        except Empty:
+            return []
+        deadline = time() + self.linger
+        while len(batch) < self.batch_size:
+            remaining = deadline - time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except Empty:
+                break
+        return batch
+
+    def _send(self, stream, records):
+        attempt = 0
+        while records:
+            if attempt == PRODUCER_ATTEMPTS:
+                msg = 'kinesis Producer dropped {} records for {}'.format(
+                    len(records), stream)
+                log.error(msg)
+                sentry.get_client().captureMessage(msg)
+                self.dropped_count += len(records)
+                return
+            if attempt:
+                backoff_sleep(attempt)
+            attempt += 1
+            try:
+                response = self.connection.put_records(records, stream)
+            except Exception as e:
+                log.warn("kinesis put_records failed, retrying: %s", e)
+                continue
+            failed = [record for record, result
+                      in zip(records, response['Records'])
+                      if 'ErrorCode' in result]
+            self.sent_count += len(records) - len(failed)
+            if failed:
+                log.warn("kinesis put_records had %s failed, retrying",
+                         len(failed))
+            records = failed
+
+def get_producer():
+    """The process' Producer, made on first use (and again after a fork)."""
+    global PRODUCER, PRODUCER_PID
+    if PRODUCER is None or PRODUCER_PID != os.getpid():
+        PRODUCER = Producer()
+        PRODUCER_PID = os.getpid()
+        atexit.register(PRODUCER.close)
+    return PRODUCER
+
+def put_record(stream, data, partition_key):
+    """Put a record on stream, through the Producer if it is enabled."""
+    if settings.KINESIS_PRODUCER_ENABLED:
+        get_producer().put(stream, data, partition_key)
+    else:
+        get_kinesis().put_record(stream, data, partition_key)
 
 def assert_connection():
     connection = get_kinesis()
     connection.describe_stream(settings.SCORE_STREAM)
     connection.describe_stream(settings.TAG_TREND_STREAM)
+    connection.describe_stream(settings.LEADERBOARD_STREAM)
     return True
\ No newline at end of file
@@ -0,0 +1,347 @@
+from __future__ import division, absolute_import, unicode_literals
+
+# Every windowed leaderboard lives in the one Leaderboard table. A board's
+# hash key is '<window>_<gender_location>', or '<window>_all' for the board
+# across gender_locations, and its rows sort by (score, uuid), so a board
+# reads in score order without an index. A photo on a board has a row on
+# its gender_location's board and one on the all board. A new score moves
+# the photo, a delete of the old row and a put of the new one.
+#
+# The all boards are sharded, '<window>_all_0' and on, by get_all_shard, so
+# their writes spread over partitions. Reads merge the shards. A
+# gender_location sharded for its Photos, see get_gender_location_shard,
+# has its boards sharded the same way.
+#
+# Each board has a score histogram too, ScoreHistogram, so a photo's rank
+# on it is one query, see get_histogram_rank.
+#
+# This replaced the five per-window tables and their 20 indexes, see
+# docs/Leaderboards.rst for the migration. Until it is done, with
+# settings.LEADERBOARD_LEGACY_TABLES, put() writes those tables too and the
+# API reads them.
+
+from datetime import timedelta
+
+from log import log
+from logic.timeuuid import pack_timeuuid_binary
+from model import ALL_UNSHARDED, get_all_shard, get_all_shards, \
+    get_gender_location_shards, get_leaderboard_expires, get_one, \
+    get_ttl_seconds, HourLeaderboard, is_leaderboard_expired, Leaderboard, \
+    MonthLeaderboard, Photo, ScoreHistogram, TodayLeaderboard, \
+    WeekLeaderboard, WriteBack, YearLeaderboard
+from settings import settings
+from util import merge_by, now, took
+
+# How long a photo stays on each window's board after its post_date.
+WINDOWS = (('hour', timedelta(hours=1)),
+           ('today', timedelta(days=1)),
+           ('week', timedelta(days=7)),
+           ('month', timedelta(days=31)),
+           ('year', timedelta(days=365)))
+ALL = ALL_UNSHARDED
+# The per-window tables Leaderboard replaces.
+LEGACY_CLASSES = (('hour', HourLeaderboard),
+                  ('today', TodayLeaderboard),
+                  ('week', WeekLeaderboard),
+                  ('month', MonthLeaderboard),
+                  ('year', YearLeaderboard))
+LEGACY_UPSERT_ATTRIBUTES = ('score', 'post_date', 'null_hash', 'expires')
+# A board's histogram counts its photos in score buckets this wide, the last
+# bucket takes every score above it. The counts are kept per slice of the
+# photos' expires, HISTOGRAM_SLICES to a window, so a slice leaves the
+# board at once.
+HISTOGRAM_BUCKET_WIDTH = 10.0
+HISTOGRAM_BUCKETS = 400
+HISTOGRAM_SLICES = 24
+# Inverts the bytes of a packed uuid, so newer uuids sort first.
+INVERT = b''.join(chr(255 - i) for i in xrange(256))
+
+
+def get_board(window, gender_location):
+    return '{}_{}'.format(window, gender_location)
+
+def get_boards(window, gender_location):
+    """The boards a read of a board merges, its shards."""
+    if ALL == gender_location:
+        return [get_board(window, shard) for shard in get_all_shards()]
+    return [get_board(window, shard)
+            for shard in get_gender_location_shards(gender_location)]
+
+def get_rank_key(score, photo_uuid):
+    """Sorts rows in board order, as the Leaderboard range key does
+    backwards."""
+    return (-score, pack_timeuuid_binary(photo_uuid).translate(INVERT),
+            photo_uuid)
+
+def get_histogram_bucket(score):
+    bucket = int(score // HISTOGRAM_BUCKET_WIDTH)
+    return min(max(bucket, 0), HISTOGRAM_BUCKETS - 1)
+
+def get_slice_seconds(window):
+    return int(dict(WINDOWS)[window].total_seconds()) // HISTOGRAM_SLICES
+
+def get_histogram_key(window, expires, score):
+    """The ScoreHistogram range key of a row, and when its slice ends."""
+    slice_seconds = get_slice_seconds(window)
+    # The slice is the first to end at or after expires.
+    slice_index = -(-expires // slice_seconds)
+    return ('{:08x}_{:04x}'.format(slice_index, get_histogram_bucket(score)),
+            slice_index * slice_seconds)
+
+def _count(write_back, window, board, expires, score, count):
+    bucket, slice_expires = get_histogram_key(window, expires, score)
+    write_back.update(ScoreHistogram(board, bucket, count=count), ['count'],
+                      action='ADD')
+    write_back.update(ScoreHistogram(board, bucket, expires=slice_expires),
+                      ['expires'])
+
+def put(write_back, gender_location, photo_uuid, post_date, score,
+        old_score=None, current_seconds=None):
+    """Queue a photo's rows on the boards it hasn't expired from.
+
+    old_score is the score the photo was last put with, its rows at that
+    score are deleted, None if it hasn't been put before. A photo without a
+    post_date is on no board. The photo is published to the ranking engines
+    too, see logic.ranking, once write_back has committed the rows.
+
+    """
+    # logic.ranking reads the boards through this module.
+    from logic import ranking
+    if post_date is None:
+        return
+    if current_seconds is None:
+        current_seconds = get_ttl_seconds(now())
+    for window, duration in WINDOWS:
+        expires = get_ttl_seconds(post_date + duration)
+        if expires <= current_seconds:
+            continue
+        for board in (get_board(window, gender_location),
+                      get_board(window, get_all_shard(photo_uuid))):
+            if old_score is None:
+                _count(write_back, window, board, expires, score, 1)
+            elif get_histogram_bucket(old_score) != \
+                    get_histogram_bucket(score):
+                _count(write_back, window, board, expires, old_score, -1)
+                _count(write_back, window, board, expires, score, 1)
+            if old_score is not None and old_score != score:
+                write_back.delete(Leaderboard(board, (old_score, photo_uuid),
+                                              gender_location=gender_location,
+                                              uuid=photo_uuid,
+                                              score=old_score,
+                                              post_date=post_date,
+                                              expires=expires))
+            write_back.save(Leaderboard(board, (score, photo_uuid),
+                                        gender_location=gender_location,
+                                        uuid=photo_uuid,
+                                        score=score,
+                                        post_date=post_date,
+                                        expires=expires))
+    write_back.after_commit(ranking.publish, gender_location, photo_uuid,
+                            post_date, score)
+    if not settings.LEADERBOARD_LEGACY_TABLES:
+        return
+    # These share Photo's primary key, so they are upserted in place.
+    for window, leaderboard_class in LEGACY_CLASSES:
+        expires = get_leaderboard_expires(leaderboard_class, post_date)
+        if expires <= current_seconds:
+            continue
+        write_back.update(leaderboard_class(gender_location,
+                                            uuid=photo_uuid,
+                                            post_date=post_date,
+                                            score=score,
+                                            expires=expires),
+                          LEGACY_UPSERT_ATTRIBUTES)
+
+def get_top(window, gender_location):
+    """A board's rows from the highest score down, skipping expired rows."""
+    current_seconds = get_ttl_seconds(now())
+    seen = set()
+    queries = [Leaderboard.query(board, scan_index_forward=False,
+                                 consistent_read=False)
+               for board in get_boards(window, gender_location)]
+    for row in merge_by(queries,
+                        lambda row: get_rank_key(row.score, row.uuid)):
+        # TTL deletes expired rows eventually, not right away. A row whose
+        # delete was lost is left at an old score, show the photo once.
+        if is_leaderboard_expired(row, current_seconds) or row.uuid in seen:
+            continue
+        seen.add(row.uuid)
+        yield row
+
+def get_all_time_top(after=None, **filters):
+    """Photos across every gender_location from the highest score down.
+
+    Merges the tops of Photo.all_score_index's shards. The page starts just
+    past the photo with uuid after, at its current score, with one read to
+    find it. filters go to each query.
+
+    """
+    photo = None
+    if after is not None:
+        photo = get_one(Photo, 'uuid_index', after, consistent_read=False)
+        if photo is None:
+            return iter(())
+        filters['score__le'] = photo.score
+    queries = [Photo.all_score_index.query(shard, scan_index_forward=False,
+                                           consistent_read=False, **filters)
+               for shard in get_all_shards()]
+    top = merge_by(queries, lambda photo: -photo.score)
+    if photo is not None:
+        top = _past(top, photo)
+    return top
+
+def _past(top, photo):
+    """top from just past photo, photos at its score before it were on the
+    page before."""
+    for item in top:
+        if item.score < photo.score:
+            yield item
+            break
+        if item.uuid == photo.uuid:
+            break
+    for item in top:
+        yield item
+
+def get_histogram_rank(window, gender_location, score):
+    """(rank, count) of a score on a board, from the board's histogram.
+
+    One query per shard of the board. rank is 0 for the top, and is
+    estimated within the score's bucket as if the bucket's scores were
+    spread evenly. A slice's photos
+    are counted until the slice ends, up to a HISTOGRAM_SLICES'th of the
+    window after they leave the board.
+
+    """
+    first_slice = get_ttl_seconds(now()) // get_slice_seconds(window) + 1
+    bucket = get_histogram_bucket(score)
+    above = same = count = 0
+    rows = (row for board in get_boards(window, gender_location)
+            for row in ScoreHistogram.query(
+                board, bucket__ge='{:08x}'.format(first_slice),
+                consistent_read=False))
+    for row in rows:
+        row_bucket = int(row.bucket.split('_')[1], 16)
+        count += row.count
+        if row_bucket > bucket:
+            above += row.count
+        elif row_bucket == bucket:
+            same += row.count
+    # How much of the bucket is above score, the photo is one of same.
+    fraction = min(max(bucket + 1 - score / HISTOGRAM_BUCKET_WIDTH, 0.0), 1.0)
+    rank = max(above, 0) + int(max(same - 1, 0) * fraction)
+    return rank, max(count, rank + 1)
+
+def backfill():
+    """Copy the live rows of the per-window tables into Leaderboard."""
+    start_time = now()
+    current_seconds = get_ttl_seconds(start_time)
+    durations = dict(WINDOWS)
+    count = 0
+    for window, leaderboard_class in LEGACY_CLASSES:
+        write_back = WriteBack()
+        for row in leaderboard_class.scan():
+            expires = get_ttl_seconds(row.post_date + durations[window])
+            if expires <= current_seconds:
+                continue
+            for board_gender_location in (row.gender_location,
+                                          get_all_shard(row.uuid)):
+                write_back.save(Leaderboard(
+                    get_board(window, board_gender_location),
+                    (row.score, row.uuid),
+                    gender_location=row.gender_location,
+                    uuid=row.uuid,
+                    score=row.score,
+                    post_date=row.post_date,
+                    expires=expires))
+        count += write_back.commit()
+    log.info("leaderboard backfill, %s" % took(count, 'write', start_time))
+    return count
+
+def rebuild_histograms():
+    """Count the Leaderboard table's live rows into ScoreHistogram again.
+
+    After backfill, or if the counts have drifted. Counts the score job
+    adds while this runs can be overwritten.
+
+    """
+    start_time = now()
+    current_seconds = get_ttl_seconds(start_time)
+    counts = {}  # (board, bucket) -> [count, slice expires]
+    seen = set()
+    for row in Leaderboard.scan():
+        # A row left at an old score is counted once, as get_top shows it.
+        if is_leaderboard_expired(row, current_seconds) or \
+           (row.board, row.uuid) in seen:
+            continue
+        seen.add((row.board, row.uuid))
+        window = row.board.split('_', 1)[0]
+        bucket, slice_expires = get_histogram_key(window, row.expires,
+                                                  row.score)
+        counts.setdefault((row.board, bucket), [0, slice_expires])[0] += 1
+    write_back = WriteBack()
+    for row in ScoreHistogram.scan():
+        if (row.board, row.bucket) not in counts:
+            write_back.delete(row)
+    for (board, bucket), (count, slice_expires) in counts.iteritems():
+        write_back.save(ScoreHistogram(board, bucket, count=count,
+                                       expires=slice_expires))
+    count = write_back.commit()
+    log.info("leaderboard rebuild_histograms, %s" % took(count, 'write',
+                                                         start_time))
+    return count
+
+def reshard_all():
+    """Move the photos and rows on the unsharded all boards to the shards.
+
+    For Photos and Leaderboard rows written before the all boards were
+    sharded. Run rebuild_histograms after.
+
+    """
+    start_time = now()
+    write_back = WriteBack()
+    for photo in Photo.scan(null_hash__eq=ALL_UNSHARDED):
+        photo.null_hash = get_all_shard(photo.uuid)
+        write_back.update(photo, ['null_hash'], uuid__exists=True)
+    for window, duration in WINDOWS:
+        for row in Leaderboard.query(get_board(window, ALL_UNSHARDED)):
+            write_back.delete(row)
+            write_back.save(Leaderboard(
+                get_board(window, get_all_shard(row.uuid)), row.rank,
+                gender_location=row.gender_location,
+                uuid=row.uuid,
+                score=row.score,
+                post_date=row.post_date,
+                expires=row.expires))
+    count = write_back.commit()
+    log.info("leaderboard reshard_all, %s" % took(count, 'write', start_time))
+    return count
+
+def sweep():
+    """Delete expired leaderboard rows, as DynamoDB's TTL does.
+
+    For local stand-ins for DynamoDB without TTL. Rows of the per-window
+    tables written before they had expires get it, so TTL can take them
+    from then on.
+
+    """
+    start_time = now()
+    current_seconds = get_ttl_seconds(start_time)
+    write_back = WriteBack()
+    for window, leaderboard_class in LEGACY_CLASSES:
+        for leaderboard in leaderboard_class.scan():
+            if is_leaderboard_expired(leaderboard, current_seconds):
+                write_back.delete(leaderboard)
+            elif leaderboard.expires is None:
+                leaderboard.expires = get_leaderboard_expires(
+                    leaderboard_class, leaderboard.post_date)
+                write_back.update(leaderboard, ['expires'],
+                                  uuid__exists=True)
+    for leaderboard in Leaderboard.scan():
+        if is_leaderboard_expired(leaderboard, current_seconds):
+            write_back.delete(leaderboard)
+    for histogram in ScoreHistogram.scan():
+        if histogram.expires <= current_seconds:
+            write_back.delete(histogram)
+    count = write_back.commit()
+    log.info("leaderboard sweep, %s" % took(count, 'write', start_time))
+    return count
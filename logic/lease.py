@@ -0,0 +1,107 @@
+from __future__ import division, absolute_import, unicode_literals
+
+from datetime import timedelta
+import os
+import socket
+from threading import Event, Thread
+from uuid import uuid1
+
+from pynamodb.exceptions import PutError
+
+from log import log
+from model import Lease
+from util import now
+
+# A Lease is a named claim on a job that only one process should run at a
+# time. The holder renews it well before it expires, so if the holder dies
+# the job is free again within LEASE_DURATION.
+LEASE_DURATION = timedelta(seconds=30)
+
+
+def get_owner():
+    """A name for this process to hold leases under."""
+    return '{}:{}:{}'.format(socket.gethostname(), os.getpid(),
+                             uuid1().hex[:8])
+
+def acquire(name, owner, duration=LEASE_DURATION):
+    """Take or renew the named lease, True if owner holds it now."""
+    current = now()
+    lease = Lease(name, owner=owner, expires=current + duration)
+    # Renew it if it is ours, or take it if nobody has it.
+    if _put(lease, owner__eq=owner) or _put(lease, name__null=True):
+        return True
+    try:
+        held = Lease.get(name)
+    except Lease.DoesNotExist:
+        return False
+    if held.expires > current:
+        return False
+    # Take it over from an expired holder, unless someone beat us to it.
+    return _put(lease, owner__eq=held.owner, expires__eq=held.expires)
+
+def _put(lease, **expected_values):
+    try:
+        lease.save(**expected_values)
+    except PutError as e:
+        if 'ConditionalCheckFailed' in unicode(e):
+            return False
+        raise
+    return True
+
+def release(name, owner):
+    """Give up the named lease, if owner holds it, by expiring it now."""
+    return _put(Lease(name, owner=owner, expires=now()), owner__eq=owner)
+
+def get_holder(name):
+    """The owner of the named lease, None if nobody holds it."""
+    try:
+        lease = Lease.get(name)
+    except Lease.DoesNotExist:
+        return None
+    if lease.expires <= now():
+        return None
+    return lease.owner
+
+
+class LeaseKeeper(Thread):
+    """Renews a held lease in the background until stopped.
+
+    If a renewal fails the lease is lost, `lost` is set and on_lost is
+    called, the holder should stop its work without committing any more.
+
+    """
+    def __init__(self, name, owner, duration=LEASE_DURATION, on_lost=None):
+        super(LeaseKeeper, self).__init__(name='lease-%s' % name)
+        self.daemon = True
+        self.lease_name = name
+        self.owner = owner
+        self.duration = duration
+        self.on_lost = on_lost
+        self.lost = Event()
+        self._done = Event()
+
+    def run(self):
+        interval = self.duration.total_seconds() / 3
+        renewed = now()
+        while not self._done.wait(interval):
+            try:
+                held = acquire(self.lease_name, self.owner, self.duration)
+            except Exception as e:
+                log.error("LeaseKeeper %s renew had Exception %s",
+                          self.lease_name, e)
+                log.exception(e)
+                # Keep trying until the lease would have run out.
+                held = now() - renewed < self.duration
+            else:
+                if held:
+                    renewed = now()
+            if not held:
+                log.warn("LeaseKeeper %s lost the lease", self.lease_name)
+                self.lost.set()
+                if self.on_lost is not None:
+                    self.on_lost()
+                return
+
+    def stop(self):
+        self._done.set()
+        self.join()
@@ -0,0 +1,146 @@
+from __future__ import division, absolute_import, unicode_literals
+
+# GET /users/me/matches picks its matches while the user waits. So that it
+# needn't, each batch it serves asks the worker, by SQS, to pick the user's
+# next BATCHES batches ahead of time, and it serves those from MatchQueue
+# when there are some. Off unless settings.MATCH_QUEUE_ENABLED.
+#
+# Only the picking is done ahead, the pairs and their photos rendered. A
+# batch is written nothing for until it is served, when its Matches, the
+# user's tournament status and the bump are written as for any batch, see
+# apps.api.api.serve_matches. So a batch dropped unserved costs nothing.
+#
+# A batch older than MAX_AGE, or for a gender_location the user no longer
+# views, is dropped rather than served, its ratings are out of date.
+
+from datetime import timedelta
+import json
+from uuid import UUID
+import zlib
+
+from pynamodb.exceptions import DeleteError
+
+from log import log
+from model import MatchQueue, Photo, WriteBack
+from util import now, took
+
+# Batches kept ready per user.
+BATCHES = 2
+# How long a batch is served for after it was picked.
+MAX_AGE = timedelta(minutes=5)
+
+
+# Photos are kept with what predicting their matches needs and how they
+# render, rather than read again when served.
+
+def _dump_photo(photo, rendered):
+    return {'gender_location': photo.gender_location,
+            'uuid': photo.uuid.hex,
+            'user_uuid': photo.user_uuid.hex,
+            'score': photo.score,
+            'phi': photo.phi,
+            'sigma': photo.sigma,
+            'rendered': rendered}
+
+def _load_photo(data):
+    return Photo(data['gender_location'], UUID(data['uuid']),
+                 user_uuid=UUID(data['user_uuid']),
+                 score=data['score'], phi=data['phi'], sigma=data['sigma'])
+
+def _load_batch(batch):
+    return json.loads(zlib.decompress(batch.pairs))
+
+def push(user_uuid, gender_location, pairs, renders, bump_photo=None):
+    """Queue a batch of picked pairs for the user, renders being their
+    rendered photos by uuid, and bump_photo, if any, in the first pair."""
+    batch = {
+        'pairs': [[_dump_photo(photo, renders[photo.uuid]) for photo in pair]
+                  for pair in pairs],
+        'bump': bump_photo.uuid.hex if bump_photo is not None else None}
+    MatchQueue(user_uuid, now(),
+               gender_location=gender_location,
+               pairs=zlib.compress(json.dumps(batch))).save()
+
+def _get_batches(user_uuid, gender_location):
+    """The user's servable batches, oldest first, dropping the others."""
+    oldest = now() - MAX_AGE
+    batches = []
+    write_back = WriteBack()
+    for batch in MatchQueue.query(user_uuid):
+        if batch.queued < oldest or batch.gender_location != gender_location:
+            write_back.delete(batch)
+        else:
+            batches.append(batch)
+    write_back.commit()
+    return batches
+
+def count(user_uuid, gender_location):
+    """How many batches the user has ready."""
+    return len(_get_batches(user_uuid, gender_location))
+
+def pop(user_uuid, gender_location):
+    """The user's oldest batch taken off the queue, as (pairs, renders,
+    bump_photo) like push's arguments, or None if there are none.
+
+    The photos are only those attributes a batch is served with, don't save
+    them.
+
+    """
+    start_time = now()
+    for batch in _get_batches(user_uuid, gender_location):
+        try:
+            # Another request may have just served it.
+            batch.delete(user_uuid__exists=True)
+        except DeleteError:
+            continue
+        data = _load_batch(batch)
+        pairs = []
+        renders = {}
+        bump_photo = None
+        for pair in data['pairs']:
+            photos = tuple(_load_photo(photo) for photo in pair)
+            for photo, photo_data in zip(photos, pair):
+                renders[photo.uuid] = photo_data['rendered']
+                if photo.uuid.hex == data['bump']:
+                    bump_photo = photo
+            pairs.append(photos)
+        log.debug("match queue pop %s, %s" % (
+            user_uuid.hex, took(len(pairs), 'pair', start_time)))
+        return pairs, renders, bump_photo
+    return None
+
+def fill(user_uuid, gender_location, pick):
+    """Queue batches from pick(excluded, bumped) until the user has BATCHES,
+    or it picks no pairs. Returns how many were queued.
+
+    pick returns (pairs, renders, bump_photo) as push takes them, or None,
+    passing over the pairs in excluded, (photo_a uuid, photo_b uuid), and
+    not bumping the photos, by uuid, in bumped, as those are already queued.
+
+    """
+    start_time = now()
+    excluded = set()
+    bumped = set()
+    batches = _get_batches(user_uuid, gender_location)
+    for batch in batches:
+        data = _load_batch(batch)
+        for photo_a, photo_b in data['pairs']:
+            excluded.add((UUID(photo_a['uuid']), UUID(photo_b['uuid'])))
+        if data['bump'] is not None:
+            bumped.add(UUID(data['bump']))
+    queued = 0
+    for x in xrange(BATCHES - len(batches)):
+        picked = pick(excluded, bumped)
+        if not picked or not picked[0]:
+            break
+        pairs, renders, bump_photo = picked
+        push(user_uuid, gender_location, pairs, renders, bump_photo)
+        excluded.update((photo_a.uuid, photo_b.uuid)
+                        for photo_a, photo_b in pairs)
+        if bump_photo is not None:
+            bumped.add(bump_photo.uuid)
+        queued += 1
+    log.info("match queue fill %s, %s" % (user_uuid.hex,
+                                          took(queued, 'batch', 'batches',
+                                               start_time)))
+    return queued
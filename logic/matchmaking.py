@@ -0,0 +1,161 @@
+from __future__ import division, absolute_import, unicode_literals
+
+# Picks the pairs of photos to show for judging. A vote says the most about
+# photos whose rating is uncertain, high phi, against an opponent it could
+# lose to, Glicko2.quality_1vs1. So the first photo of a pair is drawn in
+# proportion to phi squared, from an alias table, and its opponent from the
+# OPPONENT_WINDOW photos either side of it by score, in proportion to the
+# pair's quality times the opponent's phi squared. A pair costs the same
+# however many photos there are.
+#
+# Photos are only paired with photos of the same media type, never with
+# themselves or a photo of the same user.
+
+from bisect import bisect_left
+from random import randrange, random
+
+from logic.glicko2 import Glicko2
+
+# Photos either side of a photo, by score, its opponent is drawn from.
+OPPONENT_WINDOW = 8
+# Draws of a first photo before settling for one already in a pair.
+UNUSED_DRAWS = 3
+# A photo with phi this low still gets drawn now and then.
+MIN_PHI = 1.0
+
+_env = Glicko2()
+
+
+def get_media_type(photo):
+    return 'movie' if photo.media_type == 'movie' else 'photo'
+
+def _build_alias(weights):
+    """Vose's alias table, to draw an index in proportion to weights."""
+    count = len(weights)
+    total = sum(weights)
+    probabilities = [weight * count / total for weight in weights]
+    aliases = [0] * count
+    small = [i for i, p in enumerate(probabilities) if p < 1.0]
+    large = [i for i, p in enumerate(probabilities) if p >= 1.0]
+    while small and large:
+        less = small.pop()
+        more = large.pop()
+        aliases[less] = more
+        probabilities[more] += probabilities[less] - 1.0
+        if probabilities[more] < 1.0:
+            small.append(more)
+        else:
+            large.append(more)
+    # What is left is 1 but for rounding.
+    for i in small + large:
+        probabilities[i] = 1.0
+    return probabilities, aliases
+
+
+class Matchmaker(object):
+    """Draws pairs from photos of one media type, see above."""
+    def __init__(self, photos):
+        self.photos = sorted(photos, key=lambda photo: photo.score)
+        self.scores = [photo.score for photo in self.photos]
+        self.positions = dict((photo.uuid, i)
+                              for i, photo in enumerate(self.photos))
+        self.ratings = [self._get_rating(photo) for photo in self.photos]
+        self.weights = [max(photo.phi, MIN_PHI) ** 2
+                        for photo in self.photos]
+        if self.photos:
+            self.probabilities, self.aliases = _build_alias(self.weights)
+
+    def __len__(self):
+        return len(self.photos)
+
+    @staticmethod
+    def _get_rating(photo):
+        return _env.scale_down(_env.create_rating(photo.score, photo.phi,
+                                                  photo.sigma))
+
+    def pick(self, used=()):
+        """A photo in proportion to its phi squared, one not in used if it
+        comes up in UNUSED_DRAWS."""
+        for x in xrange(UNUSED_DRAWS):
+            i = randrange(len(self.photos))
+            if random() >= self.probabilities[i]:
+                i = self.aliases[i]
+            photo = self.photos[i]
+            if photo.uuid not in used:
+                break
+        return photo
+
+    def pick_opponent(self, photo, used=()):
+        """An opponent for photo, which needn't be one of ours, or None.
+
+        Photos in used are passed over unless there is nothing else.
+
+        """
+        position = self.positions.get(photo.uuid)
+        if position is None:
+            position = bisect_left(self.scores, photo.score)
+        rating = self._get_rating(photo)
+        candidates = []
+        fallback = []
+        for i in xrange(max(position - OPPONENT_WINDOW, 0),
+                        min(position + OPPONENT_WINDOW + 1,
+                            len(self.photos))):
+            other = self.photos[i]
+            if other.uuid == photo.uuid or \
+               other.user_uuid == photo.user_uuid:
+                continue
+            weight = _env.quality_1vs1(rating, self.ratings[i]) * \
+                self.weights[i]
+            if other.uuid in used:
+                fallback.append((weight, other))
+            else:
+                candidates.append((weight, other))
+        candidates = candidates or fallback
+        if not candidates:
+            return None
+        point = random() * sum(weight for weight, other in candidates)
+        for weight, other in candidates:
+            point -= weight
+            if point < 0:
+                break
+        return other
+
+    def pick_pair(self, used=()):
+        """(photo, opponent), or None if the photo drawn has no opponent."""
+        photo = self.pick(used)
+        opponent = self.pick_opponent(photo, used)
+        if opponent is None:
+            return None
+        return photo, opponent
+
+
+def get_matchmakers(photos):
+    """{media type: Matchmaker} of photos."""
+    by_media_type = {'photo': [], 'movie': []}
+    for photo in photos:
+        by_media_type[get_media_type(photo)].append(photo)
+    return dict((media_type, Matchmaker(photos))
+                for media_type, photos in by_media_type.iteritems())
+
+def get_pairs(matchmakers, tries):
+    """Draw up to tries pairs, each from a Matchmaker of matchmakers in
+    proportion to its photos.
+
+    A photo is in one pair at most unless the draws keep coming back to
+    it.
+
+    """
+    matchmakers = [matchmaker for matchmaker in matchmakers.itervalues()
+                   if len(matchmaker) >= 2]
+    total = sum(len(matchmaker) for matchmaker in matchmakers)
+    used = set()
+    for x in xrange(tries if matchmakers else 0):
+        point = randrange(total)
+        for matchmaker in matchmakers:
+            point -= len(matchmaker)
+            if point < 0:
+                break
+        pair = matchmaker.pick_pair(used)
+        if pair is not None:
+            used.update(photo.uuid for photo in pair)
+            yield pair
@@ -0,0 +1,139 @@
+from __future__ import division, absolute_import, unicode_literals
+
+# GET /leaderboards/m and /leaderboards/f show the top photos of a list of
+# cities. Rendering them live is a query per city and several reads per
+# photo, so the worker renders them ahead of time, on the cron in cron.yaml,
+# and saves each city's leaderboard as a LeaderboardOverview row. A gender's
+# rows are one query, and each Api process keeps what it read for
+# CACHE_DURATION.
+#
+# The scorer renders the cities it has scored photos of again too, through
+# a Refresher, at most every REFRESH_INTERVAL, so the overviews keep up
+# with the scores between crons.
+
+from datetime import timedelta
+import json
+from threading import Lock
+import zlib
+
+from log import log
+from model import get_base_gender_location, LeaderboardOverview, WriteBack
+from util import now, took, unix_time
+
+# How long an Api process serves the overviews it read before reading them
+# again.
+CACHE_DURATION = timedelta(seconds=30)
+# Least time between a Refresher's refreshes.
+REFRESH_INTERVAL = timedelta(seconds=30)
+
+_cache = {}  # gender -> (read time, overview)
+_cache_lock = Lock()
+
+
+def _make_row(gender, position, leaderboard, generated):
+    return LeaderboardOverview(
+        gender, position,
+        name=leaderboard['name'],
+        gender_location=leaderboard['gender_location'],
+        photos=zlib.compress(json.dumps(leaderboard['photos'])),
+        generated=generated)
+
+def save(gender, leaderboards):
+    """Save a gender's rendered leaderboards, dicts of name,
+    gender_location and photos, in order."""
+    generated = now()
+    write_back = WriteBack()
+    for position, leaderboard in enumerate(leaderboards):
+        write_back.save(_make_row(gender, position, leaderboard, generated))
+    # Rows past the end are from a longer list of cities.
+    for row in LeaderboardOverview.query(gender,
+                                         position__ge=len(leaderboards)):
+        write_back.delete(row)
+    count = write_back.commit()
+    log.info("overview save %s, %s" % (gender, took(count, 'write',
+                                                      generated)))
+    return count
+
+def update(gender, leaderboards):
+    """Save some of a gender's rendered leaderboards, {position:
+    leaderboard}, and leave the others as they are."""
+    generated = now()
+    write_back = WriteBack()
+    for position, leaderboard in leaderboards.iteritems():
+        write_back.save(_make_row(gender, position, leaderboard, generated))
+    count = write_back.commit()
+    log.info("overview update %s, %s" % (gender, took(count, 'write',
+                                                        generated)))
+    return count
+
+def load(gender):
+    """A gender's saved leaderboards, {'leaderboards': [...], 'version': n},
+    None if there are none. version is the unix time they were rendered."""
+    leaderboards = []
+    generated = None
+    for row in LeaderboardOverview.query(gender, consistent_read=False):
+        leaderboards.append({
+            'name': row.name,
+            'gender_location': row.gender_location,
+            'photos': json.loads(zlib.decompress(row.photos))
+        })
+        generated = row.generated if generated is None \
+            else max(generated, row.generated)
+    if not leaderboards:
+        return None
+    return {
+        'leaderboards': leaderboards,
+        'version': unix_time(generated)
+    }
+
+def get(gender):
+    """load, from this process' copy if it was read in the last
+    CACHE_DURATION."""
+    current_time = now()
+    with _cache_lock:
+        cached = _cache.get(gender)
+    if cached is not None and current_time - cached[0] < CACHE_DURATION:
+        return cached[1]
+    overview = load(gender)
+    if overview is not None:
+        with _cache_lock:
+            _cache[gender] = (current_time, overview)
+    return overview
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
+
+
+class Refresher(object):
+    """Calls refresh(gender_locations) with the gender_locations touched
+    since it last did, at most every interval.
+
+    A refresh that fails is logged, the gender_locations wait for the
+    next.
+
+    """
+    def __init__(self, refresh, interval=REFRESH_INTERVAL):
+        self.refresh = refresh
+        self.interval = interval
+        self.touched = set()
+        self.refreshed = None
+
+    def touch(self, gender_locations):
+        """Note gender_locations as touched, and refresh if it is time.
+        Returns True if it refreshed."""
+        self.touched.update(get_base_gender_location(gender_location)
+                            for gender_location in gender_locations)
+        current_time = now()
+        if not self.touched or (self.refreshed is not None and
+                                current_time - self.refreshed < self.interval):
+            return False
+        self.refreshed = current_time
+        try:
+            self.refresh(set(self.touched))
+        except Exception as e:
+            log.error("overview refresh had Exception %s", e)
+            log.exception(e)
+            return False
+        self.touched.clear()
+        return True
@@ -5,12 +5,13 @@ from __future__ import division, absolute_import, unicode_literals
 from uuid import uuid1
 
 from boto.s3.key import Key
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 from pynamodb.models import DoesNotExist
 
 from log import log
-from model import get_one, HourLeaderboard, MonthLeaderboard, Photo, \
-    ProfileOnlyPhoto, TodayLeaderboard, WeekLeaderboard, YearLeaderboard
+from model import batch_get, get_all_shard, get_gender_location_shard, \
+    get_one, Photo, ProfileOnlyPhoto
 from logic.s3 import get_serve_bucket
 from settings import settings
 from util import now
@@ -41,11 +42,14 @@ def create_photo(user, location, geo, set_as_profile_photo,
             'geodata': geo.meta,
             'set_as_profile_photo': set_as_profile_photo,
             'tags': tags,
-            'media_type': media_type
+            'media_type': media_type,
+            'null_hash': get_all_shard(photo_uuid)
         }
         if is_test == True:
             kwargs['is_test'] = True
-        photo = Photo(gender_location, **kwargs)
+        # The file name keeps the gender_location, the key is its shard.
+        photo = Photo(get_gender_location_shard(gender_location, photo_uuid),
+                      **kwargs)
     else:
         kwargs = {
             'file_name': 'pop_%s' % photo_uuid.hex,
@@ -78,25 +82,43 @@ def get_photo(photo_uuid, check_copy_complete=True):
     except DoesNotExist:
         return None
 
-def get_photo_hour(photo_uuid):
-    return get_one(HourLeaderboard, 'uuid_index', photo_uuid,
-                   consistent_read=False)
-
-def get_photo_today(photo_uuid):
-    return get_one(TodayLeaderboard, 'uuid_index', photo_uuid,
-                   consistent_read=False)
-
-def get_photo_week(photo_uuid):
-    return get_one(WeekLeaderboard, 'uuid_index', photo_uuid,
-                   consistent_read=False)
-
-def get_photo_month(photo_uuid):
-    return get_one(MonthLeaderboard, 'uuid_index', photo_uuid,
-                   consistent_read=False)
-
-def get_photo_year(photo_uuid):
-    return get_one(YearLeaderboard, 'uuid_index', photo_uuid,
-                   consistent_read=False)
+# Bounds the concurrent uuid_index queries get_photos_by_uuid makes.
+PHOTO_QUERY_WORKERS = 8
+
+def get_photos_by_uuid(photo_uuids, gender_locations=None,
+                       consistent_read=False):
+    """Return {photo_uuid: Photo} for the given photo uuids.
+
+    gender_locations maps photo_uuid to the gender_location we expect the
+    photo is in. Those are fetched by primary key with BatchGetItem, 100
+    per call, consistently if consistent_read. Photos with no expected
+    gender_location, or that were not found where we expected, are looked
+    up on uuid_index with the queries running concurrently, a GSI can't be
+    read consistently. Photos that can't be found are left out.
+
+    """
+    if gender_locations is None:
+        gender_locations = {}
+    photo_uuids = set(photo_uuids)
+    result = {}
+    keys = [(gender_locations[photo_uuid], photo_uuid)
+            for photo_uuid in photo_uuids if photo_uuid in gender_locations]
+    for photo in batch_get(Photo, keys, consistent_read=consistent_read):
+        result[photo.uuid] = photo
+    missing = [photo_uuid for photo_uuid in photo_uuids
+               if photo_uuid not in result]
+    if missing:
+        def query(photo_uuid):
+            return get_one(Photo, 'uuid_index', photo_uuid,
+                           consistent_read=False)
+        workers = min(PHOTO_QUERY_WORKERS, len(missing))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for photo in executor.map(query, missing):
+                if photo is not None:
+                    result[photo.uuid] = photo
+    log.info("get_photos_by_uuid %s batch, %s query, %s found",
+             len(keys), len(missing), len(result))
+    return result
 
 class CropError(Exception):
     pass
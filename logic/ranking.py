@@ -0,0 +1,468 @@
+from __future__ import division, absolute_import, unicode_literals
+
+# An in-process copy of the Leaderboard boards, so the API can answer top-N,
+# the page after a photo and a photo's rank without querying DynamoDB.
+#
+# Each board is a RankedBoard, an indexable skip list in leaderboard order,
+# loaded from the Leaderboard table the first time it is asked for. The
+# boards across every gender_location are loaded when the engine starts.
+# While a board is loading it is cold, and callers get None and go to
+# DynamoDB instead.
+#
+# logic.leaderboard.put publishes every photo it puts on the boards to
+# settings.LEADERBOARD_STREAM and applies it to this process' engine. With
+# Kinesis enabled the engine also follows that stream from its tip, so a
+# process that doesn't score, like the API server, sees the score job's
+# updates.
+
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+from math import log as math_log
+import os
+import random
+import struct
+from threading import RLock, Thread
+from uuid import UUID
+
+from log import log
+from logic import kinesis, leaderboard
+from model import get_base_gender_location, get_ttl_seconds
+from settings import settings
+from util import now, took
+
+# Boards with more rows than this aren't kept, they are read from DynamoDB.
+MAX_BOARD_ROWS = 200000
+# Boards loading at once.
+LOAD_WORKERS = 2
+# GetRecords calls a second the followers share on each shard, of the 5
+# Kinesis allows.
+FOLLOWER_READS_PER_SECOND = 4
+# Skip list levels, enough for 2 ** SKIP_LIST_LEVELS entries.
+SKIP_LIST_LEVELS = 24
+# Leaderboard stream records are a version byte, the photo uuid, its score
+# and its post_date (whole seconds since the epoch), then its
+# gender_location in utf-8.
+RANKING_RECORD_VERSION = 1
+RANKING_RECORD_HEADER = struct.Struct(b'>B16sdq')
+
+ENGINE = None
+ENGINE_PID = None
+
+
+class _Last(object):
+    """Sorts after every key."""
+    def __lt__(self, other):
+        return False
+
+    def __le__(self, other):
+        return self is other
+
+    def __gt__(self, other):
+        return self is not other
+
+    def __ge__(self, other):
+        return True
+
+    def __eq__(self, other):
+        return self is other
+
+    def __ne__(self, other):
+        return self is not other
+
+
+class _Node(object):
+    __slots__ = ('key', 'next', 'width')
+
+    def __init__(self, key, level):
+        self.key = key
+        self.next = [None] * level
+        # How many entries each link skips over, counting the one it
+        # lands on.
+        self.width = [1] * level
+
+
+class RankedList(object):
+    """Keys in sorted order, with O(log n) insert, remove, rank and index.
+
+    An indexable skip list. Every link knows how many entries it passes, so
+    a walk from the head adds up to a position on the way down.
+
+    """
+    def __init__(self, levels=SKIP_LIST_LEVELS):
+        self.levels = levels
+        self.size = 0
+        self.last = _Node(_Last(), 0)
+        self.head = _Node(None, levels)
+        self.head.next = [self.last] * levels
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.size:
+            raise IndexError(index)
+        node = self.head
+        index += 1
+        for level in reversed(xrange(self.levels)):
+            while node.width[level] <= index:
+                index -= node.width[level]
+                node = node.next[level]
+        return node.key
+
+    def insert(self, key):
+        chain = [None] * self.levels
+        steps_at_level = [0] * self.levels
+        node = self.head
+        for level in reversed(xrange(self.levels)):
+            while node.next[level].key <= key:
+                steps_at_level[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+        # Each level up has half the entries of the one below.
+        height = min(self.levels, 1 - int(math_log(1.0 - random.random(), 2)))
+        new = _Node(key, height)
+        steps = 0
+        for level in xrange(height):
+            previous = chain[level]
+            new.next[level] = previous.next[level]
+            previous.next[level] = new
+            new.width[level] = previous.width[level] - steps
+            previous.width[level] = steps + 1
+            steps += steps_at_level[level]
+        for level in xrange(height, self.levels):
+            chain[level].width[level] += 1
+        self.size += 1
+
+    def remove(self, key):
+        chain = [None] * self.levels
+        node = self.head
+        for level in reversed(xrange(self.levels)):
+            while node.next[level].key < key:
+                node = node.next[level]
+            chain[level] = node
+        found = chain[0].next[0]
+        if found is self.last or found.key != key:
+            raise KeyError(key)
+        for level in xrange(len(found.next)):
+            previous = chain[level]
+            previous.width[level] += found.width[level] - 1
+            previous.next[level] = found.next[level]
+        for level in xrange(len(found.next), self.levels):
+            chain[level].width[level] -= 1
+        self.size -= 1
+
+    def rank(self, key):
+        """The index of key, KeyError if it isn't here."""
+        node = self.head
+        position = 0
+        for level in reversed(xrange(self.levels)):
+            while node.next[level].key < key:
+                position += node.width[level]
+                node = node.next[level]
+        found = node.next[0]
+        if found is self.last or found.key != key:
+            raise KeyError(key)
+        return position
+
+    def slice(self, start, count):
+        """Up to count keys from index start on."""
+        if start >= self.size or count <= 0:
+            return []
+        node = self.head
+        index = start + 1
+        for level in reversed(xrange(self.levels)):
+            while node.width[level] <= index:
+                index -= node.width[level]
+                node = node.next[level]
+        keys = []
+        while node is not self.last and len(keys) < count:
+            keys.append(node.key)
+            node = node.next[0]
+        return keys
+
+
+class RankedBoard(object):
+    """One board's photos in leaderboard order, highest score first."""
+    def __init__(self):
+        self.entries = RankedList()
+        self.keys = {}  # uuid -> key in entries
+        self.expiries = []  # heap of (expires, uuid)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def put(self, photo_uuid, score, expires):
+        key = leaderboard.get_rank_key(score, photo_uuid)
+        old_key = self.keys.get(photo_uuid)
+        if old_key == key:
+            return
+        if old_key is None:
+            heapq.heappush(self.expiries, (expires, photo_uuid))
+        else:
+            self.entries.remove(old_key)
+        self.entries.insert(key)
+        self.keys[photo_uuid] = key
+
+    def remove(self, photo_uuid):
+        key = self.keys.pop(photo_uuid, None)
+        if key is not None:
+            self.entries.remove(key)
+
+    def expire(self, current_seconds):
+        while self.expiries and self.expiries[0][0] <= current_seconds:
+            expires, photo_uuid = heapq.heappop(self.expiries)
+            self.remove(photo_uuid)
+
+    def top(self, count, after=None):
+        """Up to count uuids from the top, or from just after a uuid."""
+        start = 0
+        if after is not None:
+            key = self.keys.get(after)
+            if key is None:
+                return []
+            start = self.entries.rank(key) + 1
+        return [key[2] for key in self.entries.slice(start, count)]
+
+    def rank(self, photo_uuid):
+        """The photo's place on the board, 0 for the top, None if absent."""
+        key = self.keys.get(photo_uuid)
+        if key is None:
+            return None
+        return self.entries.rank(key)
+
+
+class RankingEngine(object):
+    """The RankedBoards of this process, by (window, gender_location).
+
+    A board is cold until it has been loaded from DynamoDB, the calls that
+    read a board return None for a cold one and start loading it. Updates
+    that come in while a board loads are applied once it has.
+
+    """
+    def __init__(self, max_board_rows=MAX_BOARD_ROWS):
+        self.max_board_rows = max_board_rows
+        self.boards = {}  # (window, gender_location) -> RankedBoard
+        self.loading = {}  # (window, gender_location) -> pending updates
+        self.too_big = set()
+        self.consumer = None
+        self._lock = RLock()
+        self._loader = ThreadPoolExecutor(max_workers=LOAD_WORKERS)
+
+    def start(self, follow=False):
+        """Load the boards across every gender_location, and with follow,
+        follow settings.LEADERBOARD_STREAM for other processes' updates.
+
+        """
+        if follow:
+            self.consumer = kinesis.StreamConsumer(
+                settings.LEADERBOARD_STREAM, batch_size=100, linger=0.5,
+                max_duration=None, follow=True, latest=True,
+                interval=get_follow_interval())
+            thread = Thread(target=self._follow, name='ranking-follow')
+            thread.daemon = True
+            thread.start()
+        for window, duration in leaderboard.WINDOWS:
+            self.load(window, leaderboard.ALL)
+
+    def stop(self):
+        if self.consumer is not None:
+            self.consumer.stop()
+        self._loader.shutdown(wait=False)
+
+    def load(self, window, gender_location):
+        """Start loading a board, if it isn't loaded or loading."""
+        board_key = (window, gender_location)
+        with self._lock:
+            if board_key in self.boards or board_key in self.loading or \
+               board_key in self.too_big:
+                return
+            self.loading[board_key] = []
+        return self._loader.submit(self._load, window, gender_location)
+
+    def _load(self, window, gender_location):
+        board_key = (window, gender_location)
+        start_time = now()
+        board = RankedBoard()
+        try:
+            for row in leaderboard.get_top(window, gender_location):
+                if len(board) == self.max_board_rows:
+                    log.warn("ranking board %s_%s is too big to keep",
+                             window, gender_location)
+                    with self._lock:
+                        del self.loading[board_key]
+                        self.too_big.add(board_key)
+                    return
+                board.put(row.uuid, row.score, row.expires)
+        except Exception as e:
+            log.error("ranking load %s_%s had Exception %s", window,
+                      gender_location, e)
+            log.exception(e)
+            with self._lock:
+                del self.loading[board_key]
+            return
+        with self._lock:
+            for photo_uuid, score, expires in self.loading.pop(board_key):
+                board.put(photo_uuid, score, expires)
+            self.boards[board_key] = board
+        log.info("ranking load %s_%s, %s" % (
+            window, gender_location, took(len(board), 'row', start_time)))
+
+    def apply(self, gender_location, photo_uuid, post_date_seconds, score):
+        """Put a photo on the loaded boards it hasn't expired from."""
+        gender_location = get_base_gender_location(gender_location)
+        current_seconds = get_ttl_seconds(now())
+        with self._lock:
+            for window, duration in leaderboard.WINDOWS:
+                expires = post_date_seconds + int(duration.total_seconds())
+                if expires <= current_seconds:
+                    continue
+                for board_gender_location in (gender_location,
+                                              leaderboard.ALL):
+                    board_key = (window, board_gender_location)
+                    board = self.boards.get(board_key)
+                    if board is not None:
+                        board.put(photo_uuid, score, expires)
+                    elif board_key in self.loading:
+                        self.loading[board_key].append(
+                            (photo_uuid, score, expires))
+
+    def _get_board(self, window, gender_location):
+        """The loaded board, None after starting to load a cold one."""
+        with self._lock:
+            board = self.boards.get((window, gender_location))
+        if board is None:
+            self.load(window, gender_location)
+        return board
+
+    def top(self, window, gender_location, count, after=None):
+        """Up to count photo uuids from the top of a board, or from after
+        the uuid after. None if the board is cold.
+
+        """
+        board = self._get_board(window, gender_location)
+        if board is None:
+            return None
+        with self._lock:
+            board.expire(get_ttl_seconds(now()))
+            return board.top(count, after)
+
+    def rank(self, window, gender_location, photo_uuid):
+        """A photo's place on a board, 0 for the top.
+
+        None if the photo isn't on the board, or the board is cold, see
+        is_warm.
+
+        """
+        board = self._get_board(window, gender_location)
+        if board is None:
+            return None
+        with self._lock:
+            board.expire(get_ttl_seconds(now()))
+            return board.rank(photo_uuid)
+
+    def count(self, window, gender_location):
+        """How many photos are on a board, None if it is cold."""
+        board = self._get_board(window, gender_location)
+        if board is None:
+            return None
+        with self._lock:
+            board.expire(get_ttl_seconds(now()))
+            return len(board)
+
+    def is_warm(self, window, gender_location):
+        with self._lock:
+            return (window, gender_location) in self.boards
+
+    def _follow(self):
+        try:
+            for batch in self.consumer:
+                for data in batch:
+                    try:
+                        self.apply(*decode_ranking(data))
+                    except Exception as e:
+                        log.error("ranking could not apply %r, %s", data, e)
+        except Exception as e:
+            log.error("ranking follow had Exception %s", e)
+            log.exception(e)
+
+
+def encode_ranking(gender_location, photo_uuid, post_date, score):
+    """A Leaderboard stream record of a photo put on the boards."""
+    return RANKING_RECORD_HEADER.pack(
+        RANKING_RECORD_VERSION, photo_uuid.bytes, score,
+        get_ttl_seconds(post_date)) + gender_location.encode('utf-8')
+
+def decode_ranking(data):
+    """(gender_location, uuid, post_date seconds, score) of a record."""
+    data = bytes(data)
+    version, photo_uuid, score, post_date_seconds = \
+        RANKING_RECORD_HEADER.unpack_from(data)
+    if version != RANKING_RECORD_VERSION:
+        raise ValueError('unknown ranking record version %s' % version)
+    gender_location = data[RANKING_RECORD_HEADER.size:].decode('utf-8')
+    return gender_location, UUID(bytes=photo_uuid), post_date_seconds, score
+
+def publish(gender_location, photo_uuid, post_date, score):
+    """Tell every process' engine that a photo was put on the boards."""
+    if ENGINE is not None and ENGINE_PID == os.getpid():
+        ENGINE.apply(gender_location, photo_uuid, get_ttl_seconds(post_date),
+                     score)
+    kinesis.put_record(settings.LEADERBOARD_STREAM,
+                       encode_ranking(gender_location, photo_uuid, post_date,
+                                      score),
+                       photo_uuid.hex)
+
+def get_follow_interval():
+    """Seconds between a follower's reads of a shard, so that all
+    settings.LEADERBOARD_FOLLOWERS of them stay within the shard's limit."""
+    return max(kinesis.GET_RECORDS_INTERVAL,
+               settings.LEADERBOARD_FOLLOWERS / FOLLOWER_READS_PER_SECOND)
+
+def get_engine():
+    """The process' RankingEngine, None unless it is enabled.
+
+    Made and started on first use, and again after a fork.
+
+    """
+    global ENGINE, ENGINE_PID
+    if not settings.LEADERBOARD_CACHE_ENABLED:
+        return None
+    if ENGINE is None or ENGINE_PID != os.getpid():
+        ENGINE = RankingEngine()
+        ENGINE_PID = os.getpid()
+        ENGINE.start(follow=settings.KINESIS_ENABLED)
+    return ENGINE
+
+def get_page(window, gender_location, after, count):
+    """Up to count photo uuids from a board, from the top or after the
+    photo with the hex uuid after.
+
+    None if there is no engine or the board is cold, read DynamoDB then.
+
+    """
+    engine = get_engine()
+    if engine is None:
+        return None
+    after_uuid = None
+    if after:
+        try:
+            after_uuid = UUID(after)
+        except ValueError:
+            return []
+    return engine.top(window, gender_location, count, after=after_uuid)
+
+def get_rank(window, gender_location, photo_uuid):
+    """(rank, count) of a photo on a board, rank 0 for the top and None if
+    the photo isn't on it.
+
+    None if there is no engine or the board is cold.
+
+    """
+    engine = get_engine()
+    if engine is None:
+        return None
+    rank = engine.rank(window, gender_location, photo_uuid)
+    count = engine.count(window, gender_location)
+    if count is None:
+        return None
+    return rank, count
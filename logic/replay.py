@@ -0,0 +1,398 @@
+from __future__ import division, absolute_import, unicode_literals
+
+# Replay recomputes every photo's rating from the Match history, for when a
+# scoring bug or a TAU change means the stored ratings are wrong.
+#
+# 1. Scan Photo and the judged Matches, a few segments at a time in
+#    parallel. Matches are kept as numpy arrays of photo indexes.
+# 2. Partition the matches by gender_location. Ratings in one
+#    gender_location don't depend on any other, unless a match crosses
+#    them, so gender_locations joined by such a match share a partition.
+# 3. Replay each partition on a process pool in judged_date order, one
+#    Glicko2 rating period (rate_batch) per REPLAY_PERIOD of votes, the way
+#    the scorer rates a batch at a time.
+# 4. Diff the replayed ratings against the stored ones. The result is a
+#    ReplayPlan, report() it for a dry run and write() it to apply it.
+#
+#     >>> from logic.replay import replay
+#     >>> plan = replay()
+#     >>> print(plan.report())
+#     >>> plan.write()
+
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+import multiprocessing
+
+import numpy
+from pynamodb.constants import ATTR_TYPE_MAP, ITEMS, LAST_EVALUATED_KEY, \
+    SCAN_OPERATOR_MAP
+from pynamodb.exceptions import ScanError
+
+from log import log
+from logic.glicko2 import Glicko2, LOSS, WIN
+from logic import leaderboard
+from logic.score import TAU
+from model import backoff_sleep, get_ttl_seconds, Match, Photo, \
+    PhotoGenderTag, WriteBack
+from util import now, pluralize, took
+
+# Parallel scan segments per table.
+REPLAY_SEGMENTS = 8
+REPLAY_SCAN_ATTEMPTS = 10
+# Votes judged in the same period are rated together.
+REPLAY_PERIOD = timedelta(minutes=5)
+# Replayed ratings closer than this to the stored ones are left alone.
+REPLAY_TOLERANCE = 1e-6
+# Photos written per WriteBack commit.
+REPLAY_WRITE_CHUNK = 1000
+
+PHOTO_ATTRIBUTES = ('gender_location', 'uuid', 'post_date', 'score', 'phi',
+                    'sigma', 'tags')
+MATCH_ATTRIBUTES = ('photo_uuids', 'judged_date', 'a_won')
+NAIVE_EPOCH = datetime(1970, 1, 1)
+
+
+# -- Scan ---------------------------------------------------------------------
+
+def scan_segments(model_class, attribute_names, handle_segment,
+                  segments=REPLAY_SEGMENTS, **filters):
+    """Parallel scan of model_class, `segments` segments at once.
+
+    handle_segment is called on its own thread with an iterator of raw items
+    (attribute name -> deserialized value, only attribute_names) for each
+    segment. Returns the list of what it returned.
+
+    """
+    attributes = model_class._get_attributes()
+    key_filter, scan_filter = model_class._build_filters(
+        SCAN_OPERATOR_MAP, non_key_operator_map=SCAN_OPERATOR_MAP,
+        key_attribute_classes=attributes, filters=filters)
+    key_filter.update(scan_filter)
+    def items(segment):
+        if segments == 1:
+            segment = total_segments = None  # a plain scan
+        else:
+            total_segments = segments
+        connection = model_class._get_connection()
+        last_evaluated_key = None
+        while True:
+            attempt = 0
+            while True:
+                try:
+                    data = connection.scan(
+                        attributes_to_get=list(attribute_names),
+                        scan_filter=key_filter or None,
+                        segment=segment, total_segments=total_segments,
+                        exclusive_start_key=last_evaluated_key)
+                except ScanError as e:
+                    attempt += 1
+                    if attempt >= REPLAY_SCAN_ATTEMPTS:
+                        raise
+                    log.warn("replay scan %s segment %s retry %s, %s",
+                             model_class.Meta.table_name, segment, attempt, e)
+                    backoff_sleep(attempt)
+                else:
+                    break
+            for raw in data.get(ITEMS, []):
+                item = {}
+                for name, value in raw.iteritems():
+                    attribute = attributes[name]
+                    item[name] = attribute.deserialize(
+                        value[ATTR_TYPE_MAP[attribute.attr_type]])
+                yield item
+            last_evaluated_key = data.get(LAST_EVALUATED_KEY)
+            if not last_evaluated_key:
+                return
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        futures = [executor.submit(lambda s: handle_segment(items(s)), segment)
+                   for segment in xrange(segments)]
+        return [future.result() for future in futures]
+
+def _micros(value):
+    """Microseconds since the epoch of a UTCDateTimeAttribute value."""
+    delta = value.replace(tzinfo=None) - NAIVE_EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def get_initial_rating():
+    """The (score, phi, sigma) a new Photo starts with."""
+    attributes = Photo._get_attributes()
+    return (attributes['score'].default, attributes['phi'].default,
+            attributes['sigma'].default)
+
+def load_photos(segments=REPLAY_SEGMENTS):
+    """Every photo's key, post_date, rating and tags, as a list of dicts."""
+    start_time = now()
+    photos = [photo
+              for segment in scan_segments(Photo, PHOTO_ATTRIBUTES, list,
+                                           segments)
+              for photo in segment]
+    initial = get_initial_rating()
+    for photo in photos:
+        for name, default in zip(('score', 'phi', 'sigma'), initial):
+            photo.setdefault(name, default)
+    log.info("replay photos, %s" % took(len(photos), 'photo', start_time))
+    return photos
+
+def load_matches(photo_indexes, segments=REPLAY_SEGMENTS):
+    """Every judged Match as arrays (a, b, a_won, judged micros).
+
+    a and b index into the photos photo_indexes was made from. Matches whose
+    photos are gone or with no judged_date can't be replayed and are
+    counted in skipped.
+
+    """
+    def handle_segment(items):
+        a = array(b'l')
+        b = array(b'l')
+        a_won = array(b'b')
+        judged = array(b'l')
+        skipped = 0
+        for item in items:
+            uuid_a, uuid_b = item['photo_uuids']
+            index_a = photo_indexes.get(uuid_a)
+            index_b = photo_indexes.get(uuid_b)
+            judged_date = item.get('judged_date')
+            if index_a is None or index_b is None or judged_date is None:
+                skipped += 1
+                continue
+            a.append(index_a)
+            b.append(index_b)
+            # As in process_scores, a match without a_won goes to b.
+            a_won.append(1 if item.get('a_won') else 0)
+            judged.append(_micros(judged_date))
+        return a, b, a_won, judged, skipped
+    start_time = now()
+    results = scan_segments(Match, MATCH_ATTRIBUTES, handle_segment, segments,
+                            judged__eq=True)
+    a = _concatenate([r[0] for r in results], numpy.int_)
+    b = _concatenate([r[1] for r in results], numpy.int_)
+    a_won = _concatenate([r[2] for r in results], numpy.int8).astype(bool)
+    judged = _concatenate([r[3] for r in results], numpy.int_)
+    skipped = sum(r[4] for r in results)
+    log.info("replay matches, %s, %s skipped" % (
+        took(len(a), 'match', 'matches', start_time), skipped))
+    return a, b, a_won, judged, skipped
+
+
+def _concatenate(arrays, dtype):
+    return numpy.concatenate([numpy.frombuffer(a, dtype=dtype) if len(a)
+                              else numpy.empty(0, dtype=dtype)
+                              for a in arrays])
+
+
+# -- Replay -------------------------------------------------------------------
+
+def partition_matches(gender_location_ids, a, b):
+    """Label each match with a partition, as an array of root ids.
+
+    gender_location_ids maps photo index to a gender_location number.
+    Matches share a partition if they share a gender_location, directly or
+    through a match that crosses two of them.
+
+    """
+    parent = numpy.arange(
+        gender_location_ids.max() + 1 if len(gender_location_ids) else 0)
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+    a_ids = gender_location_ids[a]
+    b_ids = gender_location_ids[b]
+    crossing = a_ids != b_ids
+    if crossing.any():
+        pairs = numpy.unique(a_ids[crossing] * len(parent) + b_ids[crossing])
+        for pair in pairs:
+            root_a = find(pair // len(parent))
+            root_b = find(pair % len(parent))
+            if root_a != root_b:
+                parent[root_b] = root_a
+    roots = numpy.array([find(x) for x in xrange(len(parent))],
+                        dtype=numpy.int_)
+    return roots[a_ids]
+
+def replay_partition(a, b, a_won, judged, period_micros, initial, tau=TAU):
+    """Replay one partition's matches, in judged order, a period at a time.
+
+    Every photo starts from the initial (score, phi, sigma). Returns the
+    photo indexes and their replayed score, phi and sigma arrays. Runs in a
+    worker process.
+
+    """
+    env = Glicko2(tau=tau)
+    photos, inverse = numpy.unique(numpy.concatenate((a, b)),
+                                   return_inverse=True)
+    local_a = inverse[:len(a)]
+    local_b = inverse[len(a):]
+    mus = numpy.empty(len(photos))
+    phis = numpy.empty(len(photos))
+    sigmas = numpy.empty(len(photos))
+    mus.fill(initial[0])
+    phis.fill(initial[1])
+    sigmas.fill(initial[2])
+    order = numpy.argsort(judged, kind='mergesort')
+    local_a = local_a[order]
+    local_b = local_b[order]
+    a_won = a_won[order]
+    periods = judged[order] // period_micros
+    bounds = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(periods)) + 1,
+                                [len(periods)]))
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        winners = numpy.where(a_won[start:end], local_a[start:end],
+                              local_b[start:end])
+        losers = numpy.where(a_won[start:end], local_b[start:end],
+                             local_a[start:end])
+        # Rate only the photos in this period, the same as the scorer.
+        rated, games = numpy.unique(numpy.concatenate((winners, losers)),
+                                    return_inverse=True)
+        winners = games[:end - start]
+        losers = games[end - start:]
+        # One row per game as seen by each photo, winner then loser.
+        players = numpy.column_stack((winners, losers)).ravel()
+        opponents = numpy.column_stack((losers, winners)).ravel()
+        outcomes = numpy.tile([WIN, LOSS], end - start)
+        mus[rated], phis[rated], sigmas[rated] = env.rate_batch(
+            mus[rated], phis[rated], sigmas[rated],
+            players, opponents, outcomes)
+    return photos, mus, phis, sigmas
+
+def replay(period=REPLAY_PERIOD, processes=None, segments=REPLAY_SEGMENTS):
+    """Recompute every photo's rating from the judged Matches.
+
+    Returns a ReplayPlan, nothing is written until its write() is called.
+
+    """
+    start_time = now()
+    photos = load_photos(segments)
+    photo_indexes = dict((photo['uuid'], index)
+                         for index, photo in enumerate(photos))
+    a, b, a_won, judged, skipped = load_matches(photo_indexes, segments)
+
+    gender_location_numbers = {}
+    gender_location_ids = numpy.array(
+        [gender_location_numbers.setdefault(photo['gender_location'],
+                                            len(gender_location_numbers))
+         for photo in photos], dtype=numpy.int_)
+    partitions = partition_matches(gender_location_ids, a, b)
+    order = numpy.argsort(partitions, kind='mergesort')
+    labels = partitions[order]
+    bounds = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(labels)) + 1,
+                                [len(labels)])) if len(labels) else []
+    # Biggest partitions first, so the pool isn't left waiting on one.
+    slices = sorted((order[start:end] for start, end
+                     in zip(bounds[:-1], bounds[1:])),
+                    key=len, reverse=True)
+    log.info("replay %s in %s" % (pluralize(len(a), 'match', 'matches'),
+                                  pluralize(len(slices), 'partition')))
+
+    initial = get_initial_rating()
+    period_micros = int(period.total_seconds() * 1000000)
+    replayed = {}  # photo index -> (score, phi, sigma)
+    with ProcessPoolExecutor(
+            max_workers=processes or multiprocessing.cpu_count()) as executor:
+        futures = [executor.submit(replay_partition, a[rows], b[rows],
+                                   a_won[rows], judged[rows], period_micros,
+                                   initial)
+                   for rows in slices]
+        for future in futures:
+            indexes, mus, phis, sigmas = future.result()
+            for index, mu, phi, sigma in zip(indexes, mus, phis, sigmas):
+                replayed[index] = (float(mu), float(phi), float(sigma))
+    log.info("replay ratings, %s" % took(len(replayed), 'photo', start_time))
+    return ReplayPlan(photos, replayed, match_count=len(a), skipped=skipped)
+
+
+# -- Plan ---------------------------------------------------------------------
+
+class ReplayPlan(object):
+    """The replayed ratings that differ from the stored ones.
+
+    changes is a list of (photo, (score, phi, sigma)), photo being the dict
+    load_photos read. Photos that weren't in any replayed match are left
+    out, their stored rating stands.
+
+    """
+    def __init__(self, photos, replayed, match_count=0, skipped=0):
+        self.photo_count = len(photos)
+        self.replayed_count = len(replayed)
+        self.match_count = match_count
+        self.skipped = skipped
+        self.changes = []
+        for index, rating in sorted(replayed.iteritems()):
+            photo = photos[index]
+            stored = (photo['score'], photo['phi'], photo['sigma'])
+            if any(abs(new - old) > REPLAY_TOLERANCE
+                   for new, old in zip(rating, stored)):
+                self.changes.append((photo, rating))
+
+    def __len__(self):
+        return len(self.changes)
+
+    def report(self, top=20):
+        """A dry-run diff, what write() would change."""
+        lines = ['replayed {} from {}, {} skipped'.format(
+                     pluralize(self.replayed_count, 'photo'),
+                     pluralize(self.match_count, 'match', 'matches'),
+                     self.skipped),
+                 '{} of {} would change'.format(
+                     pluralize(len(self.changes), 'photo'), self.photo_count)]
+        by_gender_location = {}
+        for photo, rating in self.changes:
+            deltas = by_gender_location.setdefault(photo['gender_location'],
+                                                   [])
+            deltas.append(rating[0] - photo['score'])
+        for gender_location, deltas in sorted(by_gender_location.iteritems()):
+            lines.append('  {} {} changed, mean |delta| {:.2f}, '
+                         'max |delta| {:.2f}'.format(
+                             gender_location, len(deltas),
+                             sum(abs(d) for d in deltas) / len(deltas),
+                             max(abs(d) for d in deltas)))
+        movers = sorted(self.changes,
+                        key=lambda change: abs(change[1][0] - change[0]['score']),
+                        reverse=True)[:top]
+        if movers:
+            lines.append('biggest moves:')
+        for photo, rating in movers:
+            lines.append('  {} {} {:.2f} -> {:.2f} (phi {:.2f} -> {:.2f})'.format(
+                photo['gender_location'], photo['uuid'].hex, photo['score'],
+                rating[0], photo['phi'], rating[1]))
+        return '\n'.join(lines)
+
+    def write(self, chunk=REPLAY_WRITE_CHUNK):
+        """Write the changed ratings to Photo, its tags and leaderboards."""
+        start_time = now()
+        write_count = 0
+        current_seconds = get_ttl_seconds(start_time)
+        initial_phi = get_initial_rating()[1]
+        for offset in xrange(0, len(self.changes), chunk):
+            write_back = WriteBack()
+            for photo, (score, phi, sigma) in \
+                    self.changes[offset:offset + chunk]:
+                gender_location = photo['gender_location']
+                photo_uuid = photo['uuid']
+                # Updates, not saves, so a photo edited since the scan
+                # keeps everything but its rating, and a deleted one stays
+                # deleted.
+                write_back.update(Photo(gender_location, photo_uuid,
+                                        score=score, phi=phi, sigma=sigma),
+                                  ['score', 'phi', 'sigma'],
+                                  uuid__exists=True)
+                gender = 'm' if gender_location.startswith('m') else 'f'
+                for tag in photo.get('tags') or []:
+                    gender_tag = '{}_{}'.format(gender, tag.lower())
+                    write_back.update(PhotoGenderTag(gender_tag,
+                                                     uuid=photo_uuid,
+                                                     score=score),
+                                      ['score'], uuid__exists=True)
+                old_score = photo['score']
+                if photo['phi'] == initial_phi:
+                    # Not rated before, so not on the leaderboards.
+                    old_score = None
+                leaderboard.put(write_back, gender_location, photo_uuid,
+                                photo.get('post_date'), score,
+                                old_score=old_score,
+                                current_seconds=current_seconds)
+            write_count += write_back.commit()
+        log.info("replay write, %s" % took(write_count, 'write', start_time))
+        return write_count
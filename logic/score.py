@@ -1,51 +1,153 @@
 from __future__ import division, absolute_import, unicode_literals
 
 
+from collections import namedtuple
 from datetime import timedelta
-from time import sleep
+import struct
 from uuid import UUID
 
+import numpy
 from boto.kinesis.exceptions import InvalidArgumentException, \
     ProvisionedThroughputExceededException
 from botocore.vendored.requests.exceptions import ConnectionError
-from pynamodb.exceptions import DeleteError
 from pynamodb.models import DoesNotExist
 
 from logic import kinesis
-from logic.location import LOCATIONS
+from logic import leaderboard
+from logic import lease
 from log import log
 from logic.glicko2 import Glicko2, WIN, LOSS
-from model import get_one, Match, Photo, PhotoGenderTag, HourLeaderboard, \
-    MonthLeaderboard, ShardIterator, TodayLeaderboard, User, WeekLeaderboard, \
-    YearLeaderboard
-from logic.photo import get_photo_hour, get_photo_month, get_photo_today, \
-    get_photo_week, get_photo_year
+from model import backoff_sleep, get_one, get_ttl_seconds, Match, Photo, \
+    PhotoGenderTag, ShardIterator, User, WriteBack
+from logic.photo import get_photos_by_uuid
 from logic import sentry
+from logic.stats import incr, timing
 from settings import settings
-from util import now, took
+from util import epoch, now, pluralize, took
 
 
 TAU = 0.2
-
+# Most matches rated together, as one rating period, by do_scores.
+SCORE_BATCH_SIZE = 5000
+# The streaming scorer rates a period at least every STREAM_SCORE_PERIOD
+# seconds, sooner if STREAM_SCORE_BATCH_SIZE matches are waiting.
+STREAM_SCORE_PERIOD = 2.0
+STREAM_SCORE_BATCH_SIZE = 500
+# Whoever holds this lease is the only one reading the score stream.
+SCORE_LEASE = 'score'
+# Times a batch is tried before it is logged and checkpointed past, so a
+# bad record can't stop scoring.
+SCORE_BATCH_ATTEMPTS = 3
+# predict_matches remembers the (win, lose) deltas of a photo's rating
+# against an opponent's rating. It starts over when it reaches this size.
+PREDICTION_CACHE_SIZE = 100000
+_predictions = {}  # ((score, phi, sigma), opponent's) -> (win, lose)
+
+
+# Score records are a versioned binary format, so the scorer can rate a vote
+# without reading its Match. Version 1 is a header of version, photo a, photo
+# b and user uuids, flags and the judged date (microseconds since the epoch),
+# then photo a's and photo b's gender_location, each a length byte and utf-8.
+SCORE_RECORD_VERSION = 1
+SCORE_RECORD_HEADER = struct.Struct(b'>B16s16s16sBq')
+SCORE_RECORD_A_WON = 1
+SCORE_RECORD_HAS_A_WON = 2
+SCORE_RECORD_HAS_JUDGED_DATE = 4
+# Before version 1 a record was the hex of photo a, photo b and user uuids.
+LEGACY_RECORD_LENGTH = 96
+
+ScoreRecord = namedtuple('ScoreRecord', ['photo_uuids', 'user_uuid', 'a_won',
+                                         'judged_date', 'gender_locations'])
+
+def _pack_string(value):
+    value = (value or '').encode('utf-8')
+    return struct.pack(b'>B', len(value)) + value
+
+def _unpack_string(data, offset):
+    length = ord(data[offset])
+    offset += 1
+    value = data[offset:offset + length].decode('utf-8')
+    return value or None, offset + length
 
 def encode_match(match):
     photo_a_uuid, photo_b_uuid = match.photo_uuids
-    return '%s%s%s' % (photo_a_uuid.hex, photo_b_uuid.hex, match.user_uuid.hex)
+    flags = 0
+    if match.a_won is not None:
+        flags |= SCORE_RECORD_HAS_A_WON
+        if match.a_won:
+            flags |= SCORE_RECORD_A_WON
+    judged = 0
+    if match.judged_date is not None:
+        flags |= SCORE_RECORD_HAS_JUDGED_DATE
+        delta = match.judged_date - epoch
+        judged = ((delta.days * 86400 + delta.seconds) * 1000000 +
+                  delta.microseconds)
+    return (SCORE_RECORD_HEADER.pack(SCORE_RECORD_VERSION, photo_a_uuid.bytes,
+                                     photo_b_uuid.bytes, match.user_uuid.bytes,
+                                     flags, judged) +
+            _pack_string(match.a_gender_location) +
+            _pack_string(match.b_gender_location))
 
 def decode_match(data):
-    return Match.get((UUID(data[:32]), UUID(data[32:64])), UUID(data[64:96]),
-                     consistent_read=False)
+    """Return the ScoreRecord in data.
+
+    A legacy hex record doesn't carry the vote, so its Match is read.
+
+    """
+    if len(data) == LEGACY_RECORD_LENGTH and data[:1] != chr(SCORE_RECORD_VERSION):
+        return _decode_legacy_match(data)
+    data = bytes(data)
+    (version, photo_a_bytes, photo_b_bytes, user_bytes, flags,
+     judged) = SCORE_RECORD_HEADER.unpack_from(data)
+    if version != SCORE_RECORD_VERSION:
+        raise ValueError('Unknown score record version %s' % version)
+    a_won = None
+    if flags & SCORE_RECORD_HAS_A_WON:
+        a_won = bool(flags & SCORE_RECORD_A_WON)
+    judged_date = None
+    if flags & SCORE_RECORD_HAS_JUDGED_DATE:
+        judged_date = epoch + timedelta(microseconds=judged)
+    offset = SCORE_RECORD_HEADER.size
+    a_gender_location, offset = _unpack_string(data, offset)
+    b_gender_location, offset = _unpack_string(data, offset)
+    return ScoreRecord((UUID(bytes=photo_a_bytes), UUID(bytes=photo_b_bytes)),
+                       UUID(bytes=user_bytes), a_won, judged_date,
+                       (a_gender_location, b_gender_location))
+
+def _decode_legacy_match(data):
+    match = Match.get((UUID(data[:32]), UUID(data[32:64])), UUID(data[64:96]),
+                      consistent_read=False)
+    # Matches are made from the judge's view gender_location, and everyone
+    # views 'f', so that is where the photos most likely are.
+    gender_location = None
+    if match.location is not None:
+        gender_location = Photo.make_gender_location(False,
+                                                     match.location.hex)
+    return ScoreRecord(match.photo_uuids, match.user_uuid, match.a_won,
+                       match.judged_date, (gender_location, gender_location))
+
+def get_match_partition_key(match):
+    """Partition key for a match on the score stream.
+
+    Keyed on the photo pair, so a busy gender_location still spreads over
+    every shard. Sorted, so the pair has one key whichever is 'a'.
+
+    """
+    return ''.join(sorted(photo_uuid.hex for photo_uuid in match.photo_uuids))
 
 def log_match_for_scoring(match):
     data = encode_match(match)
-    partition_key = '0'
-    log.info("log_match_for_scoring {} {} {}".format(settings.SCORE_STREAM, data, partition_key))
-    kinesis.get_kinesis().put_record(settings.SCORE_STREAM, data, partition_key)
+    partition_key = get_match_partition_key(match)
+    log.info("log_match_for_scoring {} {}".format(settings.SCORE_STREAM, partition_key))
+    kinesis.put_record(settings.SCORE_STREAM, data, partition_key)
 
 def get_scores():
-    result = []
     log.info("get_scores {}".format(settings.SCORE_STREAM))
-    for item in kinesis.get_all(settings.SCORE_STREAM):
+    return decode_matches(kinesis.get_all(settings.SCORE_STREAM))
+
+def decode_matches(items):
+    result = []
+    for item in items:
         try:
             match = decode_match(item)
         except Exception as e:
@@ -58,9 +160,10 @@ def get_scores():
 
 def process_scores(matches):
     """
-    Given a list of (winner_g_l, winner_uuid,
-    loser_g_l, loser_uuid,) tuples, run them through glicko2 and
-    update the score, phi and sigma values in DynamoDB.
+    Given a list of ScoreRecords (see decode_match), run them through
+    glicko2 and update the score, phi and sigma values in DynamoDB.
+
+    Returns the gender_locations of the photos scored.
 
     """
 
@@ -70,7 +173,27 @@ def process_scores(matches):
 
     log.info("scoring - process_scores called with match iter")
     run_time = now()
-    photos_by_uuid = {}
+    current_seconds = get_ttl_seconds(run_time)
+    write_back = WriteBack()
+    matches = list(matches)
+    # Load every photo in the batch up front, by primary key where the
+    # record has the gender_location; the rest fall back to uuid_index.
+    # Periods run back to back, so the reads are consistent, a stale photo
+    # would undo the last period's rating and leave its leaderboard rows
+    # behind.
+    gender_locations = {}
+    for match in matches:
+        for photo_uuid, gender_location in zip(match.photo_uuids,
+                                               match.gender_locations):
+            if gender_location is not None:
+                gender_locations[photo_uuid] = gender_location
+    start_time = now()
+    judged_uuids = set(photo_uuid for match in matches
+                       for photo_uuid in match.photo_uuids)
+    photos_by_uuid = get_photos_by_uuid(judged_uuids, gender_locations,
+                                        consistent_read=True)
+    log.info("scoring - photo hydration, %s" % took(len(photos_by_uuid),
+                                                     'photo', start_time))
     def get_photo(photo_uuid):
         try:
             return photos_by_uuid[photo_uuid]
@@ -80,6 +203,23 @@ def process_scores(matches):
             photos_by_uuid[photo_uuid] = photo
             return photo
 
+    # A match whose photo is gone, deleted since it was judged, can't be
+    # rated, so it is dropped.
+    rateable = []
+    for match in matches:
+        if any(get_photo(photo_uuid) is None
+               for photo_uuid in match.photo_uuids):
+            log.warn("scoring - dropping match %s by %s, its photo is gone",
+                     ''.join(photo_uuid.hex
+                             for photo_uuid in match.photo_uuids),
+                     match.user_uuid.hex)
+            incr('score.missing_photo-incr')
+        else:
+            rateable.append(match)
+    matches = rateable
+    if not matches:
+        return set()
+
     # http://www.glicko.net/glicko/glicko2.pdf
     # https://github.com/sublee/glicko2
     #  (a) If the player is unrated, set the rating to 1500 and the RD to
@@ -97,8 +237,21 @@ def process_scores(matches):
     #
     # (Glicko-2) rating mu, rating deviation phi, and volatility sigma
 
-    photo_to_matches = {}  # photo_uuid -> match
-    user_to_matches = {}  # user_uuid -> match
+    photo_indexes = {}  # photo_uuid -> index into the rating arrays
+    photo_uuids = []
+    def get_index(photo):
+        try:
+            return photo_indexes[photo.uuid]
+        except KeyError:
+            photo_indexes[photo.uuid] = len(photo_uuids)
+            photo_uuids.append(photo.uuid)
+            return photo_indexes[photo.uuid]
+
+    # One row per game as seen by each photo, in match order.
+    players = []
+    opponents = []
+    outcomes = []
+    user_counts = {}  # user_uuid -> [win count, loss count]
     # We get events racked up about matches that got judged and need
     # post processing. Simulate them here.
     # * for winner, loser in list of matches that happened since last scoring.
@@ -112,50 +265,46 @@ def process_scores(matches):
         else:
             w = b
             l = a
-        to_winner = (WIN, l.score, l.phi, l.sigma,)
-        try:
-            photo_to_matches[w.uuid].append(to_winner)
-        except KeyError:
-            photo_to_matches[w.uuid] = [to_winner]
-        to_loser = (LOSS, w.score, w.phi, w.sigma)
-        try:
-            photo_to_matches[l.uuid].append(to_loser)
-        except KeyError:
-            photo_to_matches[l.uuid] = [to_loser]
-        match.scored_date = run_time
-        match.save()
-        if w.user_uuid not in user_to_matches:
-            user_to_matches[w.user_uuid] = {}
-        if 'wins' not in user_to_matches[w.user_uuid]:
-            user_to_matches[w.user_uuid]['wins'] = []
-        user_to_matches[w.user_uuid]['wins'].append(w)
-        if l.user_uuid not in user_to_matches:
-            user_to_matches[l.user_uuid] = {}
-        if 'losses' not in user_to_matches[l.user_uuid]:
-            user_to_matches[l.user_uuid]['losses'] = []
-        user_to_matches[l.user_uuid]['losses'].append(l)
-    log.info("number of keys to score-adjust %s" % len(photo_to_matches.keys()))
-
-    for photo_uuid, record in photo_to_matches.iteritems():
-        env = Glicko2(tau=TAU)
-        photo = get_photo(photo_uuid)
-        rating = env.create_rating(photo.score, photo.phi, photo.sigma)
-        rating_record = []
-        for result, score, phi, sigma in record:
-            opponent_rating = env.create_rating(score, phi, sigma)
-            rating_record.append((result, opponent_rating,))
-        # Glicko2 calculation.
-        rated = env.rate(rating, rating_record)
+        w_index = get_index(w)
+        l_index = get_index(l)
+        players.extend((w_index, l_index))
+        opponents.extend((l_index, w_index))
+        outcomes.extend((WIN, LOSS))
+        # Only if the Match is still there, this must not create one.
+        write_back.update(Match(match.photo_uuids, match.user_uuid,
+                                scored_date=run_time),
+                          ['scored_date'], user_uuid__exists=True)
+        user_counts.setdefault(w.user_uuid, [0, 0])[0] += 1
+        user_counts.setdefault(l.user_uuid, [0, 0])[1] += 1
+    log.info("number of keys to score-adjust %s" % len(photo_uuids))
+
+    # Glicko2 calculation, every photo in this run at once.
+    photos = [get_photo(photo_uuid) for photo_uuid in photo_uuids]
+    start_time = now()
+    env = Glicko2(tau=TAU)
+    mus, phis, sigmas = env.rate_batch([photo.score for photo in photos],
+                                       [photo.phi for photo in photos],
+                                       [photo.sigma for photo in photos],
+                                       players, opponents, outcomes)
+    log.info("scoring - rate_batch, %s" % took(len(photos), 'photo',
+                                                start_time))
+
+    record_counts = {}
+    for index in players:
+        record_counts[index] = record_counts.get(index, 0) + 1
+    for index, photo in enumerate(photos):
+        photo_uuid = photo.uuid
+        # An unrated photo isn't on the leaderboards yet.
+        old_score = photo.score if photo.get_is_rated() else None
         before = "%s %s %s" % (photo.score, photo.phi, photo.sigma)
-        score = rated.mu
+        score = float(mus[index])
         photo.score = score
-        photo.phi = rated.phi
-        photo.sigma = rated.sigma
+        photo.phi = float(phis[index])
+        photo.sigma = float(sigmas[index])
         log.info("rating change for %s from %s to %s %s %s from a record count of %s",
             photo_uuid.hex, before, score,
-            photo.phi, photo.sigma, len(record))
-        # This could fail due to provision error.
-        photo.save()
+            photo.phi, photo.sigma, record_counts[index])
+        write_back.save(photo)
         for tag in photo.get_tags():
             gender = 'm' if photo.get_is_gender_male() else 'f'
             gender_tag = '{}_{}'.format(gender, tag.lower())
@@ -172,139 +321,166 @@ def process_scores(matches):
                                                         uuid=photo.uuid,
                                                         score=score,
                                                         tag_with_case=tag)
-                photo_gender_tag.save()
+                write_back.save(photo_gender_tag)
             else:
                 photo_gender_tag.score = score
-                photo_gender_tag.save()
-
-        hour_leaderboard = get_photo_hour(photo.uuid)
-        if hour_leaderboard is None:
-            hour_leaderboard = HourLeaderboard(photo.gender_location,
-                                               uuid=photo.uuid,
-                                               post_date=photo.post_date)
-        hour_leaderboard.score = rated.mu
-        hour_leaderboard.save()
-
-        today_leaderboard = get_photo_today(photo.uuid)
-        if today_leaderboard is None:
-            today_leaderboard = TodayLeaderboard(photo.gender_location,
-                                                 uuid=photo.uuid,
-                                                 post_date=photo.post_date)
-        today_leaderboard.score = rated.mu
-        today_leaderboard.save()
-
-        week_leaderboard = get_photo_week(photo.uuid)
-        if week_leaderboard is None:
-            week_leaderboard = WeekLeaderboard(photo.gender_location,
-                                               uuid=photo.uuid,
-                                               post_date=photo.post_date)
-        week_leaderboard.score = rated.mu
-        week_leaderboard.save()
-
-        month_leaderboard = get_photo_month(photo.uuid)
-        if month_leaderboard is None:
-            month_leaderboard = MonthLeaderboard(photo.gender_location,
-                                                 uuid=photo.uuid,
-                                                 post_date=photo.post_date)
-        month_leaderboard.score = rated.mu
-        month_leaderboard.save()
-
-        year_leaderboard = get_photo_year(photo.uuid)
-        if year_leaderboard is None:
-            year_leaderboard = YearLeaderboard(photo.gender_location,
-                                               uuid=photo.uuid,
-                                               post_date=photo.post_date)
-        year_leaderboard.score = rated.mu
-        year_leaderboard.save()
-
-    for user_uuid, wins_and_losses in user_to_matches.iteritems():
-        wins = wins_and_losses.get('wins', [])
-        win_count = len(wins)
-        losses = wins_and_losses.get('losses', [])
-        loss_count = len(losses)
-
-        user = User.get(user_uuid, consistent_read=False)
-        if user is None:
-            user = User.get(user_uuid)
-        user.win_count += win_count
-        user.loss_count += loss_count
-        user.save()
-
-def do_scores():
-    return process_scores(get_scores())
-
-def predict_match(match, photo_a, photo_b):
-    match.a_win_delta = predict_photo(WIN, photo_a, photo_b)
-    match.a_lose_delta = predict_photo(LOSS, photo_a, photo_b)
-    match.b_win_delta = predict_photo(WIN, photo_b, photo_a)
-    match.b_lose_delta = predict_photo(LOSS, photo_b, photo_a)
+                write_back.save(photo_gender_tag)
+
+        leaderboard.put(write_back, photo.gender_location, photo_uuid,
+                        photo.post_date, score, old_score=old_score,
+                        current_seconds=current_seconds)
+
+    # The counts are added by DynamoDB, so the Users aren't read and a
+    # concurrent save of the User isn't overwritten. The condition keeps
+    # the ADD from creating a User that was deleted.
+    for user_uuid, (win_count, loss_count) in user_counts.iteritems():
+        user = User(user_uuid, win_count=win_count, loss_count=loss_count)
+        attribute_names = [name for name, count
+                           in (('win_count', win_count),
+                               ('loss_count', loss_count)) if count]
+        write_back.update(user, attribute_names, action='ADD',
+                          uuid__exists=True)
 
-def predict_photo(result, photo_a, photo_b):
-    original_rating = photo_a.score
-    env = Glicko2(tau=TAU)
-    rating_a = env.create_rating(photo_a.score, photo_a.phi, photo_a.sigma)
-    rating_b = env.create_rating(photo_b.score, photo_b.phi, photo_b.sigma)
-    rating_record = [(result, rating_b)]
-    rated = env.rate(rating_a, rating_record)
-    return rated.mu - original_rating
-
-def _trim(query, cutoff_datetime):
-    """Delete all items older than the cutoff date."""
-    trims = 0
-    for location in LOCATIONS.keys():
-        for gender in ['m', 'f']:
-            gender_location = '%s%s' % (gender, location.hex)
-            start_time = now()
-            item_count = 0
-            for item in query(gender_location, consistent_read=False):
-                if item.post_date < cutoff_datetime:
-                    while True:
-                        try:
-                            # TODO: Retry should be in pynamodb, not sure
-                            # why it is not automatic.
-                            # I put this in because I found this exception
-                            # in the logs:
-                            # DeleteError: Failed to delete item: An error occurred (ProvisionedThroughputExceededException) when calling the DeleteItem operation: The level of configured provisioned throughput for the table was exceeded. Consider increasing your provisioning level with the UpdateTable API
-                            item.delete()
-                        except DeleteError:
-                            sleep(0.2)
-                        else:
-                            break
-                    item_count += 1
-                else:
-                    break
-            took_str = took(item_count, 'entry', 'entries', start_time)
-            log.info("leaderboard trim %s, %s" % (gender_location, took_str))
-            trims += 1
-    return trims
-
-def trim_hour_leaderboards():
     start_time = now()
-    count = _trim(HourLeaderboard.date_index.query, now()-timedelta(hours=1))
-    log.info("trimming hour leaderboards, %s" %
-                took(count, 'leaderboard', start_time))
+    write_count = write_back.commit()
+    duration = (now() - start_time).total_seconds()
+    timing('score.write_back-timing', duration)
+    incr('score.write_back-incr', write_count)
+    log.info("scoring - write back, %s in %s" % (
+        took(write_count, 'write', start_time),
+        pluralize(write_back.request_count, 'request')))
+    return set(photo.gender_location for photo in photos)
+
+def do_scores(on_scored=None):
+    """Score everything pending on the score stream, a batch at a time.
+
+    Each micro-batch is one Glicko2 rating period, and is checkpointed once
+    its results are written, then on_scored, if given, is called with the
+    period's gender_locations. A batch that fails SCORE_BATCH_ATTEMPTS times
+    is logged and checkpointed past. This is the cron fallback, it does
+    nothing while the streaming scorer holds the score lease.
 
-def trim_today_leaderboards():
-    start_time = now()
-    count = _trim(TodayLeaderboard.date_index.query, now()-timedelta(days=1))
-    log.info("trimming today leaderboards, %s" %
-                took(count, 'leaderboard', start_time))
+    """
+    consumer = kinesis.StreamConsumer(settings.SCORE_STREAM,
+                                      batch_size=SCORE_BATCH_SIZE)
+    return _score_with_lease(consumer, lease.get_owner(), on_scored)
 
-def trim_week_leaderboards():
-    start_time = now()
-    count = _trim(WeekLeaderboard.date_index.query, now()-timedelta(days=7))
-    log.info("trimming week leaderboards, %s" %
-                took(count, 'leaderboard', start_time))
+def stream_scores(owner, on_scored=None):
+    """Score the stream as votes arrive, for as long as owner holds the lease.
 
-def trim_month_leaderboards():
-    start_time = now()
-    count = _trim(MonthLeaderboard.date_index.query, now()-timedelta(days=31))
-    log.info("trimming month leaderboards, %s" %
-                took(count, 'leaderboard', start_time))
+    Rating periods are small, STREAM_SCORE_BATCH_SIZE matches or
+    STREAM_SCORE_PERIOD seconds, so leaderboards are seconds behind the votes
+    and memory doesn't grow with the backlog. on_scored is as for do_scores.
+    Returns False right away if the lease is held by someone else, otherwise
+    returns once it is lost.
 
-def trim_year_leaderboards():
-    start_time = now()
-    count = _trim(YearLeaderboard.date_index.query, now()-timedelta(days=365))
-    log.info("trimming year leaderboards, %s" %
-                took(count, 'leaderboard', start_time))
+    """
+    consumer = kinesis.StreamConsumer(settings.SCORE_STREAM,
+                                      batch_size=STREAM_SCORE_BATCH_SIZE,
+                                      period=STREAM_SCORE_PERIOD,
+                                      max_duration=None, follow=True)
+    return _score_with_lease(consumer, owner, on_scored)
+
+def _score_with_lease(consumer, owner, on_scored=None):
+    if not lease.acquire(SCORE_LEASE, owner):
+        log.info("score lease held by %s, not scoring",
+                 lease.get_holder(SCORE_LEASE))
+        incr('score.lease_held-incr')
+        return False
+    keeper = lease.LeaseKeeper(SCORE_LEASE, owner, on_lost=consumer.stop)
+    keeper.start()
+    try:
+        for batch in consumer:
+            if keeper.lost.is_set():
+                # Someone else may be reading the stream now, leave this
+                # batch for them to score.
+                break
+            gender_locations = _score_batch(batch, keeper.lost)
+            if keeper.lost.is_set():
+                # Lost while scoring, the new holder starts from the last
+                # checkpoint, which mustn't move past what it's scoring.
+                break
+            consumer.checkpoint(batch)
+            if on_scored is not None:
+                on_scored(gender_locations)
+    finally:
+        keeper.stop()
+        lease.release(SCORE_LEASE, owner)
+    return True
+
+def _score_batch(batch, lost):
+    # Tries process_scores SCORE_BATCH_ATTEMPTS times, then gives up on the
+    # batch, logging its records, so the stream moves on. A batch that
+    # keeps failing is usually bad data rather than DynamoDB.
+    matches = decode_matches(batch)
+    attempt = 0
+    while not lost.is_set():
+        attempt += 1
+        try:
+            return process_scores(matches)
+        except Exception as e:
+            if lost.is_set():
+                raise
+            log.error("scoring - batch failed, attempt %s of %s: %s",
+                      attempt, SCORE_BATCH_ATTEMPTS, e)
+            log.exception(e)
+            if attempt == SCORE_BATCH_ATTEMPTS:
+                log.error("scoring - skipping batch of %s",
+                          pluralize(len(batch), 'record'))
+                for record in batch:
+                    log.error("scoring - skipped record %r", record)
+                incr('score.batch_skipped-incr')
+                return set()
+            backoff_sleep(attempt, base=1.0, cap=10.0)
+    return set()
+
+def predict_match(match, photo_a, photo_b):
+    (match.a_win_delta, match.a_lose_delta,
+     match.b_win_delta, match.b_lose_delta) = predict_matches(
+        [(photo_a, photo_b)])[0]
+
+def predict_matches(pairs):
+    """The score deltas of each (photo_a, photo_b) pair.
+
+    Returns a list of (a_win, a_lose, b_win, b_lose) deltas, the same as
+    predict_photo gives. Ratings that haven't been predicted against each
+    other before are all rated in one rate_batch call.
 
+    """
+    sides = []
+    for photo_a, photo_b in pairs:
+        rating_a = (photo_a.score, photo_a.phi, photo_a.sigma)
+        rating_b = (photo_b.score, photo_b.phi, photo_b.sigma)
+        sides.append((rating_a, rating_b))
+        sides.append((rating_b, rating_a))
+    missing = list(set(side for side in sides if side not in _predictions))
+    if missing:
+        if len(_predictions) + len(missing) > PREDICTION_CACHE_SIZE:
+            _predictions.clear()
+        _predictions.update(zip(missing, _predict_sides(missing)))
+    return [_predictions[sides[index]] + _predictions[sides[index + 1]]
+            for index in xrange(0, len(sides), 2)]
+
+def _predict_sides(sides):
+    # Each side is rated twice, a win and a loss, as one-game rating
+    # periods. The players are the sides' ratings, twice over, followed by
+    # their opponents, who only play as opponents.
+    count = len(sides)
+    ratings = [rating for rating, opponent in sides] * 2 + \
+              [opponent for rating, opponent in sides]
+    mu, phi, sigma = numpy.array(ratings, dtype=numpy.float64).T
+    players = numpy.arange(2 * count)
+    opponents = 2 * count + numpy.tile(numpy.arange(count), 2)
+    outcomes = numpy.repeat([WIN, LOSS], count)
+    env = Glicko2(tau=TAU)
+    new_mu, new_phi, new_sigma = env.rate_batch(mu, phi, sigma, players,
+                                                opponents, outcomes)
+    deltas = (new_mu[:2 * count] - mu[:2 * count]).tolist()
+    return zip(deltas[:count], deltas[count:])
+
+def predict_photo(result, photo_a, photo_b):
+    env = Glicko2(tau=TAU)
+    rating_b = (photo_b.score, photo_b.phi, photo_b.sigma)
+    mu, phi, sigma = env.rate_tuple(
+        (photo_a.score, photo_a.phi, photo_a.sigma), [(result, rating_b)])
+    return mu - photo_a.score
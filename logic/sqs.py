@@ -56,6 +56,14 @@ def get_facebook_photo(user_uuid, force_set_as_profile_photo):
     # This will get read by the '/worker_callback' method in worker.py
     get_queue().write(message)
 
+def prefetch_matches(user_uuid):
+    body = json.dumps({'user_uuid': user_uuid.hex,
+                       't': 'prefetch_matches'})
+    message = Message()
+    message.set_body(body)
+    # This will get read by the '/worker_callback' method in worker.py
+    get_queue().write(message)
+
 def assert_connection():
     if SQS_QUEUE is None:
         setup_sqs_connection()
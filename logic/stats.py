@@ -15,12 +15,18 @@ from util import now
 #CLIENT = statsd.StatsClient(settings.STATSD_HOST, settings.STATSD_PORT)
 initialize(settings.DATADOG_API_KEY, settings.DATADOG_APP_KEY)
 
-def incr(name):
+def incr(name, value=1):
     if settings.STATSD_ENABLED:
         #CLIENT.incr(name)
-        statsd.increment(name)
+        statsd.increment(name, value)
         if settings.STATS_LOG:
-            log.info('stats incr: %s', name)
+            log.info('stats incr: %s %s', name, value)
+
+def gauge(name, value):
+    if settings.STATSD_ENABLED:
+        statsd.gauge(name, value)
+        if settings.STATS_LOG:
+            log.info('stats gauge: %s %s', name, value)
 
 def timing(name, value):
     if settings.STATSD_ENABLED:
@@ -57,13 +57,12 @@ def add_tag(user, photo, tag):
 
 def log_tag_for_trending(gender, tag):
     data = json.dumps([gender, tag])
-    partition_key = '0'
+    # Shard on the tag so the trend stream isn't held to one shard.
+    partition_key = '{}_{}'.format(gender, tag.lower())
     log.info("log_tag_for_trending {} {} {}".format(settings.TAG_TREND_STREAM,
                                                      gender,
                                                      tag))
-    kinesis.get_kinesis().put_record(settings.TAG_TREND_STREAM,
-                                     data,
-                                     partition_key)
+    kinesis.put_record(settings.TAG_TREND_STREAM, data, partition_key)
 
 def do_tag_trends():
     """Get all pending taggings from stream and update GenderTagTrend table."""
@@ -74,14 +73,20 @@ def do_tag_trends():
     count = 0
     tag_counts = {}  # gender_tag -> count
     log.info("tag trends reading {}".format(settings.TAG_TREND_STREAM))
-    for data in kinesis.get_all(settings.TAG_TREND_STREAM):
-        gender, tag = json.loads(data)
-        gender_tag = '{}_{}'.format(gender, tag.lower())
-        try:
-            tag_counts[gender_tag] += 1
-        except KeyError:
-            tag_counts[gender_tag] = 1
-        count += 1
+    # The trends are rebuilt from everything read, so we only checkpoint,
+    # with the last batch, once the table is updated.
+    consumer = kinesis.StreamConsumer(settings.TAG_TREND_STREAM)
+    last_batch = None
+    for batch in consumer:
+        for data in batch:
+            gender, tag = json.loads(data)
+            gender_tag = '{}_{}'.format(gender, tag.lower())
+            try:
+                tag_counts[gender_tag] += 1
+            except KeyError:
+                tag_counts[gender_tag] = 1
+            count += 1
+        last_batch = batch
     next_time = now()
     log.info("do_tag_trends has {} from {}, took {}".format(
         pluralize(tag_counts, 'tag'),
@@ -128,4 +133,6 @@ def do_tag_trends():
     log.info("do_tag_trends create had {}, took {}".format(
         pluralize(create_count, 'create'),
         stringify(next_time-start_time)))
+    if last_batch is not None:
+        consumer.checkpoint(last_batch)
     log.info("do_tag_trends done")
\ No newline at end of file
@@ -3,7 +3,6 @@ from __future__ import division, absolute_import, unicode_literals
 
 
 from datetime import timedelta
-from itertools import islice
 from log import log
 import random
 from uuid import uuid1
@@ -11,7 +10,8 @@ from uuid import uuid1
 from pynamodb.models import DoesNotExist
 
 import model
-from logic.score import predict_match
+from logic import candidates, judged
+from logic.score import predict_matches
 from util import generate_random_string, now
 
 
@@ -40,15 +40,8 @@ def _seed_local(user, tournament):
     # an algorithm, likely top 16 ranked.
     gender = 'm' if user.view_gender_male else 'f'
     g_l = '%s%s' % (gender, user.location.hex)
-    photos = list(islice(model.Photo.post_date_index.query(
-                            g_l, scan_index_forward=False,
-                            copy_complete__eq=True,
-                            consistent_read=False),
-                    200))
-    bad_photos = [p for p in photos if not p.copy_complete]
-    if bad_photos:
-        log.debug("copy_complete__eq not working, photos with copy_complete!=True in match-query results")
-    photos = [p for p in photos if p.copy_complete]
+    # The match candidates, test photos left out.
+    photos = candidates.get_pool(g_l).get_all()
 
     if len(photos) < 16:
         log.info("not enough photos to make tournament in %s", g_l)
@@ -94,12 +87,47 @@ def create_global_tournament(user):
     tournament.save()
     return tournament
 
-def confirm_tournament_status(user):
+# The User attributes the tournament status is kept in.
+TOURNAMENT_STATUS_ATTRIBUTES = ['last_tournament_status_access',
+                                'matches_until_next_tournament',
+                                'next_tournament']
+
+# These save the user's tournament status, or with a model.WriteBack queue
+# it there, so a request's changes are one UpdateItem of the status
+# attributes when it commits.
+
+def _save_tournament_status(user, write_back):
+    if write_back is None:
+        user.save()
+    else:
+        write_back.update(user, TOURNAMENT_STATUS_ATTRIBUTES)
+
+def lock_tournament_status(user, write_back):
+    """Make write_back's update of the user's tournament status conditional
+    on it being as read, so that two requests for the user at once can't
+    both advance it. The update of the one that loses is dropped.
+
+    The status is read again, consistently, into user first, the request's
+    user may be from an eventually consistent read that hasn't seen the
+    user's last request.
+
+    """
+    stored = model.User.get(user.uuid, consistent_read=True)
+    for name in TOURNAMENT_STATUS_ATTRIBUTES:
+        setattr(user, name, getattr(stored, name))
+    if user.last_tournament_status_access is None:
+        expected = {'last_tournament_status_access__null': True}
+    else:
+        expected = {'last_tournament_status_access__eq':
+                    user.last_tournament_status_access}
+    write_back.update(user, [], **expected)
+
+def confirm_tournament_status(user, write_back=None):
     if user.matches_until_next_tournament is None:
-        init_tournament_status(user)
+        init_tournament_status(user, write_back)
 
 
-def advance_tournament_status(user):
+def advance_tournament_status(user, write_back=None):
     if 'local' == user.next_tournament:
         user.matches_until_next_tournament = 8
         user.next_tournament = 'regional'
@@ -109,34 +137,34 @@ def advance_tournament_status(user):
     elif 'global' == user.next_tournament:
         user.matches_until_next_tournament = 10
         user.next_tournament = 'local'
-    user.save()
+    _save_tournament_status(user, write_back)
 
 
-def init_tournament_status(user):
+def init_tournament_status(user, write_back=None):
     user.last_tournament_status_access = now()
     user.matches_until_next_tournament = 10
     user.next_tournament = 'local'
-    user.save()
+    _save_tournament_status(user, write_back)
 
 
-def tournament_status_log_match(user):
+def tournament_status_log_match(user, write_back=None):
     user.matches_until_next_tournament -= 1
     user.last_tournament_status_access = now()
-    user.save()
+    _save_tournament_status(user, write_back)
 
 
-def tournament_is_next(user):
-    confirm_tournament_status(user)
+def tournament_is_next(user, write_back=None):
+    confirm_tournament_status(user, write_back)
     n = now()
     if n - user.last_tournament_status_access > timedelta(hours=1):
-        init_tournament_status(user)
+        init_tournament_status(user, write_back)
     else:
         user.last_tournament_status_access = n
-        user.save()
+        _save_tournament_status(user, write_back)
     return user.matches_until_next_tournament <= 0
 
 
-def get_next_tournament(user):
+def get_next_tournament(user, write_back=None):
     if 'local' == user.next_tournament:
         tournament = create_local_tournament(user)
     elif 'regional' == user.next_tournament:
@@ -145,18 +173,36 @@ def get_next_tournament(user):
         tournament = create_global_tournament(user)
     else:
         raise ValueError
-    advance_tournament_status(user)
+    advance_tournament_status(user, write_back)
     return tournament
 
 
 def create_match(photo_a, photo_b, user):
-    match = model.Match((photo_a.uuid, photo_b.uuid), user.uuid)
-    match.proposed_date = now()
-    match.lat = user.lat
-    match.lon = user.lon
-    match.geodata = user.geodata
-    match.location = user.location
-    # Set the a_win_delta, a_lose_delta, b_win_delta, b_lose_delta values.
-    predict_match(match, photo_a, photo_b)
-    match.save()
-    return match
+    return create_matches([(photo_a, photo_b)], user)[0]
+
+def create_matches(pairs, user, write_back=None):
+    """Create a Match for each (photo_a, photo_b), predicted all at once.
+
+    With a model.WriteBack the Matches are queued there rather than saved.
+
+    """
+    predictions = predict_matches(pairs)
+    matches = []
+    for (photo_a, photo_b), deltas in zip(pairs, predictions):
+        match = model.Match((photo_a.uuid, photo_b.uuid), user.uuid)
+        match.proposed_date = now()
+        match.lat = user.lat
+        match.lon = user.lon
+        match.geodata = user.geodata
+        match.location = user.location
+        match.a_gender_location = photo_a.gender_location
+        match.b_gender_location = photo_b.gender_location
+        (match.a_win_delta, match.a_lose_delta,
+         match.b_win_delta, match.b_lose_delta) = deltas
+        if write_back is None:
+            match.save()
+        else:
+            write_back.save(match)
+        judged.add(user.uuid, photo_a.uuid, photo_b.uuid)
+        matches.append(match)
+    return matches
@@ -1,5 +1,12 @@
 from __future__ import division, absolute_import, unicode_literals
 
+from datetime import timedelta
+import random
+import struct
+from time import sleep
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
 from delorean import parse
 from pynamodb.models import Model
 from pynamodb.attributes import (BinaryAttribute,
@@ -8,7 +15,8 @@ from pynamodb.attributes import (BinaryAttribute,
                                  UnicodeAttribute,
                                  UnicodeSetAttribute)
 from pynamodb.attributes import UTCDateTimeAttribute as PynamoDBUTCDateTimeAttribute
-from pynamodb.exceptions import DoesNotExist
+from pynamodb.constants import ATTR_TYPE_MAP, UPDATE_FILTER_OPERATOR_MAP
+from pynamodb.exceptions import DoesNotExist, PutError, UpdateError
 from pynamodb.indexes import (AllProjection, GlobalSecondaryIndex,
                               IncludeProjection, KeysOnlyProjection,
                               LocalSecondaryIndex)
@@ -17,7 +25,7 @@ from log import log
 from logic.stats import classAwareDecorator, instanceAwareDecorator
 from logic.timeuuid import pack_timeuuid_binary, unpack_timeuuid_binary
 from settings import settings
-from util import grouper
+from util import epoch, grouper, merge_by
 
 # TODO: Default Read and Write Units are all too low for prod.
 DEFAULT_USER_READ_UNITS = 2
@@ -43,12 +51,13 @@ def create_table(obj, wait):
                          wait=wait)
 
 def get_models():
-    return [User, UserName, Photo, Match, PhotoComment, ShardIterator,
+    return [User, UserName, Photo, Match, PhotoComment, ShardIterator, Lease,
             Tournament, Win, Following, Follower, Flag,
             FlagStatus, FlagHistory, FeedActivity, TodayLeaderboard,
             WeekLeaderboard, MonthLeaderboard, ProfileOnlyPhoto,
             FacebookLog, Award, HourLeaderboard, YearLeaderboard,
-            PhotoGenderTag, GenderTagTrend]
+            Leaderboard, ScoreHistogram, PhotoGenderTag, GenderTagTrend,
+            LeaderboardOverview, MatchQueue]
 
 def create_model(wait_all=True):
     for models in grouper(10, get_models()):
@@ -223,6 +232,260 @@ def get_one(model_class, index_name, hash_key, raises=False, **kwargs):
             raise DoesNotExist
         return None
 
+BATCH_GET_LIMIT = 100  # DynamoDB's BatchGetItem maximum.
+
+def backoff_sleep(attempt, base=0.05, cap=2.0):
+    """Sleep a 'full jitter' exponential backoff for the given attempt."""
+    sleep(random.uniform(0, min(cap, base * 2 ** attempt)))
+
+def batch_get(model_class, keys, consistent_read=False):
+    """Yield the items of model_class at keys using BatchGetItem.
+
+    keys are hash keys, or (hash_key, range_key) tuples if the model has a
+    range key. Keys with no item are skipped. Unlike Model.batch_get, the
+    unprocessed keys DynamoDB hands back are retried with backoff instead of
+    immediately, so a throttled table isn't hammered.
+
+    """
+    meta = model_class._get_meta_data()
+    hash_keyname = meta.hash_keyname
+    range_keyname = meta.range_keyname
+    serialized = []
+    for key in keys:
+        if range_keyname:
+            hash_key, range_key = model_class._serialize_keys(key[0], key[1])
+            serialized.append({hash_keyname: hash_key,
+                               range_keyname: range_key})
+        else:
+            hash_key = model_class._serialize_keys(key)[0]
+            serialized.append({hash_keyname: hash_key})
+    table_name = model_class.Meta.table_name
+    connection = model_class._get_connection()
+    for offset in xrange(0, len(serialized), BATCH_GET_LIMIT):
+        keys_to_get = serialized[offset:offset + BATCH_GET_LIMIT]
+        attempt = 0
+        while keys_to_get:
+            if attempt:
+                backoff_sleep(attempt)
+            data = connection.batch_get_item(keys_to_get,
+                                             consistent_read=consistent_read)
+            for item in data.get('Responses', {}).get(table_name, []):
+                yield model_class.from_raw_data(item)
+            unprocessed = data.get('UnprocessedKeys', {}).get(table_name, {})
+            keys_to_get = unprocessed.get('Keys')
+            attempt += 1
+
+# -- Batch Writes -------------------------------------------------------------
+
+BATCH_WRITE_LIMIT = 25  # DynamoDB's BatchWriteItem maximum.
+WRITE_BACK_WORKERS = 8
+WRITE_BACK_ATTEMPTS = 10
+
+class WriteBack(object):
+    """Collects saves and deletes across tables and writes them in batches.
+
+    Pending writes are grouped per table into BatchWriteItem requests of up
+    to 25 and sent from a bounded thread pool by commit(). Unprocessed items
+    and throughput errors are retried with jittered backoff. A later write
+    to a key replaces an earlier pending one, as BatchWriteItem won't take
+    two writes to the same key in a request.
+
+    Note these are puts, like Model.save, without the conditions a save or
+    delete can be given.
+
+    update() queues an UpdateItem instead, for upserting some attributes of
+    an item without reading or replacing the rest of it. Updates go out on
+    the same pool as the batches; don't save and update the same key in one
+    commit.
+
+    after_commit() queues a call to make once the writes are made, for
+    telling others about them.
+
+    """
+    def __init__(self, max_workers=WRITE_BACK_WORKERS):
+        self.max_workers = max_workers
+        self.pending = {}  # model_class -> {key: (action, item)}
+        self.updates = {}  # (model_class, key) -> (hash, range, updates)
+        self.write_count = 0
+        self.request_count = 0
+        self.conditional_failures = 0
+        self.callbacks = []  # (function, args) to call after the commit.
+
+    def __len__(self):
+        return (sum(len(writes) for writes in self.pending.itervalues()) +
+                len(self.updates))
+
+    def save(self, item):
+        self._add('put', item)
+
+    def after_commit(self, function, *args):
+        """Call function(*args) once the next commit has written everything,
+        not at all if it fails."""
+        self.callbacks.append((function, args))
+
+    def delete(self, item):
+        self._add('delete', item)
+
+    def update(self, item, attribute_names, action='PUT', **expected_values):
+        """Queue an UpdateItem putting item's values for attribute_names.
+
+        The item is created if it does not exist, unless expected_values,
+        given as to Model.update_item, say otherwise. An update whose
+        condition fails is logged and counted in conditional_failures, not
+        retried. Updates to a key already queued are merged into one
+        UpdateItem, so an update of no attributes adds its condition to the
+        others, and alone isn't sent.
+
+        With action='ADD' the values are added to the stored numbers (or
+        sets) instead, atomically, and merged ADDs to one attribute are
+        summed.
+
+        """
+        # Only the key and the named attributes are serialized, the item
+        # needn't be complete.
+        meta = item._get_meta_data()
+        range_key = None
+        if meta.range_keyname:
+            range_key = getattr(item, meta.range_keyname)
+        hash_key, range_key = item._serialize_keys(
+            getattr(item, meta.hash_keyname), range_key)
+        attributes = item._get_attributes()
+        attribute_updates = {}
+        for name in attribute_names:
+            attr = attributes[name]
+            value = getattr(item, name)
+            if value is not None:
+                value = attr.serialize(value)
+            if value is None:
+                attribute_updates[attr.attr_name] = {'Action': 'DELETE'}
+            else:
+                attribute_updates[attr.attr_name] = {
+                    'Action': action,
+                    'Value': {ATTR_TYPE_MAP[attr.attr_type]: value}}
+        expected = None
+        if expected_values:
+            expected = item._build_expected_values(expected_values,
+                                                   UPDATE_FILTER_OPERATOR_MAP)
+        key = (type(item), hash_key, range_key)
+        if key in self.updates:
+            queued = self.updates[key][2]
+            for attr_name, update in attribute_updates.iteritems():
+                if update['Action'] == 'ADD' and \
+                   queued.get(attr_name, {}).get('Action') == 'ADD':
+                    update = self._sum(attributes, attr_name,
+                                       queued[attr_name], update)
+                queued[attr_name] = update
+            if expected:
+                self.updates[key][3].update(expected)
+        else:
+            self.updates[key] = (hash_key, range_key, attribute_updates,
+                                 expected or {})
+
+    @staticmethod
+    def _sum(attributes, attr_name, first, second):
+        for attr in attributes.itervalues():
+            if attr.attr_name == attr_name:
+                break
+        type_name = ATTR_TYPE_MAP[attr.attr_type]
+        value = attr.deserialize(first['Value'][type_name])
+        if isinstance(value, set):
+            value |= attr.deserialize(second['Value'][type_name])
+        else:
+            value += attr.deserialize(second['Value'][type_name])
+        return {'Action': 'ADD',
+                'Value': {type_name: attr.serialize(value)}}
+
+    def _add(self, action, item):
+        key = tuple(sorted(item._get_keys().items()))
+        self.pending.setdefault(type(item), {})[key] = (action, item)
+
+    def commit(self):
+        """Write everything pending, return the number of writes made."""
+        requests = []
+        for model_class, writes in self.pending.iteritems():
+            writes = writes.values()
+            for offset in xrange(0, len(writes), BATCH_WRITE_LIMIT):
+                put_items = []
+                delete_items = []
+                for action, item in writes[offset:offset + BATCH_WRITE_LIMIT]:
+                    if action == 'put':
+                        put_items.append(
+                            item._serialize(attr_map=True)['attributes'])
+                    else:
+                        delete_items.append(item._get_keys())
+                requests.append((self._write,
+                                 (model_class, put_items, delete_items)))
+        for (model_class, _, _), update in self.updates.iteritems():
+            # Nothing was queued to go with the update's condition.
+            if update[2]:
+                requests.append((self._update, (model_class,) + update))
+        callbacks = self.callbacks
+        self.pending = {}
+        self.updates = {}
+        self.callbacks = []
+        write_count = 0
+        if requests:
+            workers = min(self.max_workers, len(requests))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(f, *args) for f, args in requests]
+                write_count = sum(future.result() for future in futures)
+            self.write_count += write_count
+            self.request_count += len(requests)
+        for function, args in callbacks:
+            function(*args)
+        return write_count
+
+    def _write(self, model_class, put_items, delete_items):
+        table_name = model_class.Meta.table_name
+        connection = model_class._get_connection()
+        write_count = len(put_items) + len(delete_items)
+        attempt = 0
+        while put_items or delete_items:
+            if attempt == WRITE_BACK_ATTEMPTS:
+                raise PutError('WriteBack gave up on %s with %s unprocessed' % (
+                    table_name, len(put_items) + len(delete_items)))
+            if attempt:
+                backoff_sleep(attempt)
+            attempt += 1
+            try:
+                data = connection.batch_write_item(put_items=put_items,
+                                                   delete_items=delete_items)
+            except PutError as e:
+                log.warn('WriteBack retrying %s: %s', table_name, e)
+                continue
+            unprocessed = (data or {}).get('UnprocessedItems', {}).get(
+                table_name, [])
+            put_items = [i['PutRequest']['Item'] for i in unprocessed
+                         if 'PutRequest' in i]
+            delete_items = [i['DeleteRequest']['Key'] for i in unprocessed
+                            if 'DeleteRequest' in i]
+        return write_count
+
+    def _update(self, model_class, hash_key, range_key, attribute_updates,
+                expected):
+        table_name = model_class.Meta.table_name
+        connection = model_class._get_connection()
+        attempt = 0
+        while True:
+            if attempt:
+                backoff_sleep(attempt)
+            attempt += 1
+            try:
+                connection.update_item(hash_key, range_key=range_key,
+                                       attribute_updates=attribute_updates,
+                                       expected=expected or None)
+            except UpdateError as e:
+                if 'ConditionalCheckFailed' in unicode(e):
+                    log.warn('WriteBack condition failed on %s: %s',
+                             table_name, e)
+                    self.conditional_failures += 1
+                    return 0
+                if attempt == WRITE_BACK_ATTEMPTS:
+                    raise
+                log.warn('WriteBack retrying %s: %s', table_name, e)
+            else:
+                return 1
+
 # -- Custom Attributes --------------------------------------------------------
 
 class UUIDAttribute(BinaryAttribute):
@@ -255,6 +518,42 @@ class DoubleUUIDAttribute(BinaryAttribute):
         return unpack_timeuuid_binary(bytes_a), unpack_timeuuid_binary(bytes_b)
 
 
+# A ScoreRankAttribute's score, the bits of a big-endian double.
+SCORE_RANK = struct.Struct(b'>Q')
+SCORE_RANK_SIGN = 1 << 63
+SCORE_RANK_MASK = (1 << 64) - 1
+
+class ScoreRankAttribute(UnicodeAttribute):
+    """Attribute holding a (score, uuid), sorts by score then uuid.
+
+    Stored as hex, PynamoDB sends a BinaryAttribute base64 encoded twice,
+    and DynamoDB would sort it by the base64.
+
+    """
+    def serialize(self, value):
+        score, uuid = value
+        bits, = SCORE_RANK.unpack(struct.pack(b'>d', score))
+        # Flip the sign bit, and the rest of a negative, so the bytes sort
+        # the way the floats do.
+        if bits & SCORE_RANK_SIGN:
+            bits ^= SCORE_RANK_MASK
+        else:
+            bits |= SCORE_RANK_SIGN
+        bytes = SCORE_RANK.pack(bits) + pack_timeuuid_binary(uuid)
+        return super(ScoreRankAttribute, self).serialize(bytes.encode('hex'))
+
+    def deserialize(self, value):
+        value = super(ScoreRankAttribute, self).deserialize(value)
+        bytes = value.decode('hex')
+        bits, = SCORE_RANK.unpack(bytes[:SCORE_RANK.size])
+        if bits & SCORE_RANK_SIGN:
+            bits ^= SCORE_RANK_SIGN
+        else:
+            bits ^= SCORE_RANK_MASK
+        score, = struct.unpack(b'>d', SCORE_RANK.pack(bits))
+        return score, unpack_timeuuid_binary(bytes[SCORE_RANK.size:])
+
+
 class GeoCoordinate(NumberAttribute):
     def serialize(self, value):
         value = int(value * 10000)
@@ -480,6 +779,73 @@ class PhotoByScore(StatsLocalSecondaryIndex):
     score = NumberAttribute(range_key=True)
 
 
+# A busy location's Photos are spread over several gender_location hash
+# keys, so they don't share one partition. With n shards in
+# settings.GENDER_LOCATION_SHARDS, shard 0 is the plain gender_location and
+# the rest are '<gender_location>#1' to '#<n-1>'. Readers query every shard
+# of a gender_location and merge them. The leaderboards shard along with
+# the Photos.
+GENDER_LOCATION_SHARD_SEPARATOR = '#'
+
+def get_base_gender_location(gender_location):
+    """The gender_location a Photo's hash key is a shard of."""
+    return gender_location.split(GENDER_LOCATION_SHARD_SEPARATOR, 1)[0]
+
+def get_gender_location_shards(gender_location):
+    """Every hash key of a gender_location, the plain one first."""
+    count = settings.GENDER_LOCATION_SHARDS.get(gender_location[1:], 1)
+    return [gender_location] + [
+        '{}{}{}'.format(gender_location, GENDER_LOCATION_SHARD_SEPARATOR, shard)
+        for shard in xrange(1, count)]
+
+def get_gender_location_shard(gender_location, photo_uuid):
+    """The hash key a new Photo in gender_location gets.
+
+    From the settings of the moment, a Photo keeps its shard if the count
+    changes. Counts should only go up, readers read the shards of the
+    current count.
+
+    """
+    shards = get_gender_location_shards(gender_location)
+    return shards[photo_uuid.time_low % len(shards)]
+
+def query_gender_location(index, gender_location, key, **kwargs):
+    """Query an index with a gender_location hash key across its shards.
+
+    The shards are merged by key, which must sort as the query returns
+    items, see highest_first and newest_first.
+
+    """
+    shards = get_gender_location_shards(gender_location)
+    if len(shards) == 1:
+        return index.query(gender_location, **kwargs)
+    return merge_by([index.query(shard, **kwargs) for shard in shards], key)
+
+def highest_first(item):
+    return -item.score
+
+def newest_first(item):
+    return epoch - item.post_date
+
+
+# The all-gender_location score indexes hash on null_hash. It is spread over
+# ALL_SHARD_COUNT values, 'all_0' and on, so their writes and reads don't
+# all land on one partition. 'all' is the value from before, and the
+# default. Readers merge every shard, see logic.leaderboard.
+ALL_SHARD_COUNT = 8
+ALL_UNSHARDED = 'all'
+
+def get_all_shard(photo_uuid):
+    """The null_hash of a photo, and the suffix of its all boards."""
+    shard = (zlib.crc32(photo_uuid.bytes) & 0xffffffff) % ALL_SHARD_COUNT
+    return '{}_{}'.format(ALL_UNSHARDED, shard)
+
+def get_all_shards():
+    """Every null_hash value, the unsharded one first."""
+    return [ALL_UNSHARDED] + ['{}_{}'.format(ALL_UNSHARDED, shard)
+                              for shard in xrange(ALL_SHARD_COUNT)]
+
+
 class AllPhotoByScore(StatsGlobalSecondaryIndex):
     class Meta(OceanMeta):
         table_name = OceanMeta.base_name + 'photo_score_index_all'
@@ -558,7 +924,8 @@ class Photo(StatsModel):
     geodata = UnicodeAttribute()
     set_as_profile_photo = BooleanAttribute()
     match_bumped = BooleanAttribute(null=True, default=False)
-    null_hash = UnicodeAttribute(default='all')  # For all-gender_location score.
+    # For all-gender_location score, see get_all_shard.
+    null_hash = UnicodeAttribute(default=ALL_UNSHARDED)
     dupe_hash = BinaryAttribute(null=True)
     dupe_hash_index = PhotoByDupeHash()
     is_duplicate = BooleanAttribute(null=True)
@@ -572,8 +939,13 @@ class Photo(StatsModel):
     def get_is_gender_male(self):
         return self.gender_location.startswith('m')
 
+    def get_is_rated(self):
+        """False until the score job first rates the photo, and puts it on
+        the leaderboards."""
+        return self.phi != Photo.phi.default
+
     def get_location(self):
-        return self.gender_location[1:]
+        return get_base_gender_location(self.gender_location)[1:]
 
     @staticmethod
     def make_gender_location(is_gender_male, location):
@@ -655,6 +1027,60 @@ class ProfileOnlyPhoto(StatsModel):
     def get_share_url(self):
         return 'http://{}/{}'.format(settings.SHARE_URL, self.uuid.hex)
 
+# -- Leaderboards -------------------------------------------------------------
+
+# A leaderboard row leaves its board `window` after the photo's post_date.
+# DynamoDB's TTL deletes it some time after its expires attribute, typically
+# within 48 hours, so readers skip expired rows that are still there.
+LEADERBOARD_TTL_ATTRIBUTE = 'expires'
+
+def get_ttl_seconds(dt):
+    """A datetime as TTL wants it, whole seconds since the epoch."""
+    return int((dt - epoch).total_seconds())
+
+def get_leaderboard_expires(leaderboard_class, post_date):
+    return get_ttl_seconds(post_date + leaderboard_class.window)
+
+def is_leaderboard_expired(leaderboard, current_seconds):
+    """True if the row has left its board, current_seconds is a TTL time."""
+    expires = leaderboard.expires
+    if expires is None:
+        # Written before leaderboards had expires.
+        expires = get_leaderboard_expires(type(leaderboard),
+                                          leaderboard.post_date)
+    return expires <= current_seconds
+
+def get_leaderboard_models():
+    return [HourLeaderboard, TodayLeaderboard, WeekLeaderboard,
+            MonthLeaderboard, YearLeaderboard, Leaderboard, ScoreHistogram]
+
+def enable_leaderboard_ttl():
+    """Turn on DynamoDB TTL for the leaderboards, True if all are on.
+
+    Local stand-ins for DynamoDB may not have TTL, and older botocores
+    can't ask for it, use logic.leaderboard.sweep there.
+
+    """
+    enabled = True
+    for model in get_leaderboard_models():
+        client = model._get_connection().connection.client
+        if not hasattr(client, 'update_time_to_live'):
+            log.warn("Can not enable TTL on %s, botocore has no "
+                     "UpdateTimeToLive", model.Meta.table_name)
+            return False
+        try:
+            client.update_time_to_live(
+                TableName=model.Meta.table_name,
+                TimeToLiveSpecification={
+                    'Enabled': True,
+                    'AttributeName': LEADERBOARD_TTL_ATTRIBUTE})
+        except Exception as e:
+            # Also raised when TTL is already on.
+            log.warn("Enable TTL on %s had Exception %s",
+                     model.Meta.table_name, e)
+            enabled = False
+    return enabled
+
 
 class HourByUUID(StatsGlobalSecondaryIndex):
     class Meta(OceanMeta):
@@ -718,6 +1144,8 @@ class HourLeaderboard(StatsModel):
     all_score_index = AllHourByScore()
     uuid_index = HourByUUID()
     null_hash = UnicodeAttribute(default='all')  # For all-gender_location score.
+    expires = NumberAttribute(null=True)  # TTL, see get_leaderboard_expires.
+    window = timedelta(hours=1)
 
 
 class TodayByUUID(StatsGlobalSecondaryIndex):
@@ -782,6 +1210,8 @@ class TodayLeaderboard(StatsModel):
     uuid_index = TodayByUUID()
     all_score_index = AllTodayByScore()
     null_hash = UnicodeAttribute(default='all')  # For all-gender_location score.
+    expires = NumberAttribute(null=True)  # TTL, see get_leaderboard_expires.
+    window = timedelta(days=1)
 
 
 class WeekByUUID(StatsGlobalSecondaryIndex):
@@ -846,6 +1276,8 @@ class WeekLeaderboard(StatsModel):
     uuid_index = WeekByUUID()
     all_score_index = AllWeekByScore()
     null_hash = UnicodeAttribute(default='all')  # For all-gender_location score.
+    expires = NumberAttribute(null=True)  # TTL, see get_leaderboard_expires.
+    window = timedelta(days=7)
 
 
 class MonthByUUID(StatsGlobalSecondaryIndex):
@@ -910,6 +1342,8 @@ class MonthLeaderboard(StatsModel):
     uuid_index = MonthByUUID()
     all_score_index = AllMonthByScore()
     null_hash = UnicodeAttribute(default='all')  # For all-gender_location score.
+    expires = NumberAttribute(null=True)  # TTL, see get_leaderboard_expires.
+    window = timedelta(days=31)
 
 
 class YearByUUID(StatsGlobalSecondaryIndex):
@@ -974,6 +1408,75 @@ class YearLeaderboard(StatsModel):
     uuid_index = YearByUUID()
     all_score_index = AllYearByScore()
     null_hash = UnicodeAttribute(default='all')  # For all-gender_location score.
+    expires = NumberAttribute(null=True)  # TTL, see get_leaderboard_expires.
+    window = timedelta(days=365)
+
+
+class Leaderboard(StatsModel):
+    """Every windowed leaderboard in one table, see logic/leaderboard.py.
+
+    A board's rows share a hash key, its window and gender_location, and
+    the range key sorts them by score. There are no indexes.
+
+    """
+    class Meta(OceanMeta):
+        table_name = OceanMeta.base_name + 'leaderboard'
+
+    board = UnicodeAttribute(hash_key=True)  # <window>_<gender_location>
+    rank = ScoreRankAttribute(range_key=True)  # (score, uuid)
+    gender_location = UnicodeAttribute()
+    uuid = UUIDAttribute()
+    score = NumberAttribute()
+    post_date = UTCDateTimeAttribute()
+    expires = NumberAttribute()  # TTL, see get_leaderboard_expires.
+
+
+class ScoreHistogram(StatsModel):
+    """How many photos of a board are in each score bucket, for ranks.
+
+    Counted per slice of the photos' expires, so a slice leaves the board
+    as a whole, see logic.leaderboard.get_histogram_rank.
+
+    """
+    class Meta(OceanMeta):
+        table_name = OceanMeta.base_name + 'score_histogram'
+
+    board = UnicodeAttribute(hash_key=True)  # As Leaderboard.board.
+    bucket = UnicodeAttribute(range_key=True)  # <slice>_<score bucket>, hex
+    count = NumberAttribute(default=0)
+    expires = NumberAttribute()  # TTL, the end of the slice.
+
+
+class LeaderboardOverview(StatsModel):
+    """One rendered leaderboard of GET /leaderboards/m or /f.
+
+    A gender's leaderboards are one query, see logic.overview.
+
+    """
+    class Meta(OceanMeta):
+        table_name = OceanMeta.base_name + 'leaderboard_overview'
+
+    gender = UnicodeAttribute(hash_key=True)  # 'm' or 'f'
+    position = NumberAttribute(range_key=True)  # Order in the response.
+    name = UnicodeAttribute()
+    gender_location = UnicodeAttribute()
+    photos = BinaryAttribute()  # The rendered photos, zlib compressed JSON.
+    generated = UTCDateTimeAttribute()
+
+
+class MatchQueue(StatsModel):
+    """A batch of pairs picked ahead of GET /users/me/matches.
+
+    Batches are served oldest first, see logic.match_queue.
+
+    """
+    class Meta(OceanMeta):
+        table_name = OceanMeta.base_name + 'match_queue'
+
+    user_uuid = UUIDAttribute(hash_key=True)
+    queued = UTCDateTimeAttribute(range_key=True)
+    gender_location = UnicodeAttribute()  # The user's view gender_location.
+    pairs = BinaryAttribute()  # The pairs' photos, zlib compressed JSON.
 
 
 class PhotoCommentByUUID(StatsGlobalSecondaryIndex):
@@ -1019,12 +1522,28 @@ class Award(StatsModel):
 
 # -- Match --------------------------------------------------------------------
 
+class MatchByUser(StatsGlobalSecondaryIndex):
+    """A user's Matches by when they were proposed, for logic.judged."""
+    class Meta(OceanMeta):
+        table_name = OceanMeta.base_name + 'match_user_index'
+        projection = KeysOnlyProjection()
+        read_capacity_units = 2
+        write_capacity_units = 1
+
+    # This attribute is the hash key for the index
+    # Note that this attribute must also exist
+    # in the model
+    user_uuid = UUIDAttribute(hash_key=True)
+    proposed_date = UTCDateTimeAttribute(range_key=True)
+
+
 class Match(StatsModel):
     class Meta(OceanMeta):
         table_name = OceanMeta.base_name + 'match'
 
     photo_uuids = DoubleUUIDAttribute(hash_key=True)
     user_uuid = UUIDAttribute(range_key=True)
+    user_index = MatchByUser()
     judged = BooleanAttribute(default=False)
     proposed_date = UTCDateTimeAttribute()
     judged_date = UTCDateTimeAttribute(null=True)
@@ -1043,6 +1562,9 @@ class Match(StatsModel):
     lon = GeoCoordinate()
     geodata = UnicodeAttribute()
     location = UUIDAttribute()
+    # The photos' gender_locations, so scoring can load them by key.
+    a_gender_location = UnicodeAttribute(null=True)
+    b_gender_location = UnicodeAttribute(null=True)
 
     def get_photo_a(self):
         return get_one(Photo, 'uuid_index', self.photo_uuids[0],
@@ -1184,6 +1706,16 @@ class ShardIterator(StatsModel):
     sequence_number = UnicodeAttribute(null=True)
 
 
+class Lease(StatsModel):
+    """A named claim on a job, held by one owner until it expires."""
+    class Meta(OceanMeta):
+        table_name = OceanMeta.base_name + 'lease'
+
+    name = UnicodeAttribute(hash_key=True)
+    owner = UnicodeAttribute()
+    expires = UTCDateTimeAttribute()
+
+
 # -- Flagging -----------------------------------------------------------------
 
 class FlagByCountIndex(StatsGlobalSecondaryIndex):
@@ -20,6 +20,9 @@ IS_WORKER = True
 
 DYNAMO_DB_REGION = 'us-west-2'
 DYNAMO_DB_HOST = None
+# Also write and read the per-window leaderboard tables until Leaderboard is
+# backfilled, see docs/Leaderboards.rst.
+LEADERBOARD_LEGACY_TABLES = True
 
 S3_ENABLED = True
 # S3_INCOMING_BUCKET_NAME -- set in env by terraform
@@ -34,8 +37,28 @@ SNS_ENABLED = False
 SNS_APPLICATION_ARN = 'arn:aws:sns:us-west-2:000841753196:app/APNS_SANDBOX/LocalPicTourney-APNS-dev'
 
 KINESIS_ENABLED = True
+# Buffer records and send them with put_records off the request thread.
+KINESIS_PRODUCER_ENABLED = True
 # SCORE_STREAM -- set in env by terraform
 # TAG_TREND_STREAM -- set in env by terraform
+# LEADERBOARD_STREAM -- set in env by terraform
+# Keep the leaderboards in memory to serve them, see logic/ranking.py.
+LEADERBOARD_CACHE_ENABLED = False
+# Processes that follow LEADERBOARD_STREAM with the cache enabled, across
+# every server. A shard allows 5 GetRecords calls a second across all its
+# readers, so each follower polls every LEADERBOARD_FOLLOWERS / 4 seconds.
+# Raise it as the servers grow, to MaxSize times NumProcesses.
+LEADERBOARD_FOLLOWERS = 4
+# Busy locations' Photos are spread over this many gender_location shards,
+# by location uuid hex. Only ever raise a count, see model.py.
+GENDER_LOCATION_SHARDS = {}
+# Seconds a process reuses a gender_location's newest photos for matches,
+# see logic/candidates.py.
+MATCH_POOL_SECONDS = 10
+
+# Serve GET /users/me/matches from batches the worker makes ahead of time,
+# see logic/match_queue.py.
+MATCH_QUEUE_ENABLED = True
 
 LOCATION_DB_ENABLED = True
 LOCATION_DB_NAME ='loc'
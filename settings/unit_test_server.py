@@ -20,6 +20,9 @@ SHARE_URL = 'localhost:8000'
 
 DYNAMO_DB_REGION = None
 DYNAMO_DB_HOST = 'http://localhost:8000'
+# Also write and read the per-window leaderboard tables until Leaderboard is
+# backfilled, see docs/Leaderboards.rst.
+LEADERBOARD_LEGACY_TABLES = False
 
 S3_ENABLED = False
 S3_INCOMING_BUCKET_NAME = 'localpictourney-inbox'
@@ -34,8 +37,28 @@ SNS_ENABLED = False
 SNS_APPLICATION_ARN = 'arn:aws:sns:us-west-2:12345:app/APNS_SANDBOX/LocalPicTourney-APNS-dev'
 
 KINESIS_ENABLED = False
+# Buffer records and send them with put_records off the request thread.
+KINESIS_PRODUCER_ENABLED = False
 SCORE_STREAM = "{}-{}-score-stream".format(NAME, MODE)
 TAG_TREND_STREAM = "{}-{}-tag-trend-stream".format(NAME, MODE)
+LEADERBOARD_STREAM = "{}-{}-leaderboard-stream".format(NAME, MODE)
+# Keep the leaderboards in memory to serve them, see logic/ranking.py.
+LEADERBOARD_CACHE_ENABLED = False
+# Processes that follow LEADERBOARD_STREAM with the cache enabled, across
+# every server. A shard allows 5 GetRecords calls a second across all its
+# readers, so each follower polls every LEADERBOARD_FOLLOWERS / 4 seconds.
+# Raise it as the servers grow, to MaxSize times NumProcesses.
+LEADERBOARD_FOLLOWERS = 1
+# Busy locations' Photos are spread over this many gender_location shards,
+# by location uuid hex. Only ever raise a count, see model.py.
+GENDER_LOCATION_SHARDS = {}
+# Seconds a process reuses a gender_location's newest photos for matches,
+# see logic/candidates.py.
+MATCH_POOL_SECONDS = 0
+
+# Serve GET /users/me/matches from batches the worker makes ahead of time,
+# see logic/match_queue.py.
+MATCH_QUEUE_ENABLED = False
 
 LOCATION_DB_ENABLED = False
 LOCATION_DB_NAME ='loc'
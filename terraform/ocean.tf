@@ -164,6 +164,12 @@ resource "aws_kinesis_stream" "tag_trend_stream" {
   retention_period = 24
 }
 
+resource "aws_kinesis_stream" "leaderboard_stream" {
+  name = "${var.ocean["name"]}-${var.ocean["settings"]}-leaderboard-stream"
+  shard_count = 1
+  retention_period = 24
+}
+
 # -- SQS ----------------------------------------------------------------------
 
 resource "aws_sqs_queue" "dead_letter_queue" {
@@ -287,6 +293,11 @@ resource "aws_elastic_beanstalk_environment" "api_server" {
       name      = "OCEAN__TAG_TREND_STREAM"
       value     = "${aws_kinesis_stream.tag_trend_stream.name}"
   }
+  setting {
+      namespace = "aws:elasticbeanstalk:application:environment"
+      name      = "OCEAN__LEADERBOARD_STREAM"
+      value     = "${aws_kinesis_stream.leaderboard_stream.name}"
+  }
   setting {
       namespace = "aws:elasticbeanstalk:application:environment"
       name      = "OCEAN__LOCATION_DB_HOST"
@@ -768,6 +779,11 @@ resource "aws_elastic_beanstalk_environment" "worker" {
       name      = "OCEAN__TAG_TREND_STREAM"
       value     = "${aws_kinesis_stream.tag_trend_stream.name}"
   }
+  setting {
+      namespace = "aws:elasticbeanstalk:application:environment"
+      name      = "OCEAN__LEADERBOARD_STREAM"
+      value     = "${aws_kinesis_stream.leaderboard_stream.name}"
+  }
   setting {
       namespace = "aws:elasticbeanstalk:application:environment"
       name      = "OCEAN__LOCATION_DB_HOST"
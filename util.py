@@ -3,6 +3,7 @@ from __future__ import division, absolute_import, unicode_literals
 
 
 import datetime
+import heapq
 from itertools import islice
 import pytz
 import random
@@ -78,14 +79,6 @@ def random_iter(input_set):
         yield next
 
 
-def random_by_twos(input_set):
-    while len(input_set) >= 2:
-        next1, next2 = random.sample(input_set, 2)
-        input_set.remove(next1)
-        input_set.remove(next2)
-        yield next1, next2
-
-
 def seconds_in_units(seconds):
     """Get a tuple with most appropriate unit and value for seconds given.
 
@@ -248,6 +241,21 @@ def count_iter(i, count):
         if yield_count == count:
             raise StopIteration
 
+def _keyed(iterable, index, key):
+    for n, item in enumerate(iterable):
+        yield key(item), index, n, item
+
+def merge_by(iterables, key):
+    """Merge iterables each sorted by key into one sorted iterator.
+
+    Lazy, each iterable is read one item ahead of what has been yielded.
+    Items with equal keys come in the order of iterables.
+
+    """
+    for item in heapq.merge(*[_keyed(iterable, index, key)
+                              for index, iterable in enumerate(iterables)]):
+        yield item[3]
+
 def grouper(n, iterable):
     it = iter(iterable)
     while True: